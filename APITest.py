@@ -7,12 +7,18 @@ import sqlite3
 import logging
 import socket
 import json
+import os
+import sys
 
 from rich.console import Console
 from rich.table import Table
 from rich.logging import RichHandler
 from rich.text import Text
 
+# Shared modules live next to the player
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "v2"))
+import schedulestore
+
 # Rich log
 FORMAT = "%(message)s"
 logging.basicConfig(
@@ -21,7 +27,8 @@ logging.basicConfig(
 log = logging.getLogger("rich")
 
 # Open Database
-conn = sqlite3.connect("/media/ascott/USB/database/solodb.db")
+db_location = "/media/ascott/USB/database/solodb.db"
+conn = sqlite3.connect(db_location)
 cursor = conn.cursor()
 
 app = FastAPI()
@@ -30,34 +37,18 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # Functions
 def import_schedule():
     '''
-    Queries the schedule in the database for all items with given channel number.
-    All results are converted to a dictionary and returned in a list.
+    Loads every scheduled item into a compact ScheduleStore
 
     Args:
-        channel_number (int) - Channel number
 
     Returns:  
-        all_scheduled_items (list of dictionaries) - Each scheduled item
+        all_scheduled_items (ScheduleStore) - Each scheduled item, looked up by channel and time
         
     Raises:
     Example:
     '''
 
-    # Query schedule in database for given channel number 
-    now = datetime.strftime(datetime.now(), "%Y-%m-%d %HH:%MM:%SS")
-    cursor.execute(f"SELECT * FROM SCHEDULE ORDER BY Showtime ASC")
-
-    # Convert query results to a list of dictionaries
-    all_scheduled_items = [{
-            "channel": row[1],
-            "showtime": datetime.strptime(str(row[2]), "%Y-%m-%d %H:%M:%S"),
-            "end": datetime.strptime(str(row[3]), "%Y-%m-%d %H:%M:%S"),
-            "filepath": row[4],
-            "chapter": row[5],
-            "runtime": row[6]
-    } for row in cursor.fetchall()]
-
-    return all_scheduled_items
+    return schedulestore.load_schedule(db_location)
 
 def get_media_metadata(filepath):
     if "tv" in filepath:
@@ -93,19 +84,20 @@ def get_channel_data():
     schedule = import_schedule()
     if not schedule:
         log.debug("Failed to get schedule")
+        return data
     
     for channel in channels:
         # Get now playing for this channel
         log.debug(f"Searching for channel {channel}")
-        playing_now = [s for s in schedule if now >= s["showtime"] and now < s["end"] and s["channel"] == channel][0]
+        playing_now = schedule.playing_now(channel, now)
+        if playing_now is None:
+            log.debug(f"Nothing scheduled on channel {channel} at {now}")
+            continue
         playing_now_metadata = get_media_metadata(playing_now["filepath"])
 
-        try:
-            playing_now_index = schedule.index(playing_now)
-            playing_next = schedule[playing_now_index + 1]
+        playing_next = schedule.playing_next(playing_now)
+        if playing_next is not None:
             playing_next_metadata = get_media_metadata(playing_next["filepath"])
-        except IndexError:
-            playing_next = None
 
         remaining_time = (playing_now["end"] - now).total_seconds() if now < playing_now["end"] else 0
         hours, remainder = divmod(remaining_time, 3600)
@@ -121,7 +113,9 @@ def get_channel_data():
                 current_title = f"{playing_now['filepath']}"
 
 
-        if playing_next["chapter"] is not None:
+        if playing_next is None:
+            next_title = "Nothing scheduled"
+        elif playing_next["chapter"] is not None:
             next_title = f"{playing_next_metadata[2]} - {playing_next_metadata[1]} - Chapter {playing_next['chapter']}"
         else:
             if "bumper" in playing_next['filepath']:
@@ -153,7 +147,7 @@ def get_channel_data():
             "current_title": current_title,
             "time_remaining": formatted_time,
             "next_title": next_title,
-            "next_start_at": str(playing_next["showtime"]),
+            "next_start_at": str(playing_next["showtime"]) if playing_next is not None else "",
             "mpv_current_title": mpv_np_metadata
         }
         data.append(input_data)
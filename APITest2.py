@@ -1,6 +1,6 @@
-from fastapi import FastAPI, WebSocket
+from fastapi import FastAPI, WebSocket, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime, timedelta
 import asyncio
@@ -9,6 +9,7 @@ import logging
 import socket
 import json
 import os
+import sys
 import time
 from dotenv import load_dotenv
 
@@ -17,6 +18,13 @@ from rich.table import Table
 from rich.logging import RichHandler
 from rich.text import Text
 
+# Shared modules live next to the player
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "v2"))
+import heartbeat
+import media
+import metrics
+import schedulestore
+
 # Rich log
 FORMAT = "%(message)s"
 logging.basicConfig(
@@ -41,56 +49,36 @@ app.add_middleware(
 
 # Functions
 def import_schedule():
-    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
-    cursor = conn.cursor()
-
-    # Query schedule in database for given channel number 
-    now = datetime.strftime(datetime.now(), "%Y-%m-%d %HH:%MM:%SS")
-    cursor.execute(f"SELECT * FROM SCHEDULE ORDER BY Showtime ASC")
-
-    # Convert query results to a list of dictionaries
-    all_scheduled_items = [{
-            "channel": row[1],
-            "showtime": datetime.strptime(str(row[2]), "%Y-%m-%d %H:%M:%S"),
-            "end": datetime.strptime(str(row[3]), "%Y-%m-%d %H:%M:%S"),
-            "filepath": row[4],
-            "chapter": row[5],
-            "runtime": row[6]
-    } for row in cursor.fetchall()]
+    """ Loads the schedule into a compact ScheduleStore """
+    return schedulestore.load_schedule(os.getenv("DB_LOCATION"))
 
-    conn.close()
-
-    return all_scheduled_items
-
-def get_media_metadata(filepath):
+def get_media_metadata(media_id):
+    """ Library row for a scheduled item's Media ID, None for filler and other files outside the library """
     conn = sqlite3.connect(os.getenv("DB_LOCATION"))
     cursor = conn.cursor()
-    match filepath:
-        case t if "tv" in filepath:
-            cursor.execute(f"SELECT * FROM TV WHERE Filepath = '{filepath}'")
-        case t if "movie" in filepath:
-            cursor.execute(f"SELECT * FROM MOVIE WHERE Filepath = '{filepath}'")
-        case t if "bumper" in filepath:
-            cursor.execute(f"SELECT * FROM COMMERCIALS WHERE Filepath = '{filepath}'")
-        case t if "music" in filepath:
-            cursor.execute(f'SELECT * FROM MUSIC WHERE Filepath = "{filepath}"')
-        case t if "web" in filepath:
-            cursor.execute(f'SELECT * FROM WEB WHERE Filepath = "{filepath}"')
-        case _:
-            log.debug(f"No metadata found for {filepath}")
-
-    metadata = cursor.fetchone()
+    with metrics.timer("solostation_db_query_seconds", query="get_media_metadata"):
+        kind, metadata = media.get_media_metadata(cursor, media_id)
     conn.close()
+    if metadata is None:
+        log.debug(f"No metadata found for media {media_id}")
     return metadata
 
 def update_data(schedule):
+    """
+    Builds the now playing state for every channel
+
+    Args:
+        schedule (ScheduleStore) - All scheduled items
+
+    Returns:
+        data (dictionary) - Now playing entry for each channel, keyed by channel number.
+        'end' is an epoch timestamp so clients can count down on their own.
+    """
     now = datetime.now()
-    data = []
+    data = {}
 
-    all_playing_now = [s for s in schedule if now >= s["showtime"] and now < s["end"]]
-    all_playing_now = sorted(all_playing_now, key=lambda c: c["channel"])
-    for item in all_playing_now:
-        playing_now_metadata = get_media_metadata(item["filepath"])
+    for item in schedule.playing_at(now):
+        playing_now_metadata = get_media_metadata(item["media_id"])
 
         # Convert channel number to name
         match item["channel"]:
@@ -101,16 +89,19 @@ def update_data(schedule):
             case 4:
                 channel_name = "motion"
             case 5:
-                channel_name = "PPV1"
-            case 6:
                 channel_name = "BANG!"
+            case 6:
+                channel_name = "PPV1"
+            case 7:
+                channel_name = "PPV2"
+            case 8:
+                channel_name = "PPV3"
+            case _:
+                channel_name = f"channel{item['channel']}"
 
-        remaining_time = (item["end"] - now).total_seconds() if now < item["end"] else 0
-        hours, remainder = divmod(remaining_time, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        formatted_time = f"{int(hours):02}:{int(minutes):02}:{int(seconds):02}"
-
-        if "tv" in item["filepath"]:
+        if playing_now_metadata is None:
+            playing_now_title = "commercials"
+        elif "tv" in item["filepath"]:
             playing_now_title = f"{playing_now_metadata[2]} - {playing_now_metadata[1]}"
         elif "movies" in item["filepath"]:
             playing_now_title = f"{playing_now_metadata[1]}"
@@ -128,14 +119,122 @@ def update_data(schedule):
             "channel_number": item["channel"],
             "channel_name": channel_name,
             "playing_now_title": playing_now_title,
-            "time_remaining": formatted_time
+            "end": int(item["end"].timestamp())
         }
 
-        data.append(input_data)
+        data[str(item["channel"])] = input_data
     
     return data
 
+def missing_channels(schedule, state):
+    """ True if a channel in the loaded schedule has nothing playing in state """
+    return any(str(channel) not in state for channel in schedule.channel_ranges)
+
+def diff_data(old, new):
+    """
+    Finds what changed between two now playing states
+
+    Args:
+        old (dictionary) - Previous now playing state
+        new (dictionary) - Current now playing state
+
+    Returns:
+        changed (dictionary) - Channels that are new or whose entry changed
+        removed (list) - Channels that are no longer playing anything
+    """
+    changed = {c: entry for c, entry in new.items() if old.get(c) != entry}
+    removed = [c for c in old if c not in new]
+    return changed, removed
+
+async def refresh_now_playing():
+    """
+    Single shared loop that keeps the now playing state current. The state is only
+    rebuilt when an item ends or the scheduler changed the schedule, and every
+    change bumps the version and wakes up all waiting clients.
+    """
+    global schedule, now_playing, now_playing_diff, now_playing_version
+
+    next_change = 0
+    next_check = 0
+    while True:
+        heartbeat.beat("dashboard")
+        try:
+            # The scheduler keeps extending its window, pick up the new rows
+            if time.time() >= next_check:
+                next_check = time.time() + schedule_check_interval
+                # sqlite and the schedule load block, keep them off the event loop
+                version = await asyncio.to_thread(schedulestore.get_schedule_version, os.getenv("DB_LOCATION"))
+                if version != schedule.version():
+                    schedule = await asyncio.to_thread(import_schedule)
+                    next_change = 0
+
+            if time.time() >= next_change:
+                with metrics.timer("solostation_update_data_seconds"):
+                    new_state = await asyncio.to_thread(update_data, schedule)
+
+                # A channel ran past the loaded schedule, reload it before clients see the gap
+                if missing_channels(schedule, new_state):
+                    schedule = await asyncio.to_thread(import_schedule)
+                    new_state = await asyncio.to_thread(update_data, schedule)
+
+                changed, removed = diff_data(now_playing, new_state)
+                if changed or removed:
+                    async with now_playing_condition:
+                        now_playing = new_state
+                        now_playing_diff = {"changed": changed, "removed": removed}
+                        now_playing_version += 1
+                        now_playing_condition.notify_all()
+
+                ends = [entry["end"] for entry in new_state.values()]
+                next_change = min(ends) if ends else time.time() + 5
+        except Exception as e:
+            log.error(f"Now playing refresh error: {e}")
+            next_change = time.time() + 5
+        await asyncio.sleep(1)
+
+def snapshot_message():
+    """ Full now playing state message """
+    return {"type": "snapshot", "version": now_playing_version, "now": time.time(), "channels": now_playing}
+
+def diff_message():
+    """ Message holding only what changed since the previous version """
+    return {"type": "diff", "version": now_playing_version, "now": time.time(), **now_playing_diff}
+
+async def next_message(client_version, timeout=None):
+    """
+    Waits for the shared now playing state to move past client_version
+
+    Args:
+        client_version (int) - Last version the client has seen
+        timeout (float) - Seconds to wait before giving up, waits forever if None
+
+    Returns:
+        message (dictionary) - Diff if the client is one version behind, otherwise a snapshot
+        OR
+        None (if the timeout passed without a change)
+    """
+    async with now_playing_condition:
+        try:
+            await asyncio.wait_for(
+                now_playing_condition.wait_for(lambda: now_playing_version > client_version),
+                timeout
+            )
+        except asyncio.TimeoutError:
+            return None
+
+        if now_playing_version == client_version + 1:
+            return diff_message()
+        return snapshot_message()
+
 schedule = import_schedule()
+schedule_check_interval = float(os.getenv("DASHBOARD_SCHEDULE_CHECK_INTERVAL", 10))
+
+# Shared now playing state, fed by refresh_now_playing()
+now_playing = {}
+now_playing_diff = {"changed": {}, "removed": []}
+now_playing_version = 0
+now_playing_condition = asyncio.Condition()
+
 # now = datetime.now()
 # playing_now = [s for s in schedule if now >= s["showtime"] and now < s["end"]]
 # log.debug(sorted(playing_now, key=lambda c: c["channel"]))
@@ -155,25 +254,57 @@ async def get():
         <h1>Solostation Dashboard</h1>
         <div id="channels"></div>
         <script>
-            const ws = new WebSocket("ws://localhost:8086/ws");
+            // Protocol: one "snapshot" message, then "diff" messages holding only changed channels.
+            // Time remaining is counted down here from each channel's absolute "end".
+            let channels = {};
+            let version = 0;
+            let clockOffset = 0;
+            const ws = new WebSocket(`ws://${location.host}/ws`);
 
-            ws.onmessage = function(event) {
-                const channels = JSON.parse(event.data);
+            function formatRemaining(end) {
+                const remaining = Math.max(0, Math.floor(end - (Date.now() / 1000 + clockOffset)));
+                const hours = String(Math.floor(remaining / 3600)).padStart(2, "0");
+                const minutes = String(Math.floor((remaining % 3600) / 60)).padStart(2, "0");
+                const seconds = String(remaining % 60).padStart(2, "0");
+                return `${hours}:${minutes}:${seconds}`;
+            }
+
+            function render() {
                 const container = document.getElementById("channels");
                 container.innerHTML = ""; // Clear previous content
 
-                channels.forEach(channel => {
+                Object.values(channels).forEach(channel => {
                     const channelDiv = document.createElement("div");
                     channelDiv.className = "channel";
                     channelDiv.innerHTML = `
                         <div class="channel-title">${channel.channel_number} - ${channel.channel_name}</div>
                         <div>Now Playing: ${channel.playing_now_title}</div>
-                        <div>Time Remaining: ${channel.time_remaining} seconds</div>
+                        <div>Time Remaining: <span class="remaining" data-end="${channel.end}">${formatRemaining(channel.end)}</span></div>
                     `;
                     container.appendChild(channelDiv);
                 });
+            }
+
+            ws.onmessage = function(event) {
+                const message = JSON.parse(event.data);
+                clockOffset = message.now - Date.now() / 1000;
+
+                if (message.type === "snapshot") {
+                    channels = message.channels;
+                } else if (message.type === "diff") {
+                    Object.assign(channels, message.changed);
+                    message.removed.forEach(c => delete channels[c]);
+                }
+                version = message.version;
+                render();
             };
 
+            setInterval(function() {
+                document.querySelectorAll(".remaining").forEach(span => {
+                    span.textContent = formatRemaining(Number(span.dataset.end));
+                });
+            }, 1000);
+
             ws.onclose = function() {
                 console.log("WebSocket connection closed");
             };
@@ -183,16 +314,95 @@ async def get():
     """
     return HTMLResponse(content=html_content)
 
+# Pre-rendered guide grid, as built by the schedule
+def read_guide(day, channel=None):
+    """ Stored guide grids for a day, every channel's or only channel's """
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    cursor = conn.cursor()
+    if channel is None:
+        cursor.execute("SELECT Grid FROM GUIDE WHERE Day = ? ORDER BY Channel ASC", (day,))
+    else:
+        cursor.execute("SELECT Grid FROM GUIDE WHERE Day = ? AND Channel = ?", (day, channel))
+    grids = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return grids
+
+@app.get("/guide/{day}")
+async def get_guide(day: str, channel: int = None):
+    grids = await asyncio.to_thread(read_guide, day, channel)
+    if not grids:
+        return Response(status_code=404)
+
+    # Blobs are already JSON, join them without parsing
+    return Response(content=f"[{','.join(grids)}]", media_type="application/json")
+
+@app.on_event("startup")
+async def start_refresh_now_playing():
+    asyncio.create_task(refresh_now_playing())
+
 # WebSocket for real-time updates
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    while True:
+    metrics.inc("solostation_dashboard_clients", transport="ws")
+    try:
+        # Full snapshot first, then only diffs as the version moves
+        message = snapshot_message()
+        while True:
+            await websocket.send_json(message)
+            message = await next_message(message["version"])
+    except Exception as e:
+        log.error(f"WebSocket error: {e}")
+    metrics.inc("solostation_dashboard_clients", -1, transport="ws")
+    await websocket.close()
+
+# Server-Sent Events stream, same protocol as /ws
+@app.get("/events")
+async def events_endpoint(request: Request):
+    async def event_stream():
+        message = snapshot_message()
+
+        # Reconnecting clients that are already current skip the snapshot
+        last_event_id = request.headers.get("last-event-id")
+        if last_event_id is not None and last_event_id == str(now_playing_version):
+            message = None
+            client_version = now_playing_version
+
+        metrics.inc("solostation_dashboard_clients", transport="sse")
         try:
-            data = update_data(schedule)
-            await websocket.send_json(data)
-            await asyncio.sleep(1)  # Update every second
-        except Exception as e:
-            print(f"WebSocket error: {e}")
-            break
-    await websocket.close()
\ No newline at end of file
+            while not await request.is_disconnected():
+                if message is None:
+                    # Keep idle connections open through proxies
+                    yield ": keepalive\n\n"
+                else:
+                    client_version = message["version"]
+                    yield f"id: {client_version}\nevent: {message['type']}\ndata: {json.dumps(message)}\n\n"
+                message = await next_message(client_version, timeout=15)
+        finally:
+            metrics.inc("solostation_dashboard_clients", -1, transport="sse")
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# Long-poll fallback, returns as soon as the state is newer than 'since'
+@app.get("/now")
+async def now_endpoint(since: int = None, timeout: float = 25):
+    if since is not None and since >= now_playing_version:
+        await next_message(since, timeout=min(timeout, 60))
+    return snapshot_message()
+
+# Prometheus scrape endpoint
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # permessage-deflate is negotiated with clients that ask for it
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8086,
+        ws="websockets",
+        ws_per_message_deflate=os.getenv("DASHBOARD_WS_DEFLATE", "true").lower() == "true"
+    )
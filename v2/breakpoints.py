@@ -0,0 +1,209 @@
+# Break Points
+import json
+import os
+import re
+import subprocess as sp
+import time
+import logging
+
+log = logging.getLogger("rich")
+
+# Variables
+black_threshold = os.getenv("BREAK_BLACK_THRESHOLD", "0.10")
+black_min_seconds = os.getenv("BREAK_BLACK_SECONDS", "0.1")
+silence_noise = os.getenv("BREAK_SILENCE_NOISE", "-50dB")
+silence_min_seconds = os.getenv("BREAK_SILENCE_SECONDS", "0.3")
+
+# How detected candidates become chapters
+chapter_minutes = float(os.getenv("BREAK_CHAPTER_MINUTES", 8))
+edge_seconds = float(os.getenv("BREAK_EDGE_SECONDS", 120))
+min_chapter_seconds = float(os.getenv("BREAK_MIN_CHAPTER_SECONDS", 180))
+
+# Functions
+def initialize_breaks_db(cursor):
+    """
+    Initializes the Break Analysis table, black and silent stretches found in a
+    file keyed by its partial hash, and marks where chapters came from so detected
+    ones can be told apart from embedded ones. Files that couldn't be scanned are
+    kept with no candidates and the error, so they aren't scanned again.
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+
+    Returns:
+        None
+    """
+
+    log.debug("Initializing Break Analysis database")
+    table = """ CREATE TABLE IF NOT EXISTS BREAK_ANALYSIS(
+        Hash TEXT PRIMARY KEY,
+        Candidates TEXT,
+        Analyzed TEXT,
+        Error TEXT
+    );"""
+
+    cursor.execute(table)
+
+    cursor.execute("PRAGMA table_info(BREAK_ANALYSIS)")
+    if "Error" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE BREAK_ANALYSIS ADD COLUMN Error TEXT")
+
+    cursor.execute("PRAGMA table_info(CHAPTERS)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if columns and "Source" not in columns:
+        cursor.execute("ALTER TABLE CHAPTERS ADD COLUMN Source TEXT")
+
+def parse_intervals(output, name):
+    """
+    Pulls (start, end) pairs out of blackdetect or silencedetect log lines
+
+    Args:
+        output (string): ffmpeg's stderr
+        name (string): 'black' or 'silence'
+
+    Returns:
+        intervals (list): (start, end) tuples in seconds
+    """
+
+    if name == "black":
+        return [
+            (float(start), float(end))
+            for start, end in re.findall(r"black_start:\s*([\d.]+)\s+black_end:\s*([\d.]+)", output)
+        ]
+
+    starts = [float(start) for start in re.findall(r"silence_start:\s*(-?[\d.]+)", output)]
+    ends = [float(end) for end in re.findall(r"silence_end:\s*([\d.]+)", output)]
+    return list(zip(starts, ends))
+
+def detect(path):
+    """
+    Finds the stretches of a file that are black and silent at the same time,
+    where broadcasters cut to commercials. Runs blackdetect and silencedetect in
+    one decoding pass.
+
+    Args:
+        path (string): Video file
+
+    Returns:
+        candidates (list): (start, end) tuples in seconds
+
+    Example:
+        detect("/media/ascott/USB/tv/Friends (1994)/Season 1/S01E01.mp4")
+    """
+
+    command = [
+        "ffmpeg", "-hide_banner", "-nostdin", "-nostats",
+        "-i", path,
+        "-map", "0:v:0", "-map", "0:a:0?",
+        "-vf", f"blackdetect=d={black_min_seconds}:pix_th={black_threshold}",
+        "-af", f"silencedetect=n={silence_noise}:d={silence_min_seconds}",
+        "-f", "null", "-",
+    ]
+    result = sp.run(command, capture_output=True, text=True, check=True)
+
+    black = parse_intervals(result.stderr, "black")
+    silence = parse_intervals(result.stderr, "silence")
+
+    candidates = []
+    for black_start, black_end in black:
+        for silence_start, silence_end in silence:
+            start = max(black_start, silence_start)
+            end = min(black_end, silence_end)
+            if start < end:
+                candidates.append((round(start, 3), round(end, 3)))
+
+    return sorted(candidates)
+
+def analyze_file(path):
+    """
+    Process pool entry point, scans one file
+
+    Args:
+        path (string): Video file
+
+    Returns:
+        path (string): The file, for matching results up
+        candidates (list): From detect()
+        seconds (float): Time the scan took
+    """
+
+    start = time.perf_counter()
+    return path, detect(path), time.perf_counter() - start
+
+def choose_breaks(candidates, runtime):
+    """
+    Picks break points from the candidates, as close as it can to evenly spaced
+    chapters of about BREAK_CHAPTER_MINUTES, keeping clear of the opening and
+    closing BREAK_EDGE_SECONDS and never leaving a chapter shorter than
+    BREAK_MIN_CHAPTER_SECONDS
+
+    Args:
+        candidates (list): (start, end) tuples in seconds
+        runtime (float): Length of the file in seconds
+
+    Returns:
+        points (list): Break times in seconds, ascending
+
+    Example:
+        choose_breaks([(431.2, 432.0), (905.5, 906.1)], 1320)
+    """
+
+    count = max(0, round(runtime / (chapter_minutes * 60)) - 1)
+    middles = [(start + end) / 2 for start, end in candidates]
+    middles = [m for m in middles if edge_seconds <= m <= runtime - edge_seconds]
+
+    points = []
+    for index in range(1, count + 1):
+        target = runtime * index / (count + 1)
+        options = [
+            m for m in middles
+            if all(abs(m - p) >= min_chapter_seconds for p in points)
+            and m >= min_chapter_seconds and runtime - m >= min_chapter_seconds
+        ]
+        if not options:
+            continue
+        best = min(options, key=lambda m: abs(m - target))
+        # Too far from where a break belongs, better to have one break fewer
+        if abs(best - target) <= runtime / (count + 1) / 2:
+            points.append(best)
+
+    return sorted(points)
+
+def load_candidates(cursor, digest):
+    """ Cached candidates for a partial hash, or None if the file hasn't been scanned """
+    cursor.execute("SELECT Candidates FROM BREAK_ANALYSIS WHERE Hash = ?", (digest,))
+    result = cursor.fetchone()
+    return [tuple(c) for c in json.loads(result[0])] if result else None
+
+def store_candidates(cursor, digest, candidates, error=None):
+    """ Caches the candidates found in a file, or the error that stopped the scan """
+    cursor.execute(
+        "INSERT OR REPLACE INTO BREAK_ANALYSIS (Hash, Candidates, Analyzed, Error) VALUES (?, ?, datetime('now', 'localtime'), ?)",
+        (digest, json.dumps(candidates), error),
+    )
+
+def to_hms(seconds):
+    """ Seconds as 'HH:MM:SS', the format of the CHAPTERS table """
+    seconds = int(seconds)
+    return f"{seconds // 3600:02}:{(seconds % 3600) // 60:02}:{seconds % 60:02}"
+
+def write_chapters(cursor, episode_id, points, runtime):
+    """
+    Splits an episode into detected chapters at the break points
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+        episode_id (integer): ID in the TV table
+        points (list): From choose_breaks()
+        runtime (float): Length of the episode in seconds
+
+    Returns:
+        None
+    """
+
+    bounds = [0] + list(points) + [runtime]
+    for number, (start, end) in enumerate(zip(bounds, bounds[1:]), start=1):
+        cursor.execute(
+            "INSERT INTO CHAPTERS (EpisodeID, Title, Start, End, Source) VALUES (?, ?, ?, ?, 'detected')",
+            (episode_id, number, to_hms(start), to_hms(end)),
+        )
@@ -0,0 +1,496 @@
+# Conform
+import argparse
+import json
+import os
+import sqlite3
+import subprocess as sp
+import threading
+import time
+import logging
+import keyframes
+import media
+import metrics
+import pipeline
+from dotenv import load_dotenv
+from rich.logging import RichHandler
+
+# Load env file
+load_dotenv()
+
+# Rich log
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+log_level = getattr(logging, log_level_str, logging.INFO)
+FORMAT = "%(message)s"
+logging.basicConfig(
+    level=log_level_str,
+    format=FORMAT,
+    datefmt="[%X]",
+    handlers=[RichHandler()]
+)
+log = logging.getLogger("rich")
+
+# Variables
+# What the Pi 4 decodes in hardware
+video_codecs = os.getenv("CONFORM_VIDEO_CODECS", "h264").split(",")
+video_profiles = os.getenv("CONFORM_PROFILES", "Constrained Baseline,Baseline,Main,High").split(",")
+pixel_formats = os.getenv("CONFORM_PIXEL_FORMATS", "yuv420p,yuvj420p").split(",")
+audio_codecs = os.getenv("CONFORM_AUDIO_CODECS", "aac,mp3,mp2,ac3").split(",")
+max_level = int(os.getenv("CONFORM_MAX_LEVEL", 42))
+max_width = int(os.getenv("CONFORM_MAX_WIDTH", 1920))
+max_height = int(os.getenv("CONFORM_MAX_HEIGHT", 1080))
+
+# How non-conforming files are rewritten
+workers = int(os.getenv("CONFORM_WORKERS", 1))
+preset = os.getenv("CONFORM_PRESET", "veryfast")
+crf = os.getenv("CONFORM_CRF", "20")
+keep_original = os.getenv("CONFORM_KEEP_ORIGINAL", "false").lower() in ("1", "true", "yes")
+progress_interval = float(os.getenv("CONFORM_PROGRESS_INTERVAL", 5))
+probe_workers = int(os.getenv("INGEST_PROBE_WORKERS", 4))
+claim_lock = threading.Lock()
+
+# Functions
+def initialize_conform_db():
+    """
+    Initializes the Conform Jobs table, one row per file queued for a remux or
+    transcode. Jobs outlive the process, so an interrupted queue picks up where it stopped.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    cursor = conn.cursor()
+
+    log.debug("Initializing Conform Jobs database")
+    table = """ CREATE TABLE IF NOT EXISTS CONFORM_JOBS(
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        MediaID INTEGER REFERENCES MEDIA (ID),
+        Path TEXT UNIQUE,
+        Action TEXT,
+        Reasons TEXT,
+        Status TEXT,
+        Attempts INTEGER DEFAULT 0,
+        Duration REAL,
+        Position REAL,
+        Speed REAL,
+        Fps REAL,
+        Started TEXT,
+        Finished TEXT,
+        Error TEXT
+    );"""
+
+    cursor.execute(table)
+    keyframes.initialize_keyframes_db(cursor)
+    conn.commit()
+    conn.close()
+
+def probe_file(path):
+    """
+    Reads the stream and container details of a file
+
+    Args:
+        path (string): Video file
+
+    Returns:
+        info (dictionary): ffprobe's 'streams' and 'format'
+    """
+
+    command = ["ffprobe", "-v", "quiet", "-print_format", "json", "-show_streams", "-show_format", path]
+    with metrics.timer("solostation_probe_seconds", probe="conform"):
+        result = sp.run(command, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+def check_conformance(info):
+    """
+    Checks a file against what the Pi decodes in hardware
+
+    Args:
+        info (dictionary): From probe_file()
+
+    Returns:
+        action (string): 'transcode' if the video must be re-encoded, 'audio' if only
+        the audio must, None if the file conforms
+        reasons (list): What doesn't conform
+
+    Example:
+        action, reasons = check_conformance(probe_file("S01E01.mkv"))
+    """
+
+    streams = info.get("streams", [])
+    video = [s for s in streams if s.get("codec_type") == "video" and not s.get("disposition", {}).get("attached_pic")]
+    audio = [s for s in streams if s.get("codec_type") == "audio"]
+
+    video_reasons = []
+    if not video:
+        video_reasons.append("no video stream")
+    else:
+        stream = video[0]
+        if stream.get("codec_name") not in video_codecs:
+            video_reasons.append(f"codec {stream.get('codec_name')}")
+        elif stream.get("profile") not in video_profiles:
+            video_reasons.append(f"profile {stream.get('profile')}")
+        if stream.get("codec_name") == "h264" and int(stream.get("level") or 0) > max_level:
+            video_reasons.append(f"level {stream.get('level')}")
+        if int(stream.get("width") or 0) > max_width or int(stream.get("height") or 0) > max_height:
+            video_reasons.append(f"resolution {stream.get('width')}x{stream.get('height')}")
+        if stream.get("pix_fmt") not in pixel_formats:
+            video_reasons.append(f"pixel format {stream.get('pix_fmt')}")
+
+    audio_reasons = [f"audio codec {s.get('codec_name')}" for s in audio if s.get("codec_name") not in audio_codecs]
+
+    if video_reasons and video:
+        return "transcode", video_reasons + audio_reasons
+    if video_reasons:
+        return None, video_reasons
+    if audio_reasons:
+        return "audio", audio_reasons
+    return None, []
+
+def build_command(job, info, output):
+    """
+    ffmpeg command for a job, video and audio are only re-encoded when they don't conform
+
+    Args:
+        job (dictionary): Row from the Conform Jobs table
+        info (dictionary): From probe_file()
+        output (string): Temporary output file
+
+    Returns:
+        command (list): ffmpeg arguments
+    """
+
+    command = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-y",
+        "-i", job["Path"],
+        "-map", "0:v:0", "-map", "0:a?", "-map_metadata", "0", "-map_chapters", "0",
+    ]
+
+    if job["Action"] == "transcode":
+        command += [
+            "-c:v", "libx264", "-preset", preset, "-crf", crf,
+            "-profile:v", "high", "-level:v", "4.1", "-pix_fmt", "yuv420p",
+            "-vf", f"scale='min({max_width},iw)':'min({max_height},ih)':force_original_aspect_ratio=decrease:force_divisible_by=2",
+        ]
+    else:
+        command += ["-c:v", "copy"]
+
+    audio = [s for s in info.get("streams", []) if s.get("codec_type") == "audio"]
+    if all(s.get("codec_name") in audio_codecs for s in audio):
+        command += ["-c:a", "copy"]
+    else:
+        command += ["-c:a", "aac", "-b:a", "192k", "-ac", "2"]
+
+    if output.endswith(".mp4"):
+        command += ["-movflags", "+faststart"]
+
+    return command + ["-progress", "pipe:1", "-nostats", output]
+
+def discover_files(rows):
+    """ Library files to inspect, skipping any that are missing """
+    for media_id, path in rows:
+        if os.path.exists(path):
+            yield {"media_id": media_id, "file": path}
+
+def inspect_file(job):
+    """ Probe stage, checks one file """
+    job["action"], job["reasons"] = check_conformance(probe_file(job["file"]))
+    if job["action"] is None and job["reasons"]:
+        log.warning(f"Can't conform {job['file']}: {', '.join(job['reasons'])}")
+    return job
+
+@metrics.timed("solostation_ingest_seconds", kind="conform")
+def scan():
+    """
+    Inspects every library file that hasn't been inspected yet and queues the ones
+    that won't decode in hardware. Conforming files are recorded as 'ok' and files
+    that can't be fixed as 'skipped', so later scans only look at new files.
+
+    Args:
+        None
+
+    Returns:
+        queued (integer): Jobs added
+    """
+
+    initialize_conform_db()
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT m.ID, m.Path FROM MEDIA m
+        WHERE m.Kind IN ({",".join("?" * len(media.media_tables))})
+        AND m.Path NOT IN (SELECT Path FROM CONFORM_JOBS)
+    """, media.media_tables)
+    rows = cursor.fetchall()
+
+    queued = []
+
+    def queue_job(job):
+        if job["action"]:
+            status = "queued"
+        else:
+            status = "skipped" if job["reasons"] else "ok"
+        cursor.execute(
+            "INSERT OR IGNORE INTO CONFORM_JOBS (MediaID, Path, Action, Reasons, Status) VALUES (?, ?, ?, ?, ?)",
+            (job["media_id"], job["file"], job["action"], ", ".join(job["reasons"]), status),
+        )
+        conn.commit()
+        if job["action"]:
+            queued.append(job)
+            log.info(f"Queued {job['action']} of {job['file']}: {', '.join(job['reasons'])}")
+        return job
+
+    pipeline.run_pipeline(
+        "conform",
+        discover_files(rows),
+        [pipeline.Stage("probe", inspect_file, probe_workers)],
+        queue_job,
+        label=lambda job: job["file"],
+    )
+    conn.close()
+
+    return len(queued)
+
+def claim_job():
+    """
+    Takes the oldest queued job and marks it running
+
+    Args:
+        None
+
+    Returns:
+        job (dictionary): Row from the Conform Jobs table
+        OR
+        None (if the queue is empty)
+    """
+
+    with claim_lock:
+        conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM CONFORM_JOBS WHERE Status = 'queued' ORDER BY ID LIMIT 1")
+        row = cursor.fetchone()
+        if row is not None:
+            cursor.execute(
+                "UPDATE CONFORM_JOBS SET Status = 'running', Attempts = Attempts + 1, Started = datetime('now', 'localtime'), Position = 0, Error = NULL WHERE ID = ?",
+                (row["ID"],),
+            )
+            conn.commit()
+        conn.close()
+
+    return dict(row) if row is not None else None
+
+def update_job(job_id, **fields):
+    """ Sets columns on a job, i.e. update_job(3, Status="done") """
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"), timeout=10)
+    assignments = ", ".join(f"{column} = ?" for column in fields)
+    conn.execute(f"UPDATE CONFORM_JOBS SET {assignments} WHERE ID = ?", (*fields.values(), job_id))
+    conn.commit()
+    conn.close()
+
+def run_ffmpeg(job, command, duration):
+    """
+    Runs ffmpeg, recording position, speed and frame rate from its -progress output
+
+    Args:
+        job (dictionary): Row from the Conform Jobs table
+        command (list): From build_command()
+        duration (float): Seconds of media in the input
+
+    Returns:
+        None
+
+    Raises:
+        RuntimeError: If ffmpeg fails
+    """
+
+    proc = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, text=True)
+    progress = {}
+    next_update = time.monotonic() + progress_interval
+
+    for line in proc.stdout:
+        key, _, value = line.strip().partition("=")
+        progress[key] = value
+        if key != "progress":
+            continue
+
+        # One block of key=value lines per update, ending with progress=continue or end
+        position = int(progress.get("out_time_us") or progress.get("out_time_ms") or 0) / 1_000_000
+        speed = float(progress.get("speed", "0x").rstrip("x") or 0) if progress.get("speed", "N/A") != "N/A" else 0
+        fps = float(progress.get("fps") or 0)
+        if time.monotonic() >= next_update or value == "end":
+            next_update = time.monotonic() + progress_interval
+            update_job(job["ID"], Position=position, Speed=speed, Fps=fps)
+            log.info(f"Conforming {os.path.basename(job['Path'])}: {position / max(duration, 1):.0%} at {speed:.2f}x, {fps:.0f} fps")
+
+    error = proc.stderr.read()
+    if proc.wait() != 0:
+        raise RuntimeError(error.strip().splitlines()[-1] if error.strip() else f"ffmpeg exited with code {proc.returncode}")
+
+def update_library(job, path):
+    """
+    Points the library at the conformed file. The path doesn't change, only its
+    runtime and keyframe index need refreshing. A changed runtime bumps the catalog
+    version, so the scheduler stops scheduling the old one.
+
+    Args:
+        job (dictionary): Row from the Conform Jobs table
+        path (string): Conformed video file
+
+    Returns:
+        None
+    """
+
+    duration = float(probe_file(path)["format"]["duration"])
+    runtime = f"{int(duration) // 3600:02}:{(int(duration) % 3600) // 60:02}:{int(duration) % 60:02}"
+
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"), timeout=10)
+    cursor = conn.cursor()
+    cursor.execute("SELECT Kind, ItemID FROM MEDIA WHERE ID = ?", (job["MediaID"],))
+    result = cursor.fetchone()
+    if result and result[0] in media.media_tables:
+        cursor.execute(f"UPDATE {result[0]} SET Runtime = ? WHERE ID = ? AND Runtime IS NOT ?", (runtime, result[1], runtime))
+        if cursor.rowcount:
+            media.mark_catalog_changed(cursor)
+
+    try:
+        keyframes.store_keyframes(cursor, job["MediaID"], keyframes.extract_keyframes(path))
+    except (sp.CalledProcessError, ValueError) as e:
+        log.debug(f"Could not index keyframes for {path}: {e}")
+        cursor.execute("DELETE FROM KEYFRAMES WHERE MediaID = ?", (job["MediaID"],))
+
+    conn.commit()
+    conn.close()
+
+def run_job(job):
+    """
+    Remuxes or transcodes one file next to the original, checks the result and
+    swaps it in place
+
+    Args:
+        job (dictionary): Row from the Conform Jobs table
+
+    Returns:
+        ok (bool): True if the file was conformed
+    """
+
+    path = job["Path"]
+    folder, name = os.path.split(path)
+    output = os.path.join(folder, f".{os.path.splitext(name)[0]}.conform{os.path.splitext(name)[1]}")
+    start = time.perf_counter()
+
+    try:
+        info = probe_file(path)
+        duration = float(info["format"]["duration"])
+        update_job(job["ID"], Duration=duration)
+        run_ffmpeg(job, build_command(job, info, output), duration)
+
+        # A cut-short output would shorten every schedule it's in
+        output_duration = float(probe_file(output)["format"]["duration"])
+        if abs(output_duration - duration) > max(2, duration * 0.01):
+            raise RuntimeError(f"output is {output_duration:.1f}s, expected {duration:.1f}s")
+
+        if keep_original:
+            os.replace(path, f"{path}.orig")
+        os.replace(output, path)
+        update_library(job, path)
+    except Exception as e:
+        if os.path.exists(output):
+            os.remove(output)
+        update_job(job["ID"], Status="failed", Finished=time.strftime("%Y-%m-%d %H:%M:%S"), Error=str(e))
+        metrics.inc("solostation_conform_jobs_total", result="failed", action=job["Action"])
+        log.error(f"Could not conform {path}: {e}")
+        return False
+
+    seconds = time.perf_counter() - start
+    update_job(job["ID"], Status="done", Position=duration, Speed=duration / max(seconds, 1e-9), Finished=time.strftime("%Y-%m-%d %H:%M:%S"))
+    metrics.inc("solostation_conform_jobs_total", result="done", action=job["Action"])
+    metrics.observe("solostation_conform_seconds", seconds, action=job["Action"])
+    log.info(f"Conformed {path} ({job['Action']}): {duration:.0f}s of media in {seconds:.0f}s, {duration / max(seconds, 1e-9):.2f}x")
+    return True
+
+def run_worker():
+    """ Runs queued jobs one after another until the queue is empty """
+    while True:
+        job = claim_job()
+        if job is None:
+            return
+        run_job(job)
+
+def run_queue(worker_count=None):
+    """
+    Works through the queue with a bounded pool of CONFORM_WORKERS threads, each
+    running one ffmpeg at a time. Jobs left running by a process that died are
+    started over, ffmpeg can't pick up a half written file.
+
+    Args:
+        worker_count (integer): Overrides CONFORM_WORKERS
+
+    Returns:
+        None
+
+    Example:
+        run_queue(2)
+    """
+
+    initialize_conform_db()
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    resumed = conn.execute("UPDATE CONFORM_JOBS SET Status = 'queued' WHERE Status = 'running'").rowcount
+    conn.commit()
+    queued, = conn.execute("SELECT COUNT(*) FROM CONFORM_JOBS WHERE Status = 'queued'").fetchone()
+    conn.close()
+
+    if resumed:
+        log.info(f"Resuming {resumed} interrupted conform jobs")
+    log.info(f"{queued} conform jobs queued")
+
+    threads = [threading.Thread(target=run_worker, name=f"conform-{i}") for i in range(worker_count or workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def retry_failed():
+    """ Puts every failed job back in the queue """
+    initialize_conform_db()
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    retried = conn.execute("UPDATE CONFORM_JOBS SET Status = 'queued' WHERE Status = 'failed'").rowcount
+    conn.commit()
+    conn.close()
+    return retried
+
+def print_status():
+    """ Prints job counts by status and every job that is running or failed """
+    initialize_conform_db()
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    for status, count in conn.execute("SELECT Status, COUNT(*) FROM CONFORM_JOBS GROUP BY Status"):
+        print(f"{status}: {count}")
+    for path, status, position, duration, speed, error in conn.execute(
+        "SELECT Path, Status, Position, Duration, Speed, Error FROM CONFORM_JOBS WHERE Status IN ('running', 'failed') ORDER BY ID"
+    ):
+        print(f"{status} {path}: {(position or 0) / max(duration or 1, 1):.0%} at {speed or 0:.2f}x {error or ''}")
+    conn.close()
+
+metrics.describe("solostation_conform_jobs_total", "counter", "Remux and transcode jobs finished")
+metrics.describe("solostation_conform_seconds", "histogram", "Time to conform one file", (10, 30, 60, 300, 900, 1800, 3600, 7200))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remux or transcode library files the Pi can't decode in hardware")
+    parser.add_argument("--scan", action="store_true", help="Inspect the library and queue non-conforming files")
+    parser.add_argument("--run", action="store_true", help="Work through the queue")
+    parser.add_argument("--retry", action="store_true", help="Queue failed jobs again")
+    parser.add_argument("--status", action="store_true", help="Show the queue")
+    parser.add_argument("--workers", type=int, help="Overrides CONFORM_WORKERS")
+    args = parser.parse_args()
+
+    if args.status:
+        print_status()
+    else:
+        if args.retry:
+            log.info(f"Queued {retry_failed()} failed jobs again")
+        if args.scan or not args.run:
+            log.info(f"Queued {scan()} files")
+        if args.run or not args.scan:
+            run_queue(args.workers)
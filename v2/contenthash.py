@@ -0,0 +1,81 @@
+# Content Hash
+import hashlib
+import os
+import logging
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+log = logging.getLogger("rich")
+
+# Variables
+# Bytes hashed from each end of a file
+hash_block = 1024 * 1024
+read_size = 8 * 1024 * 1024
+
+# Functions
+def partial_hash(path):
+    """
+    Identifies a file by its size and its first and last megabyte, which is
+    cheap to read and survives renames and copies
+
+    Args:
+        path (string): Video file
+
+    Returns:
+        digest (string): Hex digest
+
+    Example:
+        partial_hash("/media/ascott/USB/commercials/80s/Pepsi.mp4")
+    """
+
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, "rb") as file:
+        digest.update(file.read(hash_block))
+        if size > hash_block * 2:
+            file.seek(-hash_block, os.SEEK_END)
+        digest.update(file.read(hash_block))
+
+    return digest.hexdigest()
+
+def full_hash(path):
+    """
+    Hashes a whole file, with xxhash if it is installed and blake2b otherwise.
+    Reads everything, so it is only used to confirm a partial hash match.
+
+    Args:
+        path (string): Video file
+
+    Returns:
+        digest (string): Hex digest, prefixed with the algorithm
+    """
+
+    if xxhash is not None:
+        digest, name = xxhash.xxh3_128(), "xxh3"
+    else:
+        digest, name = hashlib.blake2b(digest_size=16), "blake2b"
+
+    with open(path, "rb") as file:
+        while chunk := file.read(read_size):
+            digest.update(chunk)
+
+    return f"{name}:{digest.hexdigest()}"
+
+def stat_file(path):
+    """
+    Size, modification time and partial hash of a file
+
+    Args:
+        path (string): Video file
+
+    Returns:
+        digest (string): From partial_hash()
+        size (integer): Bytes
+        mtime (float): Modification time
+    """
+
+    stat = os.stat(path)
+    return partial_hash(path), stat.st_size, stat.st_mtime
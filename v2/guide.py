@@ -0,0 +1,298 @@
+# Guide
+import json
+import sqlite3
+import os
+import logging
+from datetime import datetime, timedelta
+
+log = logging.getLogger("rich")
+
+# Variables
+cell_TD = timedelta(minutes=30)
+cells_per_day = 48
+
+# Functions
+def initialize_guide_db():
+    """
+    Initializes the Guide table in the database, along with the Filepath indexes
+    the guide join depends on
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    cursor = conn.cursor()
+
+    log.debug("Initializing Guide database")
+    table = """ CREATE TABLE IF NOT EXISTS GUIDE(
+        Channel INTEGER,
+        Day TEXT,
+        Grid TEXT,
+        Built TEXT,
+        PRIMARY KEY (Channel, Day)
+    );"""
+
+    cursor.execute(table)
+
+    for media_table in ["TV", "MOVIE", "MUSIC"]:
+        try:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS IDX_{media_table}_Filepath ON {media_table} (Filepath)")
+        except sqlite3.OperationalError as e:
+            log.debug(f"Could not index {media_table}: {e}")
+
+    conn.commit()
+    conn.close()
+
+def get_guide_title(row):
+    """
+    Builds the guide title and kind for a joined schedule row
+
+    Args:
+        row (tuple): Showtime, End, MediaID, Chapter, ShowName, EpisodeName, MovieName, Artist, MusicTitle
+
+    Returns:
+        title (string): Title to display in the guide
+        kind (string): TV, MOVIE or MUSIC
+        OR
+        None, None (commercials, web content, idents and filler)
+
+    Example:
+        get_guide_title(row)
+    """
+
+    showtime, end, media_id, chapter, show_name, episode_name, movie_name, artist, music_title = row
+
+    if show_name is not None:
+        return f"{show_name} - {episode_name}", "TV"
+    if movie_name is not None:
+        return movie_name, "MOVIE"
+    if artist is not None:
+        return f"{artist} - {music_title}", "MUSIC"
+    return None, None
+
+def get_rule_items(cursor, channel_number, day_start):
+    """
+    Expands a looping channel's rules for the day, and the day before for a showing
+    that runs past midnight, into guide items, covering the parts of the day that
+    aren't in the schedule
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+        channel_number (integer): Channel number
+        day_start (datetime): Midnight of the day
+
+    Returns:
+        items (list): [start, end, title, kind] as in build_guide_slice()
+        OR
+        None (if the channel has no rules for the day)
+    """
+
+    days = [(day_start - timedelta(days=1)).strftime("%Y-%m-%d"), day_start.strftime("%Y-%m-%d")]
+    try:
+        cursor.execute("""
+            SELECT r.Day, r.Runtime, r.Anchor, m.Name
+            FROM CHANNEL_RULES r
+            LEFT JOIN MOVIE m ON m.Filepath = r.Filepath
+            WHERE r.Channel = ? AND r.Day IN (?, ?)
+            ORDER BY r.Day ASC
+        """, (channel_number, *days))
+    except sqlite3.OperationalError:
+        return None
+    rules = cursor.fetchall()
+    if not rules or rules[-1][0] != days[1]:
+        return None
+
+    items = []
+    day_end = day_start + timedelta(days=1)
+    for rule_day, runtime, anchor, name in rules:
+        h, m, s = map(int, runtime.split(":"))
+        runtime_TD = timedelta(hours=h, minutes=m, seconds=s)
+        showtime = datetime.strptime(anchor, "%Y-%m-%d %H:%M:%S")
+
+        # Showings start while the rule's day lasts
+        while showtime.strftime("%Y-%m-%d") == rule_day and showtime < day_end:
+            end = showtime + runtime_TD
+            if end > day_start:
+                items.append([int((showtime - day_start).total_seconds()), int((end - day_start).total_seconds()), name, "MOVIE"])
+            showtime = end
+
+    return items
+
+def get_schedule_items(cursor, channel_number, day_start):
+    """
+    Joins one channel-day of the schedule to its metadata, collapsing chapters of
+    the same episode into one program and skipping commercials and filler
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+        channel_number (integer): Channel number
+        day_start (datetime): Midnight of the day
+
+    Returns:
+        items (list): [start, end, title, kind] as in build_guide_slice()
+        span (tuple): Start of the first and end of the last row, filler included
+        OR
+        None (if nothing is scheduled that day)
+    """
+
+    day_end = day_start + timedelta(days=1)
+    query = """
+        SELECT s.Showtime, s.End, s.MediaID, s.Chapter, t.ShowName, t.Name, m.Name, mu.Artist, mu.Title
+        FROM SCHEDULE s
+        JOIN MEDIA md ON md.ID = s.MediaID
+        LEFT JOIN TV t ON md.Kind = 'TV' AND t.ID = md.ItemID
+        LEFT JOIN MOVIE m ON md.Kind = 'MOVIE' AND m.ID = md.ItemID
+        LEFT JOIN MUSIC mu ON md.Kind = 'MUSIC' AND mu.ID = md.ItemID
+        WHERE s.Channel = ? AND s.Showtime < ? AND s.End > ?
+        ORDER BY s.Showtime ASC
+    """
+    cursor.execute(query, (channel_number, str(day_end), str(day_start)))
+
+    items = []
+    span = None
+    last_media_id = None
+    for row in cursor.fetchall():
+        start = int((datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S") - day_start).total_seconds())
+        end = int((datetime.strptime(row[1], "%Y-%m-%d %H:%M:%S") - day_start).total_seconds())
+        span = (start, end) if span is None else (span[0], end)
+
+        title, kind = get_guide_title(row)
+        if title is None:
+            continue
+
+        if row[2] == last_media_id and row[3] is not None:
+            items[-1][1] = end
+        else:
+            items.append([start, end, title, kind])
+        last_media_id = row[2]
+
+    return items, span
+
+def build_guide_slice(cursor, channel_number, day):
+    """
+    Joins one channel-day of the schedule to its metadata and buckets it into 30 minute cells
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+        channel_number (integer): Channel number
+        day (string): Day in 'YYYY-MM-DD' format
+
+    Returns:
+        grid (dictionary): 'items' is a list of [start, end, title, kind], start and end
+        being seconds from midnight; 'cells' holds, for each 30 minute cell, the index
+        of the item airing at the start of the cell or -1
+
+    Example:
+        build_guide_slice(cursor, 2, "2025-04-09")
+    """
+
+    day_start = datetime.strptime(day, "%Y-%m-%d")
+    items, span = get_schedule_items(cursor, channel_number, day_start)
+
+    # Looping channels are closed form, their rules fill in the rest of the day. The
+    # schedule wins where it has rows, it holds the filler placed before an anchor.
+    rule_items = get_rule_items(cursor, channel_number, day_start)
+    if rule_items is not None and span is None:
+        items = rule_items
+    elif rule_items is not None:
+        items = [item for item in rule_items if item[1] <= span[0]] + items + [item for item in rule_items if item[0] >= span[1]]
+
+    return {"channel": channel_number, "day": day, "items": items, "cells": bucket_cells(items)}
+
+def bucket_cells(items):
+    """ For each 30 minute cell, the index of the item airing at the start of the cell or -1 """
+    cells = []
+    item_index = 0
+    for cell in range(cells_per_day):
+        cell_start = int(cell * cell_TD.total_seconds())
+        while item_index < len(items) and items[item_index][1] <= cell_start:
+            item_index += 1
+        if item_index < len(items) and items[item_index][0] <= cell_start:
+            cells.append(item_index)
+        else:
+            cells.append(-1)
+
+    return cells
+
+def store_guide_slice(cursor, grid):
+    """ Writes a channel-day grid into the Guide table as a compact JSON blob """
+    cursor.execute(
+        "INSERT OR REPLACE INTO GUIDE (Channel, Day, Grid, Built) VALUES (?, ?, ?, ?)",
+        (grid["channel"], grid["day"], json.dumps(grid, separators=(",", ":")), datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")),
+    )
+
+def materialize_guide(days=None, channels=None):
+    """
+    Builds and stores the guide grid for every affected channel-day
+
+    Args:
+        days (list): Days in 'YYYY-MM-DD' format to rebuild, defaults to every day in the schedule
+        channels (list): Channel numbers to rebuild, defaults to every channel in the schedule
+
+    Returns:
+        None
+
+    Example:
+        materialize_guide(days=["2025-04-09"])
+    """
+
+    initialize_guide_db()
+
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    cursor = conn.cursor()
+
+    # Find all channel-days in the schedule, including days items run into past midnight
+    query = """
+        SELECT Channel, DATE(Showtime) FROM SCHEDULE
+        UNION
+        SELECT Channel, DATE(End) FROM SCHEDULE
+    """
+    try:
+        cursor.execute(query + "UNION SELECT Channel, Day FROM CHANNEL_RULES")
+    except sqlite3.OperationalError:
+        cursor.execute(query)
+    slices = [
+        (channel_number, day)
+        for channel_number, day in cursor.fetchall()
+        if (days is None or day in days) and (channels is None or channel_number in channels)
+    ]
+
+    log.info(f"Materializing {len(slices)} guide slices")
+    for channel_number, day in slices:
+        store_guide_slice(cursor, build_guide_slice(cursor, channel_number, day))
+
+    conn.commit()
+    conn.close()
+
+def invalidate_guide(cutoff):
+    """
+    Drops guide slices that are entirely before cutoff and rebuilds the slices
+    for the cutoff day, which old schedule items were just trimmed from
+
+    Args:
+        cutoff (datetime): Schedule items ending before this time were removed
+
+    Returns:
+        None
+
+    Example:
+        invalidate_guide(datetime.now() - timedelta(hours=3))
+    """
+
+    initialize_guide_db()
+
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    cursor = conn.cursor()
+
+    cutoff_day = cutoff.strftime("%Y-%m-%d")
+    cursor.execute("DELETE FROM GUIDE WHERE Day < ?", (cutoff_day,))
+    log.debug(f"Dropped {cursor.rowcount} old guide slices")
+
+    conn.commit()
+    conn.close()
+
+    materialize_guide(days=[cutoff_day])
@@ -0,0 +1,101 @@
+# Heartbeat
+import sqlite3
+import os
+import time
+import logging
+
+log = logging.getLogger("rich")
+
+# Variables
+heartbeat_interval = float(os.getenv("HEARTBEAT_INTERVAL", 2))
+last_beats = {}
+table_ready = False
+
+# Functions
+def initialize_heartbeat_db():
+    """
+    Initializes the Heartbeats table, one row per supervised process. Also turns on
+    WAL journaling so the player and dashboard can read while the scheduler writes.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    global table_ready
+
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    cursor = conn.cursor()
+
+    log.debug("Initializing Heartbeats database")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    table = """ CREATE TABLE IF NOT EXISTS HEARTBEATS(
+        Name TEXT PRIMARY KEY,
+        Pid INTEGER,
+        Beat REAL,
+        Status TEXT
+    );"""
+
+    cursor.execute(table)
+    conn.commit()
+    conn.close()
+    table_ready = True
+
+def beat(name, status=None, force=False):
+    """
+    Records that a process is alive and making progress. Beats closer together
+    than HEARTBEAT_INTERVAL are skipped, so it is cheap to call from a busy loop.
+    Never raises, a locked database only costs a beat.
+
+    Args:
+        name (string): Process name, i.e. 'player'
+        status (string): Optional note on what the process is doing
+        force (bool): Write even if the last beat was recent
+
+    Returns:
+        None
+
+    Example:
+        heartbeat.beat("player", status=f"channel {current_channel}")
+    """
+
+    now = time.time()
+    if not force and now - last_beats.get(name, 0) < heartbeat_interval:
+        return
+    last_beats[name] = now
+
+    try:
+        if not table_ready:
+            initialize_heartbeat_db()
+        conn = sqlite3.connect(os.getenv("DB_LOCATION"), timeout=1)
+        conn.execute(
+            "INSERT OR REPLACE INTO HEARTBEATS (Name, Pid, Beat, Status) VALUES (?, ?, ?, ?)",
+            (name, os.getpid(), now, status),
+        )
+        conn.commit()
+        conn.close()
+    except sqlite3.Error as e:
+        log.debug(f"Missed heartbeat for {name}: {e}")
+
+def get_heartbeats():
+    """
+    Reads the latest heartbeat of every process
+
+    Args:
+        None
+
+    Returns:
+        heartbeats (dictionary): Name to (pid, epoch of the last beat, status)
+    """
+
+    try:
+        conn = sqlite3.connect(os.getenv("DB_LOCATION"), timeout=1)
+        rows = conn.execute("SELECT Name, Pid, Beat, Status FROM HEARTBEATS").fetchall()
+        conn.close()
+    except sqlite3.Error as e:
+        log.debug(f"Could not read heartbeats: {e}")
+        return {}
+
+    return {name: (pid, beat, status) for name, pid, beat, status in rows}
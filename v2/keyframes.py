@@ -0,0 +1,174 @@
+# Keyframes
+import os
+import sqlite3
+import subprocess as sp
+import logging
+from array import array
+from bisect import bisect_left
+import metrics
+
+log = logging.getLogger("rich")
+
+# Variables
+# Chapter boundaries move to a keyframe at most this far away
+snap_tolerance = float(os.getenv("KEYFRAME_SNAP_SECONDS", 5))
+
+# Functions
+def initialize_keyframes_db(cursor):
+    """
+    Initializes the Keyframes table, one row per file holding its keyframe
+    timestamps in milliseconds, packed as 32 bit integers
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+
+    Returns:
+        None
+    """
+
+    log.debug("Initializing Keyframes database")
+    table = """ CREATE TABLE IF NOT EXISTS KEYFRAMES(
+        MediaID INTEGER PRIMARY KEY REFERENCES MEDIA (ID),
+        Count INTEGER,
+        Times BLOB
+    );"""
+
+    cursor.execute(table)
+
+def extract_keyframes(file):
+    """
+    Lists the keyframe timestamps of a file's first video stream. Reads packet
+    flags with ffprobe, nothing is decoded, so it runs at demux speed.
+
+    Args:
+        file (string): Video file
+
+    Returns:
+        times (array): Keyframe times in milliseconds, ascending
+
+    Example:
+        extract_keyframes("/media/ascott/USB/movies/Batman (1989)/Batman.mp4")
+    """
+
+    command = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts_time,flags",
+        "-of",
+        "csv=p=0",
+        file,
+    ]
+    with metrics.timer("solostation_probe_seconds", probe="keyframes"):
+        result = sp.run(command, capture_output=True, text=True, check=True)
+
+    times = set()
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time not in ("", "N/A"):
+            times.add(max(0, round(float(pts_time) * 1000)))
+
+    return array("I", sorted(times))
+
+def store_keyframes(cursor, media_id, times):
+    """ Saves a file's keyframe times, replacing any earlier index """
+    cursor.execute(
+        "INSERT OR REPLACE INTO KEYFRAMES (MediaID, Count, Times) VALUES (?, ?, ?)",
+        (media_id, len(times), times.tobytes()),
+    )
+
+def load_keyframes(cursor, media_id):
+    """
+    Reads a file's keyframe index
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+        media_id (integer): ID in the Media table
+
+    Returns:
+        times (array): Keyframe times in milliseconds
+        OR
+        None (if the file hasn't been indexed)
+    """
+
+    try:
+        cursor.execute("SELECT Times FROM KEYFRAMES WHERE MediaID = ?", (media_id,))
+    except sqlite3.OperationalError:
+        return None
+    result = cursor.fetchone()
+    if result is None:
+        return None
+
+    times = array("I")
+    times.frombytes(result[0])
+    return times
+
+def nearest_keyframe(times, seconds, tolerance=snap_tolerance):
+    """
+    Finds the keyframe closest to a position
+
+    Args:
+        times (array): Keyframe times in milliseconds, None if unknown
+        seconds (float): Position in the file
+        tolerance (float): Furthest a keyframe can be from seconds
+
+    Returns:
+        keyframe (float): Keyframe time in seconds
+        OR
+        None (if no keyframe is within tolerance)
+
+    Example:
+        nearest_keyframe(times, 661.0, tolerance=2)
+    """
+
+    if not times:
+        return None
+
+    target = seconds * 1000
+    index = bisect_left(times, target)
+    candidates = [times[i] for i in (index - 1, index) if 0 <= i < len(times)]
+    keyframe = min(candidates, key=lambda t: abs(t - target))
+    if abs(keyframe - target) > tolerance * 1000:
+        return None
+    return keyframe / 1000
+
+def align_chapters(chapters, times):
+    """
+    Moves chapter boundaries onto keyframes, so breaks cut on a keyframe and each
+    chapter starts with one. The first start and the last end are left alone.
+
+    Args:
+        chapters (list): (Title, Start, End) rows from the CHAPTERS table, 'HH:MM:SS' times
+        times (array): Keyframe times in milliseconds, None if unknown
+
+    Returns:
+        chapters (list): (Title, start seconds, end seconds) tuples
+
+    Example:
+        align_chapters([(1, "00:00:00", "00:11:00"), (2, "00:11:00", "00:22:00")], times)
+    """
+
+    aligned = []
+    for position, (title, start, end) in enumerate(chapters):
+        start_seconds = hms_to_seconds(start)
+        end_seconds = hms_to_seconds(end)
+        if position > 0:
+            start_seconds = snap(times, start_seconds)
+        if position < len(chapters) - 1:
+            end_seconds = snap(times, end_seconds)
+        aligned.append((title, start_seconds, end_seconds))
+
+    return aligned
+
+def snap(times, seconds):
+    """ The nearest keyframe to seconds within KEYFRAME_SNAP_SECONDS, or seconds itself """
+    keyframe = nearest_keyframe(times, seconds)
+    return seconds if keyframe is None else keyframe
+
+def hms_to_seconds(hms):
+    """ Converts an 'HH:MM:SS' time to seconds """
+    h, m, s = map(int, hms.split(":"))
+    return h * 3600 + m * 60 + s
@@ -0,0 +1,139 @@
+# Loudness
+import json
+import os
+import re
+import sqlite3
+import subprocess as sp
+import logging
+import metrics
+
+log = logging.getLogger("rich")
+
+# Variables
+# EBU R128 broadcast target, every item is brought to it with a fixed gain
+target_loudness = float(os.getenv("LOUDNESS_TARGET", -23))
+max_true_peak = float(os.getenv("LOUDNESS_MAX_TRUE_PEAK", -1))
+max_gain = float(os.getenv("LOUDNESS_MAX_GAIN", 12))
+
+# Functions
+def initialize_loudness_db(cursor):
+    """
+    Initializes the Loudness table, one row per file with its EBU R128 measurements
+    and the gain that brings it to LOUDNESS_TARGET
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+
+    Returns:
+        None
+    """
+
+    log.debug("Initializing Loudness database")
+    table = """ CREATE TABLE IF NOT EXISTS LOUDNESS(
+        MediaID INTEGER PRIMARY KEY REFERENCES MEDIA (ID),
+        Integrated REAL,
+        TruePeak REAL,
+        Range REAL,
+        Gain REAL
+    );"""
+
+    cursor.execute(table)
+
+def analyze(file):
+    """
+    Measures a file's integrated loudness, true peak and loudness range with
+    ffmpeg's loudnorm filter in analysis mode. Decodes the audio only.
+
+    Args:
+        file (string): Video file
+
+    Returns:
+        measurement (dictionary): 'integrated' (LUFS), 'true_peak' (dBTP) and 'range' (LU)
+        OR
+        None (if the file has no audio track or only silence)
+
+    Example:
+        analyze("/media/ascott/USB/commercials/80s/Pepsi.mp4")
+    """
+
+    command = [
+        "ffmpeg", "-hide_banner", "-nostdin", "-nostats",
+        "-i", file,
+        "-map", "0:a:0?", "-vn", "-sn", "-dn",
+        "-af", f"loudnorm=I={target_loudness}:TP={max_true_peak}:print_format=json",
+        "-f", "null", "-",
+    ]
+    with metrics.timer("solostation_probe_seconds", probe="loudness"):
+        result = sp.run(command, capture_output=True, text=True)
+
+    # Without an audio track ffmpeg has no stream to write
+    if result.returncode != 0:
+        if "does not contain any stream" in result.stderr:
+            return None
+        raise sp.CalledProcessError(result.returncode, command, result.stdout, result.stderr)
+
+    # The measurements are the last JSON object loudnorm prints
+    match = re.search(r"\{[^{}]*\"input_i\"[^{}]*\}", result.stderr)
+    if match is None:
+        return None
+    data = json.loads(match.group(0))
+    if data["input_i"] in ("-inf", "inf") or data["input_tp"] in ("-inf", "inf"):
+        return None
+
+    return {
+        "integrated": float(data["input_i"]),
+        "true_peak": float(data["input_tp"]),
+        "range": float(data["input_lra"]),
+    }
+
+def get_gain(measurement):
+    """
+    Static gain in dB that brings a file to LOUDNESS_TARGET, limited so its peaks
+    stay under LOUDNESS_MAX_TRUE_PEAK and to LOUDNESS_MAX_GAIN either way
+
+    Args:
+        measurement (dictionary): From analyze()
+
+    Returns:
+        gain (float): dB to add at playback
+    """
+
+    gain = target_loudness - measurement["integrated"]
+    gain = min(gain, max_true_peak - measurement["true_peak"])
+    return round(max(-max_gain, min(max_gain, gain)), 2)
+
+def store_loudness(cursor, media_id, measurement):
+    """
+    Saves a file's measurements and gain, replacing any earlier analysis. Files
+    analyze() couldn't measure get empty measurements and no gain, so they
+    aren't analyzed again.
+    """
+    if measurement is None:
+        cursor.execute(
+            "INSERT OR REPLACE INTO LOUDNESS (MediaID, Integrated, TruePeak, Range, Gain) VALUES (?, NULL, NULL, NULL, 0)",
+            (media_id,),
+        )
+        return
+    cursor.execute(
+        "INSERT OR REPLACE INTO LOUDNESS (MediaID, Integrated, TruePeak, Range, Gain) VALUES (?, ?, ?, ?, ?)",
+        (media_id, measurement["integrated"], measurement["true_peak"], measurement["range"], get_gain(measurement)),
+    )
+
+def load_gain(cursor, media_id):
+    """
+    Reads the playback gain of a file
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+        media_id (integer): ID in the Media table
+
+    Returns:
+        gain (float): dB to add at playback, 0 if the file hasn't been analyzed
+    """
+
+    try:
+        cursor.execute("SELECT Gain FROM LOUDNESS WHERE MediaID = ?", (media_id,))
+    except sqlite3.OperationalError:
+        return 0.0
+    result = cursor.fetchone()
+    return result[0] if result else 0.0
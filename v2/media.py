@@ -0,0 +1,304 @@
+# Media
+import sqlite3
+import logging
+
+log = logging.getLogger("rich")
+
+# Variables
+media_tables = ["TV", "MOVIE", "MUSIC", "WEB", "COMMERCIALS"]
+
+# Columns of each library table the scheduler reads
+library_columns = {
+    "TV": ["ID", "Name", "ShowName", "Season", "Episode", "Overview", "Tags", "Runtime", "Filepath", "LastPlayed"],
+    "MOVIE": ["ID", "Name", "Year", "Overview", "Tags", "Runtime", "Filepath", "LastPlayed"],
+    "MUSIC": ["ID", "Artist", "Title", "Tags", "Runtime", "Filepath"],
+    "WEB": ["ID", "Tags", "Runtime", "Filepath"],
+    "COMMERCIALS": ["ID", "Tags", "Runtime", "Filepath", "LastPlayed"],
+}
+
+# Functions
+def initialize_media_db(cursor):
+    """
+    Initializes the Media table, one row per file, which the schedule references by ID.
+    Files with the same content as a library file are kept as Kind 'DUPLICATE', with
+    ItemID pointing at the Media ID of the copy that stays in the library.
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+
+    Returns:
+        None
+    """
+
+    log.debug("Initializing Media database")
+    table = """ CREATE TABLE IF NOT EXISTS MEDIA(
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        Kind TEXT,
+        ItemID INTEGER,
+        Path TEXT UNIQUE
+    );"""
+
+    cursor.execute(table)
+
+    # Content hashes, for spotting moved files and duplicates
+    cursor.execute("PRAGMA table_info(MEDIA)")
+    columns = [column[1] for column in cursor.fetchall()]
+    for column, kind in (("Hash", "TEXT"), ("Size", "INTEGER"), ("Mtime", "REAL")):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE MEDIA ADD COLUMN {column} {kind}")
+    cursor.execute("CREATE INDEX IF NOT EXISTS media_hash ON MEDIA (Hash)")
+
+def register_media(cursor, kind, item_id, path):
+    """
+    Adds a file to the Media table, or points an existing entry at its library row
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+        kind (string): Library table the file is in, i.e. 'TV', or 'FILE' for anything else
+        item_id (integer): ID of the file's row in the library table, None for 'FILE'
+        path (string): Video file
+
+    Returns:
+        media_id (integer): ID of the file in the Media table
+
+    Example:
+        register_media(cursor, "TV", cursor.lastrowid, episode)
+    """
+
+    cursor.execute(
+        "INSERT INTO MEDIA (Kind, ItemID, Path) VALUES (?, ?, ?) ON CONFLICT(Path) DO UPDATE SET Kind = excluded.Kind, ItemID = excluded.ItemID",
+        (kind, item_id, path),
+    )
+    cursor.execute("SELECT ID FROM MEDIA WHERE Path = ?", (path,))
+    return cursor.fetchone()[0]
+
+def sync_media(cursor):
+    """
+    Registers every library file that is not in the Media table yet
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+
+    Returns:
+        None
+    """
+
+    for table in media_tables:
+        try:
+            cursor.execute(f"INSERT OR IGNORE INTO MEDIA (Kind, ItemID, Path) SELECT '{table}', ID, Filepath FROM {table} WHERE Filepath IS NOT NULL")
+        except sqlite3.OperationalError as e:
+            log.debug(f"Could not register {table} media: {e}")
+
+def select_library(cursor):
+    """
+    Every item of every library table, in one query
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+
+    Returns:
+        rows (list): (Table, JSON object of the item's library_columns) tuples
+    """
+
+    selects = []
+    for table, columns in library_columns.items():
+        fields = ", ".join(f"'{column}', {column}" for column in columns)
+        selects.append(f"SELECT '{table}' AS source_table, json_object({fields}) AS data FROM {table}")
+    query = " UNION ALL ".join(selects)
+    cursor.execute(query)
+    return cursor.fetchall()
+
+def set_media_hash(cursor, media_id, digest, size, mtime):
+    """ Records the content hash of a file, with the size and mtime it was taken at """
+    cursor.execute("UPDATE MEDIA SET Hash = ?, Size = ?, Mtime = ? WHERE ID = ?", (digest, size, mtime, media_id))
+
+def get_media_hashes(cursor):
+    """
+    Every hashed library file, by content
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+
+    Returns:
+        hashes (dictionary): Hash to a list of (Media ID, Kind, ItemID, Path) tuples
+    """
+
+    hashes = {}
+    cursor.execute(f"SELECT ID, Kind, ItemID, Path, Hash FROM MEDIA WHERE Hash IS NOT NULL AND Kind IN ({','.join('?' * len(media_tables))})", media_tables)
+    for media_id, kind, item_id, path, digest in cursor.fetchall():
+        hashes.setdefault(digest, []).append((media_id, kind, item_id, path))
+    return hashes
+
+def move_media(cursor, media_id, kind, item_id, path):
+    """
+    Points a library entry at the file's new path. The library row is kept, so
+    LastPlayed, chapters and every analysis carry over.
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+        media_id (integer): ID in the Media table
+        kind (string): Library table, i.e. 'COMMERCIALS'
+        item_id (integer): ID in the library table
+        path (string): New location of the file
+
+    Returns:
+        None
+    """
+
+    cursor.execute(f"UPDATE {kind} SET Filepath = ? WHERE ID = ?", (path, item_id))
+    # The new path may have been registered already, i.e. as a bumper
+    cursor.execute("DELETE FROM MEDIA WHERE Path = ? AND ID != ?", (path, media_id))
+    cursor.execute("UPDATE MEDIA SET Path = ? WHERE ID = ?", (path, media_id))
+
+def register_duplicate(cursor, original_id, path):
+    """
+    Records a file as a copy of a library file, so it isn't scanned or scheduled again
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+        original_id (integer): Media ID of the copy in the library
+        path (string): Duplicate file
+
+    Returns:
+        media_id (integer): ID of the duplicate in the Media table
+    """
+
+    return register_media(cursor, "DUPLICATE", original_id, path)
+
+def initialize_catalog_db(cursor):
+    """
+    Initializes the Catalog Version table, a single row the media manager bumps
+    whenever the library changes, so the scheduler knows to reload its catalog
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+
+    Returns:
+        None
+    """
+
+    log.debug("Initializing Catalog Version database")
+    table = """ CREATE TABLE IF NOT EXISTS CATALOG_VERSION(
+        ID INTEGER PRIMARY KEY CHECK (ID = 1),
+        Version INTEGER,
+        Changed TEXT
+    );"""
+
+    cursor.execute(table)
+
+def mark_catalog_changed(cursor):
+    """ Bumps the catalog version, the caller commits """
+    initialize_catalog_db(cursor)
+    cursor.execute("""
+        INSERT INTO CATALOG_VERSION (ID, Version, Changed) VALUES (1, 1, datetime('now', 'localtime'))
+        ON CONFLICT(ID) DO UPDATE SET Version = Version + 1, Changed = excluded.Changed
+    """)
+
+def get_catalog_version(cursor):
+    """ Current catalog version, 0 if the library has never been marked changed """
+    try:
+        cursor.execute("SELECT Version FROM CATALOG_VERSION WHERE ID = 1")
+    except sqlite3.OperationalError:
+        return 0
+    result = cursor.fetchone()
+    return result[0] if result else 0
+
+def get_media_ids(cursor, paths, known=None):
+    """
+    Looks up the Media ID of every path, registering paths outside the library, like
+    the filler video, as 'FILE'
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+        paths (iterable): Video files
+        known (dictionary): Optional path to ID cache, filled in with any new lookups
+
+    Returns:
+        media_ids (dictionary): Path to Media ID
+
+    Example:
+        get_media_ids(cursor, ["/folder/media.mp4"])
+    """
+
+    media_ids = known if known is not None else {}
+    for path in paths:
+        if path in media_ids:
+            continue
+        cursor.execute("SELECT ID FROM MEDIA WHERE Path = ?", (path,))
+        result = cursor.fetchone()
+        if result is None:
+            cursor.execute("INSERT INTO MEDIA (Kind, ItemID, Path) VALUES ('FILE', NULL, ?)", (path,))
+            media_ids[path] = cursor.lastrowid
+        else:
+            media_ids[path] = result[0]
+    return media_ids
+
+def get_media_metadata(cursor, media_id):
+    """
+    Fetches the library row for a Media ID with a primary key lookup
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+        media_id (integer): ID in the Media table
+
+    Returns:
+        kind (string): Library table, i.e. 'MOVIE', or 'FILE'
+        metadata (tuple): Row from the library table
+        OR
+        None, None (if the ID is unknown)
+
+    Example:
+        kind, metadata = get_media_metadata(cursor, 42)
+    """
+
+    cursor.execute("SELECT Kind, ItemID FROM MEDIA WHERE ID = ?", (media_id,))
+    result = cursor.fetchone()
+    if result is None:
+        return None, None
+
+    kind, item_id = result
+    if kind not in media_tables:
+        return kind, None
+    cursor.execute(f"SELECT * FROM {kind} WHERE ID = ?", (item_id,))
+    return kind, cursor.fetchone()
+
+def migrate_schedule(cursor):
+    """
+    Moves a SCHEDULE table that still stores full file paths over to Media IDs.
+    Does nothing if the table has already been migrated.
+
+    Args:
+        cursor (sqlite3.Cursor): Open database cursor
+
+    Returns:
+        migrated (bool): True if the table was rewritten
+    """
+
+    cursor.execute("PRAGMA table_info(SCHEDULE)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if "Filepath" not in columns:
+        return False
+
+    log.info("Migrating SCHEDULE file paths to Media IDs")
+    sync_media(cursor)
+    cursor.execute("INSERT OR IGNORE INTO MEDIA (Kind, ItemID, Path) SELECT DISTINCT 'FILE', NULL, Filepath FROM SCHEDULE WHERE Filepath IS NOT NULL")
+
+    cursor.execute(""" CREATE TABLE SCHEDULE_MIGRATION(
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        Channel INTEGER,
+        Showtime TEXT,
+        End TEXT,
+        MediaID INTEGER REFERENCES MEDIA (ID),
+        Chapter INTEGER,
+        Runtime TEXT
+    );""")
+    cursor.execute("""
+        INSERT INTO SCHEDULE_MIGRATION (ID, Channel, Showtime, End, MediaID, Chapter, Runtime)
+        SELECT s.ID, s.Channel, s.Showtime, s.End, m.ID, s.Chapter, s.Runtime
+        FROM SCHEDULE s
+        LEFT JOIN MEDIA m ON m.Path = s.Filepath
+    """)
+    cursor.execute("DROP TABLE SCHEDULE")
+    cursor.execute("ALTER TABLE SCHEDULE_MIGRATION RENAME TO SCHEDULE")
+
+    return True
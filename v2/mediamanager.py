@@ -1,18 +1,32 @@
 # Media Manager
-import tvdb_v4_official
 import glob
 import re
 import os
 import sqlite3
 import moviepy.editor as mp
 import subprocess as sp
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import json
+import breakpoints
+import conform
+import contenthash
+import hashlib
+import pickle
 import logging
 import time
+import threading
+import keyframes
+import loudness
+import media
+import metrics
+import pipeline
+import tvdbfetch
+import watcher
+from pathlib import PurePath
 from rich.console import Console
 from rich.logging import RichHandler
 from dotenv import load_dotenv
-from urllib.request import urlretrieve
 
 # Load env file
 load_dotenv()
@@ -24,7 +38,22 @@ comm_root = os.getenv("COMM_ROOT")
 web_root = os.getenv("WEB_ROOT")
 music_root = os.getenv("MUSIC_ROOT")
 mt_root = os.getenv("MOVIE_TRAILER_ROOT")
-tvdb_connected = False
+
+# Ingest pipeline
+probe_workers = int(os.getenv("INGEST_PROBE_WORKERS", 4))
+loudness_workers = int(os.getenv("LOUDNESS_WORKERS", 2))
+break_workers = int(os.getenv("BREAK_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+verify_duplicates = os.getenv("HASH_VERIFY_DUPLICATES", "true").lower() in ("1", "true", "yes")
+content_index = {}
+resolved_jobs = []
+enrich_workers = int(os.getenv("INGEST_ENRICH_WORKERS", 2))
+metadata_ready = {}
+show_data = {}
+show_data_lock = threading.Lock()
+
+# Compact copies of the TVDB JSON sidecars, rebuilt whenever a sidecar changes
+sidecar_cache_dir = os.path.expanduser(os.getenv("METADATA_CACHE_DIR", "~/.cache/solostation/metadata"))
+sidecar_cache_version = 1
 
 # SQLite
 conn = sqlite3.connect(os.getenv("DB_LOCATION"))
@@ -44,31 +73,6 @@ log = logging.getLogger("rich")
 console = Console
 
 # Functions
-def connect_tvdb_api():
-    """
-    Connects to the TVDB API
-
-    Args:
-        None
-
-    Returns:
-        None
-
-    Raises:
-        None
-
-    Example:
-        connect_tvdb_api()
-    """
-
-    global tvdb, tvdb_connected
-
-    if not tvdb_connected:
-        log.debug("Connecting to TVDB")
-        apikey = os.getenv("TVDB_API_KEY")
-        tvdb = tvdb_v4_official.TVDB(apikey)
-        tvdb_connected = True
-
 def get_runtime(file):
     """
     Generates and returns the runtime for a video
@@ -88,8 +92,9 @@ def get_runtime(file):
     log.debug(f"Getting runtime for {file}")
 
     # Get runtime of episode in MM:SS
-    file_data = mp.VideoFileClip(file)
-    file_duration = int(file_data.duration)
+    with metrics.timer("solostation_probe_seconds", probe="runtime"):
+        file_data = mp.VideoFileClip(file)
+        file_duration = int(file_data.duration)
 
     hours = file_duration // 3600
     minutes = (file_duration % 3600) // 60
@@ -128,7 +133,8 @@ def get_chapters(file):
         "-sexagesimal",
         file,
     ]
-    result = sp.run(command, capture_output=True, text=True, check=True)
+    with metrics.timer("solostation_probe_seconds", probe="chapters"):
+        result = sp.run(command, capture_output=True, text=True, check=True)
     output = json.loads(result.stdout)
 
     if "chapters" in output and len(output["chapters"]) == 0:
@@ -136,6 +142,30 @@ def get_chapters(file):
     else:
         return output
 
+def get_keyframes(file):
+    """
+    Keyframe times for a video, so an unreadable index doesn't keep the file out of the library
+
+    Args:
+        file (string): Video file input
+
+    Returns:
+        times (array): Keyframe times in milliseconds
+        OR
+        None (if ffprobe could not list them)
+    """
+
+    try:
+        return keyframes.extract_keyframes(file)
+    except (sp.CalledProcessError, ValueError) as e:
+        log.debug(f"Could not index keyframes for {file}: {e}")
+        return None
+
+def store_keyframes(media_id, times):
+    """ Saves a keyframe index from the probe stage, if there is one """
+    if times:
+        keyframes.store_keyframes(cursor, media_id, times)
+
 def download_episode_metadata(show_name, show_year, episode_json, extended_json):
     """
     Downloads the episode and series extended metadata from TVDB to separate JSON files
@@ -151,73 +181,276 @@ def download_episode_metadata(show_name, show_year, episode_json, extended_json)
     """
 
     log.debug("Missing episode or extended data - Downloading from TVDB")
-    if not tvdb_connected:
-        connect_tvdb_api()
-
-    # Search TVDB using showName and showYear
-    seriesDataFull = [s for s in tvdb.search(show_name) if "year" in s]
-    seriesData = [
-        s for s in seriesDataFull if s["type"] == "series" and s["year"] == show_year
-    ][0]
-    episode_data = tvdb.get_series_episodes(seriesData["tvdb_id"])
-    extended_data = tvdb.get_series_extended(seriesData["tvdb_id"])
-
-    # Save episode data to local JSON file
-    with open(episode_json, "w") as file:
-        json.dump(episode_data, file, indent=4)
-
-    # Save extended data to local JSON file
-    with open(extended_json, "w") as file:
-        json.dump(extended_data, file, indent=4)
+    tvdbfetch.prefetch(shows=[(show_name, show_year, episode_json, extended_json)])
 
 def download_movie_metadata(movie_name, movie_year, movie_json, movie_extended_json):
     """
     Downloads all movies metadata from TVDB and saves a local copy
 
     Args:
-        movie_name (_type_): _description_
-        movie_year (_type_): _description_
+        movie_name (string): Name of the movie
+        movie_year (string): Year of the movie
+        movie_json (string): Location of the movie JSON file
+        movie_extended_json (string): Location of the movie extended JSON file
     """
 
-    global tvdb, tvdb_connected
-
-    if not tvdb_connected:
-        connect_tvdb_api()
-
     log.debug(f"Downloading movie metadata for {movie_name}")
-
-    try:
-        # Seach TVDB for movie metadata
-        movie_metadata = [
-            m
-            for m in (tvdb.search(movie_name))
-            if "year" in m and (m["type"] == "movie" and m["year"] == movie_year)
-        ][0]
-
-        # Get extended data and genres for tags
-        movie_extended_data = tvdb.get_movie_extended(movie_metadata["tvdb_id"])
-
-        # Save metadata and extended metadata to local json files
-        with open(movie_json, "w") as file:
-            json.dump(movie_metadata, file, indent=4)
-        with open(movie_extended_json, "w") as file:
-            json.dump(movie_extended_data, file, indent=4)
-    except Exception as e:
-        log.debug(f"Error downloading movie metadata: {e}")
+    tvdbfetch.prefetch(movies=[(movie_name, movie_year, movie_json, movie_extended_json)])
 
 def download_art(movie_name, movie_extended_json, movie_art):
     # Read in local JSON extended data
-    with open(movie_extended_json, "r") as file:
-        movie_extended_data = json.load(file)
-
-    # Download movie art
     try:
+        with open(movie_extended_json, "r") as file:
+            movie_extended_data = json.load(file)
         all_artwork = movie_extended_data['artworks']
         movie_art_url = [a["image"] for a in all_artwork if a["width"] == 680][0]
-        urlretrieve(movie_art_url, movie_art)
     except Exception as e:
         log.debug(f"Could not download art for {movie_name}: {e}")
-        time.sleep(1)
+        return
+
+    # Download movie art
+    tvdbfetch.prefetch(art=[(movie_art_url, movie_art)])
+
+def missing_tv_metadata():
+    """
+    Finds every show that has no local JSON files yet
+
+    Args:
+        None
+
+    Returns:
+        shows (list): tvdbfetch.fetch_show() argument tuples
+    """
+
+    shows = []
+    for tv_root_folder in next(os.walk(tv_root))[1]:
+        show_root_folder = f"{tv_root}{tv_root_folder}"
+        episode_json = f"{show_root_folder}/episodes.json"
+        series_extended_json = f"{show_root_folder}/series-extended.json"
+        if not os.path.exists(episode_json) or not os.path.exists(series_extended_json):
+            show_name = re.search(".+?(?=\s\()", tv_root_folder)[0]
+            show_year = re.search("\(([0-9]{4})\)", tv_root_folder)[1]
+            shows.append((show_name, show_year, episode_json, series_extended_json))
+
+    return shows
+
+def missing_movie_metadata():
+    """
+    Finds every movie that is missing its local JSON files or art
+
+    Args:
+        None
+
+    Returns:
+        movies (list): tvdbfetch.fetch_movie() argument tuples
+    """
+
+    movies = []
+    for movie_folder in next(os.walk(movie_root))[1]:
+        movie_root_folder = f"{movie_root}{movie_folder}"
+        try:
+            movie_name = re.search(".+?(?=\s\()", movie_folder)[0]
+            movie_year = re.search("\(([0-9]{4})\)", movie_folder)[1]
+        except TypeError:
+            continue
+        movie_name_no_spaces = movie_name.replace(" ", "")
+        movie_json = f"{movie_root_folder}/{movie_name_no_spaces}.json"
+        movie_art = f"{movie_root_folder}/{movie_name_no_spaces}.jpg"
+        movie_extended_json = f"{movie_root_folder}/{movie_name_no_spaces}-extended.json"
+        if not os.path.exists(movie_json) or not os.path.exists(movie_extended_json) or not os.path.exists(movie_art):
+            movies.append((movie_name, movie_year, movie_json, movie_extended_json, movie_art))
+
+    return movies
+
+def start_metadata_fetch(shows=(), movies=()):
+    """
+    Fetches TVDB metadata in a background thread, so probing doesn't wait on the network
+
+    Args:
+        shows (list): tvdbfetch.fetch_show() argument tuples
+        movies (list): tvdbfetch.fetch_movie() argument tuples
+
+    Returns:
+        None
+    """
+
+    for args in list(shows) + list(movies):
+        metadata_ready[args[2]] = threading.Event()
+
+    def fetch():
+        log.debug(f"Fetching TVDB metadata for {len(shows)} shows and {len(movies)} movies")
+        try:
+            tvdbfetch.prefetch(shows=shows, movies=movies, on_done=lambda args: metadata_ready[args[2]].set())
+        finally:
+            # Nothing waits forever on a fetch that never started
+            for args in list(shows) + list(movies):
+                metadata_ready[args[2]].set()
+
+    threading.Thread(target=fetch, daemon=True).start()
+
+def wait_for_metadata(json_file):
+    """ Blocks until a background fetch for json_file, if there is one, has finished """
+    ready = metadata_ready.get(json_file)
+    if ready is not None:
+        ready.wait()
+
+def get_known_files(table):
+    """
+    Every file path already in a table, read once so discovery doesn't query per file
+
+    Args:
+        table (string): Table that needs to be searched
+
+    Returns:
+        filepaths (set): Video files in the table
+    """
+
+    cursor.execute(f"SELECT Filepath FROM {table}")
+    known = {row[0] for row in cursor.fetchall()}
+
+    # Known copies of library files aren't new either
+    cursor.execute("SELECT Path FROM MEDIA WHERE Kind = 'DUPLICATE'")
+    known.update(row[0] for row in cursor.fetchall())
+    return known
+
+def find_files(pattern, paths=None):
+    """
+    Files matching a glob pattern, or only the given paths that match it
+
+    Args:
+        pattern (string): Glob pattern, i.e. f"{web_root}/*.mp4"
+        paths (set): Touched paths from a watch, None to search the disk
+
+    Returns:
+        files (list): Matching paths
+    """
+
+    if paths is None:
+        return glob.glob(pattern)
+    return [path for path in paths if PurePath(path).match(pattern)]
+
+def load_content_index():
+    """
+    Reads the content hash of every library file, so new paths can be matched
+    against files that moved or already exist under another name
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    global content_index
+
+    media.initialize_media_db(cursor)
+    content_index = media.get_media_hashes(cursor)
+    resolved_jobs.clear()
+
+def identify_content(table, job):
+    """
+    Hashes a new file and looks it up in the content index. A match whose file is
+    gone means the file was moved or renamed; a match that is still there means
+    the new file is a duplicate, confirmed with a full hash if HASH_VERIFY_DUPLICATES.
+
+    Args:
+        table (string): Library table the file would go in
+        job (dictionary): Has the file's path under 'file'
+
+    Returns:
+        job (dictionary): With 'hash', 'size' and 'mtime' set, plus 'moved_from' or
+        'duplicate_of' (Media ID, Kind, ItemID, Path) if the content is known
+    """
+
+    try:
+        job["hash"], job["size"], job["mtime"] = contenthash.stat_file(job["file"])
+    except OSError as e:
+        log.debug(f"Could not hash {job['file']}: {e}")
+        job["hash"] = None
+        return job
+
+    # Empty files, i.e. unfinished copies, all look alike
+    if not job["size"]:
+        return job
+
+    entries = content_index.setdefault(job["hash"], [])
+    for index, entry in enumerate(entries):
+        if entry[1] == table and not os.path.exists(entry[3]):
+            job["moved_from"] = entry
+            # Later copies of the same content are duplicates of the new path
+            entries[index] = (*entry[:3], job["file"])
+            return job
+
+    for entry in entries:
+        if entry[1] == table and os.path.exists(entry[3]):
+            if verify_duplicates and contenthash.full_hash(entry[3]) != contenthash.full_hash(job["file"]):
+                continue
+            job["duplicate_of"] = entry
+            return job
+
+    return job
+
+def apply_content_match(job):
+    """
+    Moves a library entry to a moved file's new path, or records a duplicate
+
+    Args:
+        job (dictionary): From identify_content()
+
+    Returns:
+        Bool - True if the file was handled and needs no ingest
+    """
+
+    if "moved_from" in job:
+        media_id, kind, item_id, path = job["moved_from"]
+        media.move_media(cursor, media_id, kind, item_id, job["file"])
+        media.set_media_hash(cursor, media_id, job["hash"], job["size"], job["mtime"])
+        conn.commit()
+        log.info(f"{path} moved to {job['file']}")
+        metrics.inc("solostation_content_matches_total", result="moved")
+        return True
+
+    if "duplicate_of" in job:
+        media_id, kind, item_id, path = job["duplicate_of"]
+        duplicate_id = media.register_duplicate(cursor, media_id, job["file"])
+        media.set_media_hash(cursor, duplicate_id, job["hash"], job["size"], job["mtime"])
+        conn.commit()
+        log.info(f"{job['file']} is a duplicate of {path}, skipping")
+        metrics.inc("solostation_content_matches_total", result="duplicate")
+        return True
+
+    return False
+
+def resolve_content(table, jobs):
+    """
+    Discovery step that holds back files whose content is already known. They
+    skip probing and are applied by apply_resolved() once the pipeline is done.
+
+    Args:
+        table (string): Library table the files would go in
+        jobs (iterable): Discovered jobs
+
+    Returns:
+        job (dictionary): Each job with new content
+    """
+
+    for job in jobs:
+        identify_content(table, job)
+        if "moved_from" in job or "duplicate_of" in job:
+            resolved_jobs.append(job)
+        else:
+            yield job
+
+def apply_resolved():
+    """ Applies the moves and duplicates resolve_content() held back """
+    for job in resolved_jobs:
+        apply_content_match(job)
+    resolved_jobs.clear()
+
+def record_hash(media_id, job):
+    """ Stores the content hash identify_content() took for a newly added file """
+    if job.get("hash"):
+        media.set_media_hash(cursor, media_id, job["hash"], job["size"], job["mtime"])
 
 def check_if_in_table(table, filepath):
     """
@@ -266,7 +499,7 @@ def initialize_all_tables():
         ID INTEGER PRIMARY KEY AUTOINCREMENT,
         Channel INTEGER,
         TimesPlayed INTEGER,
-        Filepath TEXT,
+        Filepath TEXT
     );"""
 
     cursor.execute(table)
@@ -353,12 +586,22 @@ def initialize_all_tables():
 
     cursor.execute(table)
 
-def process_music():
+    # Media, shared IDs the schedule references
+    media.initialize_media_db(cursor)
+    media.sync_media(cursor)
+    keyframes.initialize_keyframes_db(cursor)
+    loudness.initialize_loudness_db(cursor)
+    breakpoints.initialize_breaks_db(cursor)
+    media.initialize_catalog_db(cursor)
+    conn.commit()
+
+@metrics.timed("solostation_ingest_seconds", kind="music")
+def process_music(paths=None):
     """
     Go through each music video file and insert metadata into the dasebase
 
     Args:
-        None
+        paths (set): Only look at these files, i.e. from a watch
 
     Returns:
         None
@@ -367,8 +610,13 @@ def process_music():
     log.debug("")
     log.debug("Searching and processing music videos and idents")
 
-    for file in glob.glob(f"{music_root}/*.mp4"):
-        if not check_if_in_table("MUSIC", file):
+    load_content_index()
+    known = get_known_files("MUSIC")
+    for file in find_files(f"{music_root}/*.mp4", paths):
+        if file not in known:
+            job = identify_content("MUSIC", {"file": file})
+            if apply_content_match(job):
+                continue
             try:
                 # Get artist and title from filename
                 artist = file.split(" - ")[0]
@@ -386,14 +634,20 @@ def process_music():
                     "INSERT INTO MUSIC (Tags, Artist, Title, Runtime, Filepath) VALUES (?, ?, ?, ?, ?)",
                     ("music", artist, title, runtime, file),
                 )
+                record_hash(media.register_media(cursor, "MUSIC", cursor.lastrowid, file), job)
                 conn.commit()
+                metrics.inc("solostation_ingest_items_total", kind="music")
             except Exception as e:
                 log.debug(f"Could not process {file}")
                 log.debug(e)
 
     # Process each MTV ident
-    for file in glob.glob(f"{music_root}/idents/*.mp4"):
-        if not check_if_in_table("MUSIC", file):
+    for file in find_files(f"{music_root}/idents/*.mp4", paths):
+        if file not in known:
+            job = identify_content("MUSIC", {"file": file})
+            if apply_content_match(job):
+                continue
+
             # Get runtime
             runtime = get_runtime(file)
 
@@ -402,14 +656,17 @@ def process_music():
                 "INSERT INTO MUSIC (Tags, Artist, Title, Runtime, Filepath) VALUES (?, ?, ?, ?, ?)",
                 ("ident", None, None, runtime, file),
             )
+            record_hash(media.register_media(cursor, "MUSIC", cursor.lastrowid, file), job)
             conn.commit()
+            metrics.inc("solostation_ingest_items_total", kind="ident")
 
-def process_commercials():
+@metrics.timed("solostation_ingest_seconds", kind="commercials")
+def process_commercials(paths=None):
     """
     Go through each commercial video file and insert metadata into the dasebase
 
     Args:
-        None
+        paths (set): Only look at these files, i.e. from a watch
 
     Returns:
         None
@@ -418,8 +675,15 @@ def process_commercials():
     log.debug("")
     log.debug("Searching and processing commercials")
 
-    for file in glob.glob(f"{comm_root}/*/*.mp4"):
-        if not check_if_in_table("COMMERCIALS", file):
+    load_content_index()
+    known = get_known_files("COMMERCIALS")
+    for file in find_files(f"{comm_root}/*/*.mp4", paths):
+        if file not in known:
+            # Copies under another name would skew the commercial rotation
+            job = identify_content("COMMERCIALS", {"file": file})
+            if apply_content_match(job):
+                continue
+
             # Get runtime
             runtime = get_runtime(file)
 
@@ -435,14 +699,17 @@ def process_commercials():
                 "INSERT INTO COMMERCIALS (Tags, Runtime, Filepath) VALUES (?, ?, ?)",
                 (tags, runtime, file),
             )
+            record_hash(media.register_media(cursor, "COMMERCIALS", cursor.lastrowid, file), job)
             conn.commit()
+            metrics.inc("solostation_ingest_items_total", kind="commercials")
 
-def process_web():
+@metrics.timed("solostation_ingest_seconds", kind="web")
+def process_web(paths=None):
     """
     Go through each web video file and insert metadata into the dasebase
 
     Args:
-        None
+        paths (set): Only look at these files, i.e. from a watch
 
     Returns:
         None
@@ -451,8 +718,14 @@ def process_web():
     log.debug("")
     log.debug("Searching and processing web content")
 
-    for file in glob.glob(f"{web_root}/*.mp4"):
-        if not check_if_in_table("WEB", file):
+    load_content_index()
+    known = get_known_files("WEB")
+    for file in find_files(f"{web_root}/*.mp4", paths):
+        if file not in known:
+            job = identify_content("WEB", {"file": file})
+            if apply_content_match(job):
+                continue
+
             # Get runtime
             runtime = get_runtime(file)
 
@@ -461,191 +734,739 @@ def process_web():
                 "INSERT INTO WEB(Tags, Runtime, Filepath) VALUES (?, ?, ?)",
                 ("web", runtime, file),
             )
+            record_hash(media.register_media(cursor, "WEB", cursor.lastrowid, file), job)
             conn.commit()
+            metrics.inc("solostation_ingest_items_total", kind="web")
 
-def process_tv():
+def discover_tv(known, paths=None):
     """
-    Go through each TV video file and insert metadata into the dasebase
+    Walks the TV folders for episodes that aren't in the database yet
 
     Args:
-        None
+        known (set): Files already in the TV table
+        paths (set): Only look at these files, i.e. from a watch
 
     Returns:
-        None
+        job (dictionary): One per new episode, passed along the ingest stages
     """
 
-    log.debug("")
-    log.debug("Searching and processing TV episodes")
-
     # Go through each TV show folder
     for tv_root_folder in next(os.walk(tv_root))[1]:
         # Parse metadata of TV show based on folder name
         show_root_folder = f"{tv_root}{tv_root_folder}"
         show_name = re.search(".+?(?=\s\()", tv_root_folder)[0]
-        show_year = re.search("\(([0-9]{4})\)", tv_root_folder)[1]
-        episode_json = f"{show_root_folder}/episodes.json"
-        series_extended_json = f"{show_root_folder}/series-extended.json"
 
         # Gather all MP4 and MKV files under the current TV show folder
-        all_episode_files = glob.glob(
-            f"{show_root_folder}/*/*.mp4", recursive=True
-        ) + glob.glob(f"{show_root_folder}/*/*.mkv", recursive=True)
+        all_episode_files = find_files(
+            f"{show_root_folder}/*/*.mp4", paths
+        ) + find_files(f"{show_root_folder}/*/*.mkv", paths)
         log.debug(f"Found {len(all_episode_files)} episodes for {show_name}")
 
-        # Check for episode and extended data local json files
-        log.debug(f"Checking for {show_name} local data")
-        if not os.path.exists(episode_json) or not os.path.exists(series_extended_json):
-            download_episode_metadata(show_name, show_year, episode_json, series_extended_json)
+        for episode in all_episode_files:
+            if episode not in known:
+                yield {
+                    "file": episode,
+                    "show_name": show_name,
+                    "episode_json": f"{show_root_folder}/episodes.json",
+                    "series_extended_json": f"{show_root_folder}/series-extended.json",
+                }
+
+def probe_episode(job):
+    """ Probe stage, reads an episode's runtime, chapters and keyframes """
+    job["runtime"] = get_runtime(job["file"])
+    job["chapters"] = get_chapters(job["file"])
+    job["keyframes"] = get_keyframes(job["file"])
+    return job
+
+def episode_fields(data):
+    """ What ingest uses from episodes.json, (season, number) to name and overview """
+    return {
+        (e["seasonNumber"], e["number"]): {"name": e["name"], "overview": e["overview"]}
+        for e in data["episodes"]
+    }
+
+def genre_fields(data):
+    """ What ingest uses from a series or movie extended JSON, the genre names """
+    return [tag["name"] for tag in data["genres"]]
+
+def movie_fields(data):
+    """ What ingest uses from a movie JSON """
+    return {"name": data["name"], "year": data["year"], "overview": data["overview"]}
+
+def load_sidecar(json_file, fields):
+    """
+    Reads the fields ingest needs from a TVDB JSON sidecar. The extracted fields
+    are pickled under METADATA_CACHE_DIR along with the sidecar's mtime and size,
+    so later scans skip parsing the full, pretty printed JSON until it changes.
 
-        # Open episode and extended json files
-        log.debug("Opening Episode and Series Local JSON files")
-        with open(episode_json, "r") as episode_data_file:
-            episode_local_data = json.load(episode_data_file)
-        with open(series_extended_json, "r") as series_data_file:
-            series_local_data = json.load(series_data_file)
+    Args:
+        json_file (string): Sidecar JSON file
+        fields (function): Extracts the needed fields from the parsed JSON, i.e. episode_fields
 
-        # Check each episode and make sure that it is in the database
-        for episode in all_episode_files:
-            if not check_if_in_table("TV", episode):
-                # Parse season and episode numbers
-                season_number = re.search("S(\d{2})", episode).group(1)
-                if season_number.startswith("0"):
-                    season_number = season_number.lstrip("0")
-                
-                episode_number = re.search("E(\d{2})", episode).group(1)
-                if episode_number.startswith("0"):
-                    episode_number = episode_number.lstrip("0")
-
-                # log.debug([e for e in episode_local_data["episodes"] if e["seasonNumber"] == 1][0])
-
-                # Find episode metadata in local json file
-                try:
-                    log.debug(f"Searching local files for season {season_number} episode {episode_number}")
-                    episode_metadata = [
-                        e 
-                        for e in episode_local_data["episodes"] 
-                        if e["seasonNumber"] == int(season_number)
-                        and e["number"] == int(episode_number)
-                    ][0]
-                except Exception as e:
-                    log.debug(f"Episode Metadata Error: {e}")
-
-                if episode_metadata:
-                    # Append tags from the show's genres
-                    tags = ["tv"]
-                    for tag in series_local_data["genres"]:
-                        tags.append(tag["name"].lower())
-                    tags = str(",".join(tags))
-
-                    # Get runtime for episode
-                    runtime = get_runtime(episode)
-
-                    # Insert episode into database
-                    cursor.execute(
-                        "INSERT INTO TV (Name, ShowName, Season, Episode, Overview, Tags, Runtime, Filepath) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                        (
-                            episode_metadata["name"],
-                            show_name,
-                            season_number,
-                            episode_number,
-                            episode_metadata["overview"],
-                            tags,
-                            runtime,
-                            episode
-                        ),
-                    )
-                    conn.commit()
-
-                    episode_id = cursor.lastrowid
-                    all_chapters = get_chapters(episode)
-                    chapter_number = 1
-                    if all_chapters:
-                        for chapter in all_chapters["chapters"]:
-                            log.debug(f"{chapter=}")
-                            # Insert chapter into database
-                            cursor.execute(
-                                "INSERT INTO CHAPTERS (EpisodeID, Title, Start, End) VALUES (?, ?, ?, ?)",
-                                (
-                                    episode_id,
-                                    chapter_number,
-                                    f"0{chapter['start_time'].split('.')[0]}",
-                                    f"0{chapter['end_time'].split('.')[0]}",
-                                ),
-                            )
-                            conn.commit()
-                            chapter_number += 1
-
-def process_movies():
-    """
-    Go through each movie video file and insert metadata into the dasebase
+    Returns:
+        data: Whatever fields returns
+
+    Example:
+        load_sidecar(f"{show_root_folder}/episodes.json", episode_fields)
+    """
+
+    stat = os.stat(json_file)
+    stamp = (sidecar_cache_version, fields.__name__, stat.st_mtime_ns, stat.st_size)
+    cache_file = os.path.join(sidecar_cache_dir, hashlib.sha256(f"{fields.__name__}:{json_file}".encode()).hexdigest())
+
+    try:
+        with open(cache_file, "rb") as file:
+            cached_stamp, data = pickle.load(file)
+        if cached_stamp == stamp:
+            return data
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        pass
+
+    with open(json_file, "r") as file:
+        data = fields(json.load(file))
+
+    try:
+        os.makedirs(sidecar_cache_dir, exist_ok=True)
+        tvdbfetch.write_bytes(cache_file, pickle.dumps((stamp, data), protocol=pickle.HIGHEST_PROTOCOL))
+    except OSError as e:
+        log.debug(f"Could not cache {json_file}: {e}")
+
+    return data
+
+def load_show_data(episode_json, series_extended_json):
+    """
+    Loads a show's episode index and tags, once per show
 
     Args:
-        None
+        episode_json (string): Location of the episode JSON file
+        series_extended_json (string): Location of the series extended JSON file
+
+    Returns:
+        episodes (dictionary): (season, number) to episode name and overview
+        tags (string): Show tags, 'tv' plus the show's genres
+    """
+
+    with show_data_lock:
+        if episode_json not in show_data:
+            log.debug("Loading Episode and Series Local JSON files")
+            episodes = load_sidecar(episode_json, episode_fields)
+
+            # Append tags from the show's genres
+            tags = ["tv"]
+            for tag in load_sidecar(series_extended_json, genre_fields):
+                tags.append(tag.lower())
+
+            show_data[episode_json] = (episodes, str(",".join(tags)))
+        return show_data[episode_json]
+
+def enrich_episode(job):
+    """ Enrich stage, matches an episode with its TVDB metadata and show tags """
+    episode = job["file"]
+    wait_for_metadata(job["episode_json"])
+    episodes, tags = load_show_data(job["episode_json"], job["series_extended_json"])
+
+    # Parse season and episode numbers
+    season_number = re.search("S(\d{2})", episode).group(1)
+    if season_number.startswith("0"):
+        season_number = season_number.lstrip("0")
+
+    episode_number = re.search("E(\d{2})", episode).group(1)
+    if episode_number.startswith("0"):
+        episode_number = episode_number.lstrip("0")
+
+    # Find episode metadata in the show's index
+    log.debug(f"Searching local files for season {season_number} episode {episode_number}")
+    episode_metadata = episodes.get((int(season_number or 0), int(episode_number or 0)))
+    if episode_metadata is None:
+        log.debug(f"Episode Metadata Error: no metadata for {episode}")
+        return None
+
+    job["metadata"] = episode_metadata
+    job["season"] = season_number
+    job["episode"] = episode_number
+    job["tags"] = tags
+    return job
+
+def write_episode(job):
+    """ Write stage, inserts an episode and its chapters into the database """
+    episode = job["file"]
+
+    # Insert episode into database
+    cursor.execute(
+        "INSERT INTO TV (Name, ShowName, Season, Episode, Overview, Tags, Runtime, Filepath) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            job["metadata"]["name"],
+            job["show_name"],
+            job["season"],
+            job["episode"],
+            job["metadata"]["overview"],
+            job["tags"],
+            job["runtime"],
+            episode
+        ),
+    )
+    episode_id = cursor.lastrowid
+    media_id = media.register_media(cursor, "TV", episode_id, episode)
+    store_keyframes(media_id, job["keyframes"])
+    record_hash(media_id, job)
+
+    if job["chapters"]:
+        for chapter_number, chapter in enumerate(job["chapters"]["chapters"], start=1):
+            log.debug(f"{chapter=}")
+            # Insert chapter into database
+            cursor.execute(
+                "INSERT INTO CHAPTERS (EpisodeID, Title, Start, End) VALUES (?, ?, ?, ?)",
+                (
+                    episode_id,
+                    chapter_number,
+                    f"0{chapter['start_time'].split('.')[0]}",
+                    f"0{chapter['end_time'].split('.')[0]}",
+                ),
+            )
+
+    conn.commit()
+    metrics.inc("solostation_ingest_items_total", kind="tv")
+    return job
+
+@metrics.timed("solostation_ingest_seconds", kind="tv")
+def process_tv(paths=None):
+    """
+    Go through each TV video file and insert metadata into the dasebase. Runs as
+    a pipeline: discover -> probe -> enrich -> write, so missing show metadata
+    downloads while episodes are being probed.
+
+    Args:
+        paths (set): Only look at these files, i.e. from a watch
 
     Returns:
         None
     """
 
     log.debug("")
-    log.debug("Searching and processing movies")
+    log.debug("Searching and processing TV episodes")
+
+    keyframes.initialize_keyframes_db(cursor)
+    load_content_index()
+    start_metadata_fetch(shows=missing_tv_metadata())
+    pipeline.run_pipeline(
+        "tv",
+        resolve_content("TV", discover_tv(get_known_files("TV"), paths)),
+        [
+            pipeline.Stage("probe", probe_episode, probe_workers),
+            pipeline.Stage("enrich", enrich_episode, enrich_workers),
+        ],
+        write_episode,
+        label=lambda job: job["file"],
+    )
+    apply_resolved()
+
+def discover_movies(known, paths=None):
+    """
+    Walks the movie folders for movies that aren't in the database yet
+
+    Args:
+        known (set): Files already in the MOVIE table
+        paths (set): Only look at these files, i.e. from a watch
+
+    Returns:
+        job (dictionary): One per new movie, passed along the ingest stages
+    """
 
     # Go through each movie folder
     for movie_folder in next(os.walk(movie_root))[1]:
         # Search for either a MP4 and MKV movie file with the movie root folder
         movie_root_folder = f"{movie_root}{movie_folder}"
         try:
-            movie_file = (glob.glob(f"{movie_root_folder}/*.mp4") + glob.glob(f"{movie_root_folder}/*.mkv"))[0]
+            movie_file = (find_files(f"{movie_root_folder}/*.mp4", paths) + find_files(f"{movie_root_folder}/*.mkv", paths))[0]
         except IndexError:
             continue
 
+        if movie_file in known:
+            continue
 
-        # Check and insert movie metadata into the database if it doesn't exist
-        if not check_if_in_table("MOVIE", movie_file):
-            # Parse movie name and year from filename
+        # Parse movie name from folder name
+        try:
             movie_name = re.search(".+?(?=\s\()", movie_folder)[0]
-            movie_year = re.search("\(([0-9]{4})\)", movie_folder)[1]
-            movie_name_no_spaces = movie_name.replace(" ", "")
-            movie_json = f"{movie_root_folder}/{movie_name_no_spaces}.json"
-            movie_art = f"{movie_root_folder}/{movie_name_no_spaces}.jpg"
-            movie_extended_json = f"{movie_root_folder}/{movie_name_no_spaces}-extended.json"
-            log.debug(f"{movie_name=}")
-            log.debug(f"{movie_year=}")
-            log.debug(f"{movie_name_no_spaces=}")
-            log.debug(f"{movie_json=}")
-            log.debug(f"{movie_extended_json=}")
-
-            # Download movie metadata json file if not available
-            if not os.path.exists(movie_json) or not os.path.exists(movie_extended_json):
-                download_movie_metadata(movie_name, movie_year, movie_json, movie_extended_json)
-
-            # Download movie art
-            if not os.path.exists(movie_art):
-                download_art(movie_name, movie_extended_json, movie_art)
-
-            # Open local json files
-            with open(movie_json) as file:
-                movie_metadata = json.load(file)
-
-            with open(movie_extended_json) as file:
-                movie_extended_metadata = json.load(file)
-
-            tags = ["movie"]
-            for tag in movie_extended_metadata["genres"]:
-                tags.append(tag["name"].lower())
-
-            # Insert movie into database
-            tags = str(",".join(tags))
-            log.debug(f"{movie_file=}")
-            runtime = get_runtime(movie_file)
-            cursor.execute(
-                "INSERT INTO MOVIE (Name, Year, Overview, Tags, Runtime, Filepath) VALUES (?, ?, ?, ?, ?, ?)", (movie_metadata['name'], movie_metadata['year'], movie_metadata['overview'], tags, runtime, movie_file)
-            )
+        except TypeError:
+            log.debug(f"Could not parse a movie name from {movie_folder}")
+            continue
+        movie_name_no_spaces = movie_name.replace(" ", "")
+        yield {
+            "file": movie_file,
+            "movie_json": f"{movie_root_folder}/{movie_name_no_spaces}.json",
+            "movie_extended_json": f"{movie_root_folder}/{movie_name_no_spaces}-extended.json",
+        }
+
+def probe_movie(job):
+    """ Probe stage, reads a movie's runtime and keyframes """
+    log.debug(f"movie_file={job['file']}")
+    job["runtime"] = get_runtime(job["file"])
+    job["keyframes"] = get_keyframes(job["file"])
+    return job
+
+def enrich_movie(job):
+    """ Enrich stage, reads a movie's TVDB metadata and genre tags """
+    wait_for_metadata(job["movie_json"])
+
+    # Read local json files
+    movie_metadata = load_sidecar(job["movie_json"], movie_fields)
+
+    tags = ["movie"]
+    for tag in load_sidecar(job["movie_extended_json"], genre_fields):
+        tags.append(tag.lower())
+
+    job["metadata"] = movie_metadata
+    job["tags"] = str(",".join(tags))
+    return job
+
+def write_movie(job):
+    """ Write stage, inserts a movie into the database """
+    movie_metadata = job["metadata"]
+    cursor.execute(
+        "INSERT INTO MOVIE (Name, Year, Overview, Tags, Runtime, Filepath) VALUES (?, ?, ?, ?, ?, ?)", (movie_metadata['name'], movie_metadata['year'], movie_metadata['overview'], job["tags"], job["runtime"], job["file"])
+    )
+    media_id = media.register_media(cursor, "MOVIE", cursor.lastrowid, job["file"])
+    store_keyframes(media_id, job["keyframes"])
+    record_hash(media_id, job)
+    conn.commit()
+    metrics.inc("solostation_ingest_items_total", kind="movies")
+    return job
+
+@metrics.timed("solostation_ingest_seconds", kind="movies")
+def process_movies(paths=None):
+    """
+    Go through each movie video file and insert metadata into the dasebase. Runs
+    as a pipeline: discover -> probe -> enrich -> write, so missing metadata and
+    art download while movies are being probed.
+
+    Args:
+        paths (set): Only look at these files, i.e. from a watch
+
+    Returns:
+        None
+    """
+
+    log.debug("")
+    log.debug("Searching and processing movies")
+
+    keyframes.initialize_keyframes_db(cursor)
+    load_content_index()
+    start_metadata_fetch(movies=missing_movie_metadata())
+    pipeline.run_pipeline(
+        "movies",
+        resolve_content("MOVIE", discover_movies(get_known_files("MOVIE"), paths)),
+        [
+            pipeline.Stage("probe", probe_movie, probe_workers),
+            pipeline.Stage("enrich", enrich_movie, enrich_workers),
+        ],
+        write_movie,
+        label=lambda job: job["file"],
+    )
+    apply_resolved()
+
+def get_unindexed():
+    """ Media ID and path of every library file that has no keyframe index yet, duplicates are left out """
+    kinds = ",".join("?" * len(media.media_tables))
+    cursor.execute(f"SELECT m.ID, m.Path FROM MEDIA m LEFT JOIN KEYFRAMES k ON k.MediaID = m.ID WHERE k.MediaID IS NULL AND m.Kind IN ({kinds})", media.media_tables)
+    return cursor.fetchall()
+
+def discover_unindexed(unindexed):
+    """
+    Skips files that are no longer on disk
+
+    Args:
+        unindexed (list): (Media ID, path) tuples, i.e. from get_unindexed()
+
+    Returns:
+        job (dictionary): One per file, passed along the ingest stages
+    """
+
+    for media_id, path in unindexed:
+        if os.path.exists(path):
+            yield {"file": path, "media_id": media_id}
+
+def probe_keyframes(job):
+    """ Probe stage, lists a file's keyframes """
+    job["keyframes"] = get_keyframes(job["file"])
+    return job if job["keyframes"] else None
+
+def write_keyframes(job):
+    """ Write stage, saves a file's keyframe index """
+    store_keyframes(job["media_id"], job["keyframes"])
+    conn.commit()
+    return job
+
+@metrics.timed("solostation_ingest_seconds", kind="keyframes")
+def process_keyframes():
+    """
+    Indexes the keyframes of every library file ingested before keyframe indexing existed
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    log.debug("")
+    log.debug("Indexing keyframes")
+
+    keyframes.initialize_keyframes_db(cursor)
+    media.sync_media(cursor)
+    conn.commit()
+    pipeline.run_pipeline(
+        "keyframes",
+        discover_unindexed(get_unindexed()),
+        [pipeline.Stage("probe", probe_keyframes, probe_workers)],
+        write_keyframes,
+        label=lambda job: job["file"],
+    )
+def get_unmeasured():
+    """ Media ID and path of every library file that has no loudness analysis yet, duplicates are left out """
+    kinds = ",".join("?" * len(media.media_tables))
+    cursor.execute(f"SELECT m.ID, m.Path FROM MEDIA m LEFT JOIN LOUDNESS l ON l.MediaID = m.ID WHERE l.MediaID IS NULL AND m.Kind IN ({kinds})", media.media_tables)
+    return cursor.fetchall()
+
+def measure_loudness(job):
+    """ Probe stage, runs the EBU R128 analysis of one file, None when it has no measurable audio """
+    job["loudness"] = loudness.analyze(job["file"])
+    if job["loudness"] is None:
+        log.debug(f"No measurable audio in {job['file']}, playing it without gain")
+    return job
+
+def write_loudness(job):
+    """ Write stage, saves a file's loudness and playback gain """
+    loudness.store_loudness(cursor, job["media_id"], job["loudness"])
+    conn.commit()
+    return job
+
+@metrics.timed("solostation_ingest_seconds", kind="loudness")
+def process_loudness():
+    """
+    Measures the loudness of every library file that hasn't been measured yet, so
+    the player can even out volume between items with a fixed gain. The analysis
+    decodes each file's audio, so it runs in LOUDNESS_WORKERS parallel workers.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    log.debug("")
+    log.debug("Measuring loudness")
+
+    loudness.initialize_loudness_db(cursor)
+    media.sync_media(cursor)
+    conn.commit()
+    pipeline.run_pipeline(
+        "loudness",
+        discover_unindexed(get_unmeasured()),
+        [pipeline.Stage("measure", measure_loudness, loudness_workers)],
+        write_loudness,
+        label=lambda job: job["file"],
+    )
+
+def add_detected_chapters(episode_id, candidates, runtime):
+    """ Writes the chapters chosen from an episode's break candidates, returns how many breaks it got """
+    points = breakpoints.choose_breaks(candidates, runtime)
+    if points:
+        breakpoints.write_chapters(cursor, episode_id, points, runtime)
+    conn.commit()
+    return len(points)
+
+@metrics.timed("solostation_ingest_seconds", kind="breaks")
+def process_breaks(media_ids=None):
+    """
+    Finds break points in TV episodes without embedded chapters, where the picture
+    goes black and the sound goes silent together, and writes them as chapters so
+    the scheduler can put commercials there. Files are hashed and scanned in a pool
+    of BREAK_WORKERS processes; scans are cached by partial hash, failed and empty
+    ones included, so renamed, copied or unscannable files aren't scanned again.
+
+    Args:
+        media_ids (set): Only look at these files, i.e. the ones a watch batch added
+
+    Returns:
+        None
+    """
+
+    log.debug("")
+    log.debug("Detecting chapter breaks")
+
+    if media_ids is not None and not media_ids:
+        return
+
+    breakpoints.initialize_breaks_db(cursor)
+    media.initialize_media_db(cursor)
+    cursor.execute("""
+        SELECT t.ID, t.Filepath, t.Runtime, m.ID, m.Hash FROM TV t
+        LEFT JOIN MEDIA m ON m.Path = t.Filepath
+        WHERE NOT EXISTS (SELECT 1 FROM CHAPTERS c WHERE c.EpisodeID = t.ID)
+    """)
+    episodes = [
+        (episode_id, path, runtime, digest)
+        for episode_id, path, runtime, media_id, digest in cursor.fetchall()
+        if (media_ids is None or media_id in media_ids) and os.path.exists(path)
+    ]
+    log.info(f"{len(episodes)} episodes without chapters")
+
+    scanned = cached = broken = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=break_workers) as pool:
+        # Reuse the content hashes taken at ingest, hash only the files without one
+        digests = {path: digest for _, path, _, digest in episodes if digest}
+        unhashed = [path for _, path, _, digest in episodes if not digest]
+        digests.update(zip(unhashed, pool.map(contenthash.partial_hash, unhashed, chunksize=8)))
+
+        futures = {}
+        for episode_id, path, runtime, _ in episodes:
+            candidates = breakpoints.load_candidates(cursor, digests[path])
+            if candidates is None:
+                futures[pool.submit(breakpoints.analyze_file, path)] = (episode_id, path, runtime)
+                continue
+            cached += 1
+            broken += add_detected_chapters(episode_id, candidates, keyframes.hms_to_seconds(runtime)) > 0
+
+        for future in as_completed(futures):
+            episode_id, path, runtime = futures[future]
+            try:
+                path, candidates, seconds = future.result()
+            except Exception as e:
+                log.debug(f"Could not detect breaks in {path}: {e}")
+                breakpoints.store_candidates(cursor, digests[path], [], error=str(e))
+                conn.commit()
+                continue
+            breakpoints.store_candidates(cursor, digests[path], candidates)
+            broken += add_detected_chapters(episode_id, candidates, keyframes.hms_to_seconds(runtime)) > 0
+            scanned += 1
+            metrics.observe("solostation_probe_seconds", seconds, probe="breaks")
+            log.debug(f"Found {len(candidates)} break candidates in {path} in {seconds:.1f}s")
+            if scanned % 10 == 0:
+                log.info(f"Scanned {scanned} of {len(futures)} episodes for breaks, {scanned / (time.perf_counter() - start):.2f}/s")
+
+    log.info(f"Scanned {scanned} episodes and reused {cached} cached scans, {broken} episodes got chapters")
+
+def get_hash_jobs():
+    """ Every library file with its recorded hash, size and mtime """
+    media.initialize_media_db(cursor)
+    cursor.execute(f"SELECT ID, Path, Hash, Size, Mtime FROM MEDIA WHERE Kind IN ({','.join('?' * len(media.media_tables))})", media.media_tables)
+    return [
+        {"media_id": media_id, "file": path, "hash": digest, "size": size, "mtime": mtime}
+        for media_id, path, digest, size, mtime in cursor.fetchall()
+        if os.path.exists(path)
+    ]
+
+def hash_file(job):
+    """ Hash stage, rehashes a file unless its size and mtime are unchanged """
+    stat = os.stat(job["file"])
+    if job["hash"] and job["size"] == stat.st_size and job["mtime"] == stat.st_mtime:
+        return None
+    job["hash"], job["size"], job["mtime"] = contenthash.stat_file(job["file"])
+    return job
+
+def write_hash(job):
+    """ Write stage, stores a file's content hash """
+    record_hash(job["media_id"], job)
+    conn.commit()
+    return job
+
+def collapse_duplicates():
+    """
+    Folds library entries with identical content into one. The entry added first
+    stays and takes the latest LastPlayed of the group; the others leave the
+    library table and are kept in the Media table as duplicates of it.
+
+    Args:
+        None
+
+    Returns:
+        collapsed (integer): Library entries removed
+    """
+
+    collapsed = 0
+    for digest, entries in media.get_media_hashes(cursor).items():
+        for kind in {entry[1] for entry in entries}:
+            group = sorted(entry for entry in entries if entry[1] == kind and os.path.exists(entry[3]) and os.path.getsize(entry[3]))
+            if len(group) < 2:
+                continue
+
+            keeper_id, _, keeper_item, keeper_path = group[0]
+            keeper_full = contenthash.full_hash(keeper_path) if verify_duplicates else None
+
+            cursor.execute(f"PRAGMA table_info({kind})")
+            has_last_played = "LastPlayed" in [column[1] for column in cursor.fetchall()]
+
+            for media_id, _, item_id, path in group[1:]:
+                if verify_duplicates and contenthash.full_hash(path) != keeper_full:
+                    continue
+                if has_last_played:
+                    cursor.execute(
+                        f"UPDATE {kind} SET LastPlayed = (SELECT MAX(LastPlayed) FROM {kind} WHERE ID IN (?, ?)) WHERE ID = ?",
+                        (keeper_item, item_id, keeper_item),
+                    )
+                if kind == "TV":
+                    cursor.execute("DELETE FROM CHAPTERS WHERE EpisodeID = ?", (item_id,))
+                cursor.execute(f"DELETE FROM {kind} WHERE ID = ?", (item_id,))
+                media.register_duplicate(cursor, keeper_id, path)
+                log.info(f"{path} is a duplicate of {keeper_path}, removed from the library")
+                metrics.inc("solostation_content_matches_total", result="collapsed")
+                collapsed += 1
             conn.commit()
 
+    return collapsed
+
+@metrics.timed("solostation_ingest_seconds", kind="hashes")
+def process_hashes():
+    """
+    Hashes every library file that is new or changed since it was last hashed,
+    then collapses duplicates
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    log.debug("")
+    log.debug("Hashing library content")
+
+    pipeline.run_pipeline(
+        "hashes",
+        iter(get_hash_jobs()),
+        [pipeline.Stage("hash", hash_file, probe_workers)],
+        write_hash,
+        label=lambda job: job["file"],
+    )
+    log.info(f"Collapsed {collapse_duplicates()} duplicate library entries")
+
+def process_conform():
+    """
+    Queues every library file the Pi can't decode in hardware, then remuxes or
+    transcodes them in a background thread, see conform.py
+
+    Args:
+        None
 
-# initialize_all_tables()
-# process_commercials()
-# process_web()
-# process_music()
-# process_movies()
-# process_tv()
\ No newline at end of file
+    Returns:
+        thread (threading.Thread): Runs the queue, join it to wait for the jobs
+    """
+
+    log.debug("")
+    log.debug("Checking media conformance")
+
+    conform.scan()
+    thread = threading.Thread(target=conform.run_queue, name="conform")
+    thread.start()
+    return thread
+
+def ingest_paths(paths=None):
+    """
+    Adds new files to the library through the process functions of the folders
+    they are in, then measures loudness, looks for breaks in new episodes and
+    tells the scheduler the catalog changed. Watch batches only touch their own
+    files; a failing folder is logged so the others still get ingested.
+
+    Args:
+        paths (set): New or changed files, None to scan every folder
+
+    Returns:
+        None
+
+    Example:
+        ingest_paths({"/media/ascott/USB/web/Muppets.mp4"})
+    """
+
+    changes = conn.total_changes
+    scans = [
+        (tv_root, process_tv),
+        (movie_root, process_movies),
+        (music_root, process_music),
+        (comm_root, process_commercials),
+        (web_root, process_web),
+    ]
+    for root, process in scans:
+        if not root:
+            continue
+        if paths is None:
+            touched = None
+        else:
+            touched = {path for path in paths if path.startswith(os.path.join(root, ""))}
+            if not touched:
+                continue
+            log.info(f"Ingesting {len(touched)} new files from {root}")
+        try:
+            process(touched)
+        except Exception as e:
+            log.error(f"Could not ingest from {root}: {e}")
+
+    if conn.total_changes == changes:
+        return
+
+    try:
+        process_loudness()
+    except Exception as e:
+        log.error(f"process_loudness failed: {e}")
+
+    # Only the files this batch added need scanning for breaks
+    try:
+        process_breaks(None if paths is None else get_media_ids(paths))
+    except Exception as e:
+        log.error(f"process_breaks failed: {e}")
+
+    media.mark_catalog_changed(cursor)
+    conn.commit()
+    log.info("Library changed, the scheduler will reload its catalog")
+
+def get_media_ids(paths):
+    """ Media IDs of the given files, skipping files that aren't in the Media table """
+    media_ids = set()
+    for path in paths:
+        cursor.execute("SELECT ID FROM MEDIA WHERE Path = ?", (path,))
+        result = cursor.fetchone()
+        if result:
+            media_ids.add(result[0])
+    return media_ids
+
+def watch_library():
+    """
+    Scans every media folder, then keeps running and ingests files as they are
+    copied or moved into them, see watcher.watch()
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    log.info("Watching the media folders for new files")
+    watcher.watch([tv_root, movie_root, music_root, comm_root, web_root], ingest_paths, on_start=ingest_paths)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add media to the SoloStation library")
+    parser.add_argument("--watch", action="store_true", help="Keep running after the scan and ingest new files as they appear")
+    parser.add_argument("--hashes", action="store_true", help="Also hash the whole library and collapse duplicates")
+    parser.add_argument("--keyframes", action="store_true", help="Also index keyframes of files that have none")
+    parser.add_argument("--conform", action="store_true", help="Also remux or transcode files the Pi can't decode")
+    args = parser.parse_args()
+
+    initialize_all_tables()
+    if args.hashes:
+        process_hashes()
+    if args.keyframes:
+        process_keyframes()
+
+    if args.watch:
+        if args.conform:
+            process_conform()
+        try:
+            watch_library()
+        except KeyboardInterrupt:
+            log.info("Stopped watching")
+    else:
+        ingest_paths()
+        if args.conform:
+            process_conform().join()
\ No newline at end of file
@@ -0,0 +1,187 @@
+# Metrics
+import functools
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+log = logging.getLogger("rich")
+
+# Variables
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+metrics_lock = threading.Lock()
+metric_info = {}
+metric_values = {}
+
+# Functions
+def describe(name, kind, help_text, buckets=default_buckets):
+    """
+    Registers a metric so it is exposed with its HELP and TYPE lines
+
+    Args:
+        name (string): Metric name, i.e. 'solostation_tune_seconds'
+        kind (string): 'counter', 'gauge' or 'histogram'
+        help_text (string): Description of the metric
+        buckets (tuple): Histogram bucket upper bounds in seconds
+
+    Returns:
+        None
+
+    Example:
+        describe("solostation_seek_errors_total", "counter", "Failed seeks on tune-in")
+    """
+
+    with metrics_lock:
+        metric_info[name] = {"kind": kind, "help": help_text, "buckets": buckets}
+
+def label_key(labels):
+    """ Sorted label pairs, used as part of the key for a series """
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def inc(name, value=1, **labels):
+    """ Increments a counter series """
+    key = (name, label_key(labels))
+    with metrics_lock:
+        metric_values[key] = metric_values.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    """ Sets a gauge series to value """
+    with metrics_lock:
+        metric_values[(name, label_key(labels))] = value
+
+def observe(name, value, **labels):
+    """ Records a single observation into a histogram series """
+    key = (name, label_key(labels))
+    buckets = metric_info.get(name, {}).get("buckets", default_buckets)
+    with metrics_lock:
+        series = metric_values.get(key)
+        if series is None:
+            series = metric_values[key] = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series["buckets"][i] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Times the wrapped block into a histogram
+
+    Example:
+        with metrics.timer("solostation_db_query_seconds", query="get_media_metadata"):
+            cursor.execute(query)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def timed(name, **labels):
+    """
+    Decorator that times every call of the wrapped function into a histogram
+
+    Example:
+        @metrics.timed("solostation_ingest_seconds", kind="tv")
+        def process_tv():
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def format_labels(labels, extra=()):
+    """ Formats label pairs as {a="1",b="2"} """
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+def render():
+    """
+    Renders every series in the Prometheus text exposition format
+
+    Returns:
+        output (string): Text exposition of all metrics
+    """
+
+    lines = []
+    with metrics_lock:
+        names = sorted({name for name, labels in metric_values} | set(metric_info))
+        for name in names:
+            info = metric_info.get(name, {"kind": "untyped", "help": "", "buckets": default_buckets})
+            lines.append(f"# HELP {name} {info['help']}")
+            lines.append(f"# TYPE {name} {info['kind']}")
+            for (series_name, labels), value in sorted(metric_values.items(), key=lambda kv: kv[0]):
+                if series_name != name:
+                    continue
+                if isinstance(value, dict):
+                    for bound, count in zip(info["buckets"], value["buckets"]):
+                        lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {value['count']}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {value['sum']}")
+                    lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+                else:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+
+    return "\n".join(lines) + "\n"
+
+def start_metrics_server(port):
+    """
+    Serves /metrics from a daemon thread
+
+    Args:
+        port (int): Port to listen on
+
+    Returns:
+        server (ThreadingHTTPServer): Running server
+
+    Example:
+        start_metrics_server(9101)
+    """
+
+    # Only processes that serve metrics pay for importing the HTTP server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """ Serves render() on /metrics """
+
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+    log.info(f"Serving metrics on port {port}")
+    return server
+
+# Shared metric definitions
+describe("solostation_schedule_build_seconds", "histogram", "Time to build the schedule for one channel", (1, 2.5, 5, 10, 15, 30, 60, 120, 300))
+describe("solostation_db_query_seconds", "histogram", "Database query latency")
+describe("solostation_tune_seconds", "histogram", "Time from loading an item to playback at the scheduled position")
+describe("solostation_transitions_total", "counter", "Scheduled items started by the player")
+describe("solostation_seek_errors_total", "counter", "Failed seeks on tune-in")
+describe("solostation_stalls_total", "counter", "Playback stopped before the scheduled end")
+describe("solostation_playback_drift_seconds", "histogram", "Distance between mpv's position and the schedule clock", (0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 30, 60))
+describe("solostation_resyncs_total", "counter", "Re-seeks or skips made to correct playback drift")
+describe("solostation_ingest_seconds", "histogram", "Time for one library scan", (1, 5, 15, 60, 300, 900, 3600))
+describe("solostation_probe_seconds", "histogram", "Time to probe one media file")
+describe("solostation_ingest_items_total", "counter", "Media items added to the library")
+describe("solostation_content_matches_total", "counter", "Files recognised by content hash as moved or duplicated")
+describe("solostation_update_data_seconds", "histogram", "Time to rebuild the dashboard now playing state")
+describe("solostation_dashboard_clients", "gauge", "Connected dashboard clients")
@@ -0,0 +1,184 @@
+# Pipeline
+import os
+import queue
+import threading
+import time
+import logging
+import metrics
+
+log = logging.getLogger("rich")
+
+# Variables
+queue_size = int(os.getenv("INGEST_QUEUE_SIZE", 32))
+report_interval = float(os.getenv("INGEST_REPORT_INTERVAL", 10))
+
+# Put on a queue after the last item of a stage
+done = object()
+
+# Functions
+class Stage:
+    """
+    One step of a pipeline. Its workers take items from the stage's bounded input
+    queue, pass each one to function and hand the result to the next stage.
+    function returns the item for the next stage, or None to drop it.
+    """
+
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.input = queue.Queue(maxsize=queue_size)
+        self.running = workers
+        self.items = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def record(self, seconds, result=None, error=False):
+        """ Counts one processed item """
+        with self.lock:
+            self.busy += seconds
+            if error:
+                self.errors += 1
+            elif result is None:
+                self.dropped += 1
+            else:
+                self.items += 1
+
+    def elapsed(self):
+        """ Seconds since the stage took its first item, up to when it finished """
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    def throughput(self):
+        """ Items passed on per second of the stage's run time """
+        return self.items / max(self.elapsed(), 1e-9)
+
+    def utilization(self):
+        """ Share of the workers' time spent inside function, near 1 means the stage is the bottleneck """
+        return self.busy / max(self.elapsed() * self.workers, 1e-9)
+
+def run_worker(pipeline, stage, output, label):
+    """ Runs one of a stage's workers until the stage's input is done """
+    while True:
+        item = stage.input.get()
+        if item is done:
+            # Let the other workers see it too, the last one out closes the next stage
+            stage.input.put(done)
+            break
+
+        if stage.started is None:
+            stage.started = time.perf_counter()
+
+        start = time.perf_counter()
+        try:
+            result = stage.function(item)
+            seconds = time.perf_counter() - start
+            stage.record(seconds, result)
+        except Exception as e:
+            result = None
+            seconds = time.perf_counter() - start
+            stage.record(seconds, error=True)
+            log.debug(f"{pipeline} {stage.name}: could not process {label(item)}")
+            log.debug(e)
+        metrics.observe("solostation_ingest_stage_seconds", seconds, pipeline=pipeline, stage=stage.name)
+
+        if result is not None and output is not None:
+            output.put(result)
+
+    with stage.lock:
+        stage.running -= 1
+        last = stage.running == 0
+    if last:
+        stage.finished = time.perf_counter()
+        if output is not None:
+            output.put(done)
+
+def run_source(pipeline, stage, source, output, label):
+    """ Feeds every item from the source generator to the first stage """
+    stage.started = time.perf_counter()
+    iterator = iter(source)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        except Exception as e:
+            stage.record(time.perf_counter() - start, error=True)
+            log.error(f"{pipeline} {stage.name} stopped: {e}")
+            break
+        stage.record(time.perf_counter() - start, item)
+        output.put(item)
+
+    stage.running = 0
+    stage.finished = time.perf_counter()
+    output.put(done)
+
+def format_stage(stage):
+    """ One stage's progress, i.e. 'probe 40 ok 2 dropped 0 errors 3.1/s 87% busy' """
+    return (
+        f"{stage.name} {stage.items} ok {stage.dropped} dropped {stage.errors} errors "
+        f"{stage.throughput():.1f}/s {stage.utilization():.0%} busy"
+    )
+
+def report(pipeline, stages, stop):
+    """ Logs every stage's progress each INGEST_REPORT_INTERVAL seconds until stop is set """
+    while not stop.wait(report_interval):
+        log.info(f"{pipeline} ingest: " + " | ".join(f"{format_stage(stage)} {stage.input.qsize()} queued" for stage in stages))
+        for stage in stages:
+            metrics.set_gauge("solostation_ingest_queue_depth", stage.input.qsize(), pipeline=pipeline, stage=stage.name)
+
+def run_pipeline(pipeline, source, stages, sink, label=str):
+    """
+    Runs a staged producer/consumer pipeline. The source and each stage run in
+    their own threads with a bounded queue in front of every stage, so a slow
+    stage only holds up the items behind it and the queues cap memory use. The
+    sink runs in the calling thread, so it can use the caller's database connection.
+
+    Args:
+        pipeline (string): Name used in logs and metrics, i.e. 'tv'
+        source (iterable): Generator of items, run as the 'discover' stage
+        stages (list): Stage objects, in order
+        sink (function): Called with every item that makes it through, run as the 'write' stage
+        label (function): Describes an item in error logs
+
+    Returns:
+        stages (list): Every stage, source and sink included, with their counts and timings
+
+    Example:
+        run_pipeline("tv", discover_tv(known), [Stage("probe", probe_episode, 4)], write_episode)
+    """
+
+    discover = Stage("discover", None)
+    write = Stage("write", sink)
+    all_stages = [discover] + list(stages) + [write]
+
+    threads = [threading.Thread(target=run_source, args=(pipeline, discover, source, all_stages[1].input, label), daemon=True)]
+    for stage, next_stage in zip(all_stages[1:-1], all_stages[2:]):
+        for _ in range(stage.workers):
+            threads.append(threading.Thread(target=run_worker, args=(pipeline, stage, next_stage.input, label), daemon=True))
+
+    stop = threading.Event()
+    threads.append(threading.Thread(target=report, args=(pipeline, all_stages, stop), daemon=True))
+
+    for thread in threads:
+        thread.start()
+    try:
+        run_worker(pipeline, write, None, label)
+    finally:
+        stop.set()
+
+    for stage in all_stages:
+        metrics.inc("solostation_ingest_stage_items_total", stage.items, pipeline=pipeline, stage=stage.name)
+        log.info(f"{pipeline} ingest {format_stage(stage)} over {stage.elapsed():.1f}s with {stage.workers} workers")
+
+    return all_stages
+
+metrics.describe("solostation_ingest_stage_seconds", "histogram", "Time for one ingest stage to process one item")
+metrics.describe("solostation_ingest_stage_items_total", "counter", "Items passed on by each ingest stage")
+metrics.describe("solostation_ingest_queue_depth", "gauge", "Items waiting in front of each ingest stage")
@@ -1,5 +1,10 @@
 # import mediamanager
-import schedule
+# schedule, and numpy with it, is imported by schedule_worker() once playback has started
+import schedulestore
+import keyframes
+import loudness
+import metrics
+import heartbeat
 import logging
 from datetime import datetime, timedelta
 import time
@@ -9,13 +14,9 @@ import mpv
 import re
 import json
 import threading
-from PIL import Image, ImageDraw, ImageFont
+import tempfile
 from dotenv import load_dotenv
-from rich.console import Console
-from rich.table import Table
 from rich.logging import RichHandler
-from rich.text import Text
-from rich.progress import Progress
 
 # Load env file
 load_dotenv()
@@ -59,118 +60,257 @@ player.demuxer_lavf_o = "buffer=32768"
 solo_db = os.getenv("DB_LOCATION")
 channel_file = os.getenv("CHANNEL_FILE")
 settings_file = os.getenv("SETTINGS_FILE")
+drift_sample_interval = float(os.getenv("DRIFT_SAMPLE_INTERVAL", 5))
+drift_threshold = float(os.getenv("DRIFT_THRESHOLD", 3))
+keyframe_seek_tolerance = float(os.getenv("KEYFRAME_SEEK_TOLERANCE", 1.5))
+schedule_check_interval = float(os.getenv("SCHEDULE_CHECK_INTERVAL", 60))
+schedule_worker_mode = os.getenv("SCHEDULE_WORKER", "thread").lower()
+schedule_requested = threading.Event()
+schedule_updated = threading.Event()
+state_save_interval = float(os.getenv("STATE_SAVE_INTERVAL", 10))
+state_debounce = float(os.getenv("STATE_DEBOUNCE", 1))
+state_timeline = timedelta(minutes=float(os.getenv("STATE_TIMELINE_MINUTES", 90)))
+state_changed = threading.Event()
 
 # Functions
 def import_schedule():
     '''
-    Queries the schedule in the database for all items.
-    All results are converted to a dictionary and returned in a list.
+    Loads every item in the schedule into a compact ScheduleStore
 
     Args:
 
     Returns:  
-        all_scheduled_items (list of dictionaries) - Each scheduled item
+        live_schedule (ScheduleStore) - Each scheduled item, looked up by channel and time
         
     Raises:
     Example:
+        playing_now = import_schedule().playing_now(2, datetime.now())
     '''
 
     log.info("Calling import schedule")
+    try:
+        return schedulestore.load_schedule(solo_db)
+    except sqlite3.OperationalError as e:
+        # First boot, the schedule worker hasn't created the tables yet
+        log.warning(f"No schedule to load yet: {e}")
+        return schedulestore.ScheduleStore()
 
-    # Open Database
-    conn = sqlite3.connect(solo_db)
-    cursor = conn.cursor()
+def schedule_worker():
+    '''
+    Builds, or extends, the schedule off the playback thread so the player can
+    tune in from the existing schedule straight away. Checks every
+    SCHEDULE_CHECK_INTERVAL seconds, or sooner when schedule_requested is set,
+    and sets schedule_updated whenever the schedule table changed.
 
-    # Query schedule in database for given channel number 
-    now = datetime.strftime(datetime.now(), "%Y-%m-%d %HH:%MM:%SS")
-    cursor.execute(f"SELECT * FROM SCHEDULE ORDER BY Showtime ASC")
+    Args:
 
-    # Convert query results to a list of dictionaries
-    all_scheduled_items = [{
-            "channel": row[1],
-            "showtime": datetime.strptime(str(row[2]), "%Y-%m-%d %H:%M:%S"),
-            "end": datetime.strptime(str(row[3]), "%Y-%m-%d %H:%M:%S"),
-            "filepath": row[4],
-            "chapter": row[5],
-            "runtime": row[6]
-    } for row in cursor.fetchall()]
+    Returns:  
+        None
+    '''
 
-    conn.close()
+    import schedule
 
-    return all_scheduled_items
+    schedule.run_worker(schedule_check_interval, on_update=schedule_updated.set, wake=schedule_requested)
 
-# def import_schedule(channel_number):
-#     '''
-#     Queries the schedule in the database for all items with given channel number.
-#     All results are converted to a dictionary and returned in a list.
+def schedule_watcher():
+    '''
+    Used instead of schedule_worker() when a separate scheduler process owns the
+    schedule (SCHEDULE_WORKER=external). Sets schedule_updated when the schedule
+    table has rows the loaded schedule doesn't.
 
-#     Args:
-#         channel_number (int) - Channel number
+    Args:
 
-#     Returns:  
-#         all_scheduled_items (list of dictionaries) - Each scheduled item
-        
-#     Raises:
-#     Example:
-#     '''
+    Returns:  
+        None
+    '''
+
+    while True:
+        if schedule_requested.wait(schedule_check_interval):
+            schedule_requested.clear()
+        try:
+            if schedulestore.get_schedule_version(solo_db) != live_schedule.version():
+                schedule_updated.set()
+        except sqlite3.Error as e:
+            log.debug(f"Schedule watcher error: {e}")
+
+def get_keyframes(media_id):
+    '''
+    Reads the keyframe index of a scheduled file
+
+    Args:
+        media_id (int) - Media ID of the scheduled item
+
+    Returns:
+        times (array) - Keyframe times in milliseconds
+        OR
+        None (if the file hasn't been indexed)
+    '''
+
+    conn2 = sqlite3.connect(solo_db)
+    times = keyframes.load_keyframes(conn2.cursor(), media_id)
+    conn2.close()
+
+    return times
+
+def get_gain(media_id):
+    '''
+    Reads the loudness gain of a scheduled file
+
+    Args:
+        media_id (int) - Media ID of the scheduled item
+
+    Returns:
+        gain (float) - dB that brings the file to the loudness target, 0 if it hasn't been measured
+    '''
+
+    conn2 = sqlite3.connect(solo_db)
+    gain = loudness.load_gain(conn2.cursor(), media_id)
+    conn2.close()
 
-#     # Open Database
-#     conn = sqlite3.connect(solo_db)
-#     cursor = conn.cursor()
+    return gain
 
-#     # Query schedule in database for given channel number 
-#     now = datetime.strftime(datetime.now(), "%Y-%m-%d %HH:%MM:%SS")
-#     cursor.execute(f"SELECT * FROM SCHEDULE WHERE Channel = '{channel_number}' ORDER BY Showtime ASC")
+def set_gain(gain):
+    '''
+    Applies a static gain in mpv's mixer, which costs nothing like a normalization filter would
 
-#     # Convert query results to a list of dictionaries
-#     all_scheduled_items = [{
-#             "channel": row[1],
-#             "showtime": datetime.strptime(str(row[2]), "%Y-%m-%d %H:%M:%S"),
-#             "end": datetime.strptime(str(row[3]), "%Y-%m-%d %H:%M:%S"),
-#             "filepath": row[4],
-#             "chapter": row[5],
-#             "runtime": row[6]
-#     } for row in cursor.fetchall()]
+    Args:
+        gain (float) - dB to add
 
-#     conn.close()
+    Returns:
+        None
+    '''
 
-#     return all_scheduled_items
+    try:
+        player.volume_gain = gain
+    except Exception:
+        # mpv before 0.36 has no volume-gain, scale the volume instead
+        player.volume = min(player.volume_max, 100 * 10 ** (gain / 20))
 
-def get_chapter_start_time(filepath, chapter_number):
+def get_chapter_offset(filepath, chapter_number, times):
     '''
-    Queries the schedule in the database for the start time of what is currently
-    playing
+    Finds where a chapter starts in the file, on the same keyframe the
+    scheduler aligned its break to
 
     Args:
         filepath (str) - Filepath of episode
-        channel_number (int) - Channel number
+        chapter_number (int) - Chapter number
+        times (array) - Keyframe times in milliseconds, None if unknown
 
-    Returns:  
-        chapter_start (str) - Start time of chapter
-        
-    Raises:
-    Example:
+    Returns:
+        chapter_offset (float) - Seconds into the file where the chapter starts
     '''
 
     conn2 = sqlite3.connect(solo_db)
     cursor2 = conn2.cursor()
 
     # Get episode ID
-    query = f"SELECT ID FROM TV WHERE Filepath = '{filepath}'"
-    cursor2.execute(query)
-    result = cursor2.fetchone()
-    episode_id = result[0]
-    # log.info(f"{episode_id=}")
-
-    # Get time after start of current chapter from the database
-    query = f"SELECT Start FROM CHAPTERS WHERE EpisodeID = {episode_id} AND Title = {chapter_number}"
-    cursor2.execute(query)
-    chapter_start = cursor2.fetchone()[0]
-    # log.debug(f"{chapter_start=}")
+    cursor2.execute("SELECT ID FROM TV WHERE Filepath = ?", (filepath,))
+    episode_id = cursor2.fetchone()[0]
+
+    # Get every chapter, alignment depends on the first and last
+    cursor2.execute("SELECT Title, Start, End FROM CHAPTERS WHERE EpisodeID = ?", (episode_id,))
+    chapters = cursor2.fetchall()
 
     conn2.close()
 
-    return chapter_start
+    return [start for title, start, end in keyframes.align_chapters(chapters, times) if int(title) == int(chapter_number)][0]
+
+def seek_to(position, times):
+    '''
+    Seeks to position. Lands on a keyframe instead when one is within
+    KEYFRAME_SEEK_TOLERANCE seconds, so mpv doesn't decode from the previous
+    keyframe up to position.
+
+    Args:
+        position (float) - Seconds into the file
+        times (array) - Keyframe times in milliseconds, None if unknown
+
+    Returns:
+        position (float) - Where playback was sent
+    '''
+
+    keyframe = keyframes.nearest_keyframe(times, position, keyframe_seek_tolerance)
+    if keyframe is None:
+        player.seek(position, reference="absolute")
+        return position
+
+    player.seek(keyframe, reference="absolute", precision="keyframes")
+    return keyframe
+
+def get_expected_position(playing_now, chapter_offset):
+    '''
+    Where playback should be right now according to the schedule clock
+
+    Args:
+        playing_now (dictionary) - Scheduled item that is playing
+        chapter_offset (float) - Seconds into the file where the scheduled chapter starts
+
+    Returns:  
+        expected_position (float) - Seconds into the file
+    '''
+
+    return (datetime.now() - playing_now["showtime"]).total_seconds() + chapter_offset
+
+def check_drift(playing_now, chapter_offset):
+    '''
+    Samples mpv's playback position against the schedule clock, records the drift and
+    re-seeks when it is past the threshold (decoder stalls, slow reads, pauses)
+
+    Args:
+        playing_now (dictionary) - Scheduled item that is playing
+        chapter_offset (float) - Seconds into the file where the scheduled chapter starts
+
+    Returns:  
+        (bool) - False if the scheduled position is already past the end of the file
+        and the rest of the slot should be waited out
+    '''
+
+    time_pos = player.time_pos
+    if time_pos is None:
+        return True
+
+    expected_position = get_expected_position(playing_now, chapter_offset)
+    drift = time_pos - expected_position
+    metrics.observe("solostation_playback_drift_seconds", abs(drift), channel=current_channel)
+
+    if abs(drift) <= drift_threshold:
+        return True
+
+    log.warning(f"Playback drifted {drift:+.1f}s from the schedule on channel {current_channel}")
+    if player.duration is not None and expected_position >= player.duration:
+        metrics.inc("solostation_resyncs_total", channel=current_channel, action="skip")
+        return False
+
+    try:
+        seek_to(expected_position, playing_keyframes)
+        metrics.inc("solostation_resyncs_total", channel=current_channel, action="seek")
+    except Exception as e:
+        log.debug(f"Resync Seek Error: {e}")
+        metrics.inc("solostation_seek_errors_total", channel=current_channel)
+    if player.pause:
+        player.pause = False
+    return True
+
+def wait_out_slot(playing_now):
+    '''
+    Stops the player and waits until the item's scheduled end, for files that
+    end before their slot does. Returns early on a channel change.
+
+    Args:
+        playing_now (dictionary) - Scheduled item whose file has ended
+
+    Returns:  
+        None
+    '''
+
+    log.info(f"Nothing left to play on channel {current_channel} until {playing_now['end']}")
+    try:
+        player.command("stop")
+    except Exception as e:
+        log.debug(f"Stop Error: {e}")
+    while datetime.now() < playing_now["end"] and not channel_changed:
+        heartbeat.beat("player", status=f"channel {current_channel}")
+        time.sleep(0.1)
 
 def get_music_info(filepath):
     conn = sqlite3.connect(os.getenv("DB_LOCATION"))
@@ -206,24 +346,130 @@ def update_osd_text(player, text, font_name="Arial"):
 def clear_osd_text():
     player.command("osd-overlay", 0, "none", "")
 
-def load_last_channel(default_channel=2):
+def load_state():
+    '''
+    Reads the player state snapshot from SETTINGS_FILE
+
+    Args:
+
+    Returns:  
+        state (dictionary) - Snapshot written by save_state(), empty if there is none
+    '''
+
     try:
         if os.path.exists(settings_file):
             with open(settings_file, "r") as f:
-                data = json.load(f)
-                return data.get("last_channel", default_channel)
-        return default_channel
+                return json.load(f)
     except Exception as e:
-        log.error(f"Failed to load last channel: {e}")
-        return default_channel
+        log.error(f"Failed to load player state: {e}")
+    return {}
+
+def load_last_channel(state, default_channel=2):
+    return state.get("last_channel", default_channel)
+
+def save_state():
+    '''
+    Atomically writes a snapshot of the player to SETTINGS_FILE: the channel, the
+    schedule row playing and its resolved chapter offset, and the next
+    STATE_TIMELINE_MINUTES of every channel so a restart can tune in without
+    touching the database
+
+    Args:
+
+    Returns:  
+        None
+    '''
 
-def save_last_channel(channel):
+    now = datetime.now()
+    item = playing_now
+    timeline = {
+        str(channel): live_schedule.rows(channel, now, now + state_timeline)
+        for channel in live_schedule.channel_ranges
+    }
+    state = {
+        "last_channel": current_channel,
+        "saved": time.time(),
+        "row_id": item.row_id if item is not None else None,
+        "chapter_offset": chapter_offset,
+        "timeline": timeline,
+    }
+
+    # Write next to the settings file and swap it in, a crash never leaves half a file
+    settings_dir = os.path.dirname(os.path.abspath(settings_file))
+    f = tempfile.NamedTemporaryFile("w", dir=settings_dir, prefix=".state-", delete=False)
     try:
-        with open(settings_file, "w") as f:
-            json.dump({"last_channel": channel}, f)
-        log.debug(f"Saved last channel: {channel}")
-    except Exception as e:
-        log.error(f"Failed to save last channel: {e}")
+        with f:
+            json.dump(state, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f.name, settings_file)
+    except Exception:
+        os.remove(f.name)
+        raise
+    log.debug(f"Saved player state for channel {current_channel}")
+
+def state_key():
+    '''
+    What the state snapshot depends on: the channel, the schedule row playing,
+    its chapter offset and the loaded schedule
+
+    Args:
+
+    Returns:  
+        key (tuple) - Compare with the key of the last snapshot written
+    '''
+
+    item = playing_now
+    return (current_channel, item.row_id if item is not None else None, chapter_offset, live_schedule.version())
+
+def state_writer():
+    '''
+    Checks the player state every STATE_SAVE_INTERVAL seconds, and after channel
+    changes once the keys have been quiet for STATE_DEBOUNCE seconds, so key
+    presses never wait on the disk. Only writes when state_key() has changed
+    since the last snapshot, sparing the SD card.
+
+    Args:
+
+    Returns:  
+        None
+    '''
+
+    saved_key = None
+    while True:
+        if state_changed.wait(state_save_interval):
+            # Let quick channel flipping settle before writing
+            state_changed.clear()
+            while state_changed.wait(state_debounce):
+                state_changed.clear()
+        key = state_key()
+        if key == saved_key:
+            continue
+        try:
+            save_state()
+            saved_key = key
+        except Exception as e:
+            log.error(f"Failed to save player state: {e}")
+
+def restore_schedule(state, channel):
+    '''
+    Rebuilds a small schedule from the timeline cached in the state snapshot
+
+    Args:
+        state (dictionary) - Snapshot from load_state()
+        channel (int) - Channel that is about to be tuned
+
+    Returns:  
+        live_schedule (ScheduleStore) - Cached items of every channel
+        OR
+        None (if the cache has nothing airing on channel right now)
+    '''
+
+    rows = [tuple(row) for channel_rows in state.get("timeline", {}).values() for row in channel_rows]
+    restored = schedulestore.ScheduleStore(sorted(rows, key=lambda row: (row[1], row[2])))
+    if restored.playing_now(channel, datetime.now()) is None:
+        return None
+    return restored
 
 @player.on_key_press("w")
 def listen_for_channel_change():
@@ -233,7 +479,7 @@ def listen_for_channel_change():
     if current_channel > 8:
         current_channel = 2
     channel_changed = True
-    save_last_channel(current_channel)
+    state_changed.set()
     clear_osd_text()
 
 @player.on_key_press("s")
@@ -244,25 +490,38 @@ def listen_for_channel_change():
     if current_channel < 2:
         current_channel = 8
     channel_changed = True
-    save_last_channel(current_channel)
+    state_changed.set()
     clear_osd_text()
 
 #############
-# Clear out old scheduled items
-# schedule.clear_old_schedule_items()
-
-# If schedule needs to be built, build it
-if schedule.check_schedule_for_rebuild():
-    schedule.clear_schedule_table()
-    schedule.create_schedule()
+# Optional metrics endpoint
+if os.getenv("METRICS_PORT"):
+    metrics.start_metrics_server(int(os.getenv("METRICS_PORT")))
 
 # Channel number to start on
-current_channel = load_last_channel()
+state = load_state()
+current_channel = load_last_channel(state)
 log.info(f"Last channel played: {current_channel}")
 
-# Import schedule
-live_schedule = import_schedule()
+# Resume from the snapshot's timeline if it covers now, the full schedule is
+# loaded at the next item change
+live_schedule = restore_schedule(state, current_channel)
+if live_schedule is None:
+    live_schedule = import_schedule()
+else:
+    log.info("Resuming from the saved player state")
+    schedule_updated.set()
 log.info(f"Found {len(live_schedule)} scheduled items")
+playing_now = None
+playing_keyframes = None
+chapter_offset = 0
+
+# Any rebuild or extension happens in the background, or in the supervisor's scheduler
+if schedule_worker_mode == "external":
+    threading.Thread(target=schedule_watcher, daemon=True, name="schedule").start()
+else:
+    threading.Thread(target=schedule_worker, daemon=True, name="schedule").start()
+threading.Thread(target=state_writer, daemon=True, name="state").start()
 
 # Main loop
 while True:
@@ -276,22 +535,20 @@ while True:
     while not channel_changed:
         now = datetime.now().replace(microsecond=0)
         # Get playing now and playing next
-        try:
-            channel_schedule = [s for s in live_schedule if s["channel"] == current_channel]
-            log.info(f"Found {len(channel_schedule)} items for channel {current_channel}")
-            playing_now = [s for s in channel_schedule if now >= s["showtime"] and now < s["end"]][0]
-            log.info(f"{playing_now=}")
-            playing_now_index = channel_schedule.index(playing_now)
-            try:
-                playing_next = channel_schedule[playing_now_index + 1]
-                log.info(f"Playing next: {playing_next}")
-            except IndexError:
-                playing_next = None
-        except IndexError as e:
-            log.error(f"Index error occured with playing_now: {e}")
-            live_schedule = import_schedule()
-            time.sleep(1)
+        log.info(f"Found {live_schedule.channel_count(current_channel)} items for channel {current_channel}")
+        playing_now = live_schedule.playing_now(current_channel, now)
+        heartbeat.beat("player", status=f"channel {current_channel}")
+        if playing_now is None:
+            log.error(f"Nothing scheduled on channel {current_channel} at {now}")
+            schedule_requested.set()
+            # Only reload once the worker has written something new
+            if schedule_updated.wait(1):
+                schedule_updated.clear()
+                live_schedule = import_schedule()
             continue
+        log.info(f"{playing_now=}")
+        playing_next = live_schedule.playing_next(playing_now)
+        log.info(f"Playing next: {playing_next}")
 
 
         # Start playback
@@ -299,7 +556,10 @@ while True:
             log.warning(f"File {playing_now['filepath']} does not exist")
             time.sleep(1)
             break
+        tune_start = time.perf_counter()
+        set_gain(get_gain(playing_now.media_id))
         player.play(playing_now["filepath"])
+        metrics.inc("solostation_transitions_total", channel=current_channel)
         log.info(f"Playing until {playing_now['end']}")
 
         # Music Video OSD Text
@@ -316,20 +576,23 @@ while True:
                 playable = True
                 time.sleep(0.05)
 
-        if playing_now["chapter"] is not None:
-            chapter_start_time = get_chapter_start_time(playing_now["filepath"], playing_now["chapter"])
-            time_gap = datetime.now() - playing_now["showtime"]
-            chapter_hour, chapter_minute, chapter_second = map(int, chapter_start_time.split(":"))
-            elapsed_time = (time_gap + timedelta(hours=chapter_hour, minutes=chapter_minute, seconds=chapter_second)).total_seconds()
+        playing_keyframes = get_keyframes(playing_now.media_id)
+        if playing_now["chapter"] is not None and playing_now.row_id == state.get("row_id"):
+            # Resolved before the restart
+            chapter_offset = state["chapter_offset"]
+        elif playing_now["chapter"] is not None:
+            chapter_offset = get_chapter_offset(playing_now["filepath"], playing_now["chapter"], playing_keyframes)
         else:
-            elapsed_time = (now - playing_now["showtime"]).total_seconds()
+            chapter_offset = 0
+        elapsed_time = get_expected_position(playing_now, chapter_offset)
 
         elapsed_time = max(0, elapsed_time)
         if elapsed_time > 0:
             try:
-                player.seek(elapsed_time, reference="absolute")
+                seek_to(elapsed_time, playing_keyframes)
             except Exception as e:
                 log.debug(f"Seek Error: {e}")
+                metrics.inc("solostation_seek_errors_total", channel=current_channel)
                 break
         else:
             time.sleep(0.1)
@@ -337,18 +600,39 @@ while True:
         # Unpause playback if it is paused
         if player.pause:
             player.pause = False
+        metrics.observe("solostation_tune_seconds", time.perf_counter() - tune_start, channel=current_channel)
 
         # Play video until end time has come
+        next_drift_check = time.monotonic() + drift_sample_interval
         while now < playing_now["end"]:
             now = datetime.now().replace(microsecond=0)
 
             # Break the loop if channel_changed is set to True
             if channel_changed:
                 break
+
+            heartbeat.beat("player", status=f"channel {current_channel}")
+
+            # Keep the channel live against the schedule clock
+            if time.monotonic() >= next_drift_check:
+                next_drift_check = time.monotonic() + drift_sample_interval
+                if not check_drift(playing_now, chapter_offset):
+                    wait_out_slot(playing_now)
+                    now = datetime.now().replace(microsecond=0)
+                    break
             if player.time_pos is None or player.time_pos >= player.duration:
+                if player.duration is not None and get_expected_position(playing_now, chapter_offset) >= player.duration:
+                    # Reached the end of a file shorter than its slot, not a stall
+                    wait_out_slot(playing_now)
+                    now = datetime.now().replace(microsecond=0)
+                    break
                 log.warning(f"Playback stopped unexpectantly: {player.time_pos}/{player.duration}")
+                metrics.inc("solostation_stalls_total", channel=current_channel)
                 break
             time.sleep(0.1)
 
         if now >= playing_now["end"]:
-            live_schedule = import_schedule()
\ No newline at end of file
+            # Pick up whatever the schedule worker added
+            if schedule_updated.is_set():
+                schedule_updated.clear()
+                live_schedule = import_schedule()
\ No newline at end of file
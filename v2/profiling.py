@@ -0,0 +1,168 @@
+# Profiling
+import cProfile
+import functools
+import json
+import os
+import sqlite3
+import time
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from rich.console import Console
+from rich.table import Table
+
+log = logging.getLogger("rich")
+
+# Variables
+profile_enabled = os.getenv("SCHEDULE_PROFILE", "").lower() in ("1", "true", "yes")
+profile_dir = os.getenv("SCHEDULE_PROFILE_DIR", ".")
+pstats_path = os.getenv("SCHEDULE_PROFILE_PSTATS")
+current_channel = "setup"
+active_phases = []
+phase_totals = {}
+query_totals = {}
+profiler = None
+sqlite_connect = sqlite3.connect
+
+# Functions
+def enable(pstats_file=None):
+    """
+    Turns profiling on, as if SCHEDULE_PROFILE was set
+
+    Args:
+        pstats_file (string): Optional path to dump cProfile stats to after the build
+
+    Returns:
+        None
+    """
+
+    global profile_enabled, pstats_path
+
+    profile_enabled = True
+    if pstats_file:
+        pstats_path = pstats_file
+
+def set_channel(channel_name):
+    """ Attributes all following phases and queries to channel_name """
+    global current_channel
+    current_channel = channel_name
+
+@contextmanager
+def phase(name):
+    """
+    Times the wrapped block into the current channel's breakdown. Phases nest, so
+    times are inclusive of any phases called inside them.
+
+    Example:
+        with profiling.phase("materialize_guide"):
+            cursor.execute(query)
+    """
+
+    if not profile_enabled:
+        yield
+        return
+
+    active_phases.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        active_phases.pop()
+        totals = phase_totals.setdefault(current_channel, {}).setdefault(name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += elapsed
+
+def wrap(func, name=None):
+    """ Wraps func so every call is timed as a phase """
+    name = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with phase(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+def wrap_class(cls, name, methods):
+    """ Subclass of cls whose given methods are timed as a single phase """
+    return type(cls.__name__, (cls,), {m: wrap(getattr(cls, m), name) for m in methods})
+
+def count_query(statement):
+    """ sqlite3 trace callback, counts each statement against the innermost phase """
+    phase_name = active_phases[-1] if active_phases else "other"
+    channel_queries = query_totals.setdefault(current_channel, {})
+    channel_queries[phase_name] = channel_queries.get(phase_name, 0) + 1
+
+def counting_connect(*args, **kwargs):
+    """ sqlite3.connect replacement that counts every executed statement """
+    conn = sqlite_connect(*args, **kwargs)
+    conn.set_trace_callback(count_query)
+    return conn
+
+def start():
+    """
+    Resets counters and starts the profiler for a schedule build
+
+    Returns:
+        None
+    """
+
+    global profiler
+
+    if not profile_enabled:
+        return
+
+    phase_totals.clear()
+    query_totals.clear()
+    set_channel("setup")
+    sqlite3.connect = counting_connect
+    if pstats_path:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+def stop():
+    """
+    Stops the profiler, prints the per-channel breakdown and writes it to
+    SCHEDULE_PROFILE_DIR, along with the optional pstats dump
+
+    Returns:
+        report (dictionary): Per-channel phase calls, seconds and query counts
+    """
+
+    global profiler
+
+    if not profile_enabled:
+        return None
+
+    sqlite3.connect = sqlite_connect
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(pstats_path)
+        log.info(f"Wrote cProfile stats to {pstats_path}")
+        profiler = None
+
+    report = {
+        channel: {
+            name: {"calls": calls, "seconds": round(seconds, 4), "queries": query_totals.get(channel, {}).get(name, 0)}
+            for name, (calls, seconds) in phases.items()
+        }
+        for channel, phases in phase_totals.items()
+    }
+
+    table = Table(title="Schedule build profile")
+    table.add_column("Channel")
+    table.add_column("Phase")
+    table.add_column("Calls", justify="right")
+    table.add_column("Seconds", justify="right")
+    table.add_column("Queries", justify="right")
+    for channel, phases in report.items():
+        for name, totals in sorted(phases.items(), key=lambda p: p[1]["seconds"], reverse=True):
+            table.add_row(str(channel), name, str(totals["calls"]), f"{totals['seconds']:.3f}", str(totals["queries"]))
+    Console().print(table)
+
+    report_file = os.path.join(profile_dir, f"schedule-profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(report_file, "w") as file:
+        json.dump(report, file, indent=4)
+    log.info(f"Wrote schedule profile to {report_file}")
+
+    return report
@@ -4,13 +4,19 @@ import sqlite3
 import time
 import os
 from datetime import datetime, timedelta
-from rich.console import Console
-from rich.table import Table
 from rich.logging import RichHandler
 from rich.progress import Progress, SpinnerColumn, TimeElapsedColumn
 import logging
 from dotenv import load_dotenv
-from itertools import combinations
+import guide
+import heartbeat
+import keyframes
+import media
+import metrics
+import profiling
+import argparse
+import numpy as np
+import tagindex
 
 # Load env file
 load_dotenv()
@@ -28,9 +34,17 @@ logging.basicConfig(
 log = logging.getLogger("rich")
 
 # Variables
-schedule_list = []
-solo_db = os.getenv("DB_LOCATION")
 channel_file = os.getenv("CHANNEL_FILE")
+catalog = None
+catalog_version = None
+media_pools = {}
+pending_schedule_rows = []
+pending_last_played = {}
+channel_timelines = {}
+media_ids = {}
+heartbeat_name = None
+schedule_window = timedelta(hours=float(os.getenv("SCHEDULE_WINDOW_HOURS", 6)))
+rng = np.random.default_rng()
 
 # Functions
 def initialize_schedule_db():
@@ -48,17 +62,36 @@ def initialize_schedule_db():
     cursor = conn.cursor()
 
     log.debug("Initializing Schedule database")
+    media.initialize_media_db(cursor)
     table = """ CREATE TABLE IF NOT EXISTS SCHEDULE(
         ID INTEGER PRIMARY KEY AUTOINCREMENT,
         Channel INTEGER,
         Showtime TEXT,
         End TEXT,
-        Filepath TEXT,
+        MediaID INTEGER REFERENCES MEDIA (ID),
         Chapter INTEGER,
         Runtime TEXT
     );"""
 
     cursor.execute(table)
+
+    # Older databases store the full path on every row
+    media.migrate_schedule(cursor)
+    media.sync_media(cursor)
+    keyframes.initialize_keyframes_db(cursor)
+
+    # Closed-form rules for looping channels, one title per channel-day
+    table = """ CREATE TABLE IF NOT EXISTS CHANNEL_RULES(
+        Channel INTEGER,
+        Day TEXT,
+        Filepath TEXT,
+        Runtime TEXT,
+        Anchor TEXT,
+        PRIMARY KEY (Channel, Day)
+    );"""
+
+    cursor.execute(table)
+    conn.commit()
     conn.close()
 
 def clear_schedule_table():
@@ -81,7 +114,8 @@ def clear_schedule_table():
 def clear_old_schedule_items():
     '''
     Removes all old scheduled items from the SCHEDULE table
-    where End time has been passed by current time
+    where End time has been passed by current time, and the
+    loop channel rules of days the guide no longer shows
 
     Args:
     Returns:  
@@ -93,26 +127,32 @@ def clear_old_schedule_items():
     conn = sqlite3.connect(os.getenv("DB_LOCATION"))
     cursor = conn.cursor()
 
-    current_time = (datetime.now() - timedelta(hours=3)).strftime('%Y-%m-%d %H:%M:%S')
-    query = f"""SELECT * FROM SCHEDULE WHERE End < '{current_time}'"""
-    cursor.execute(query)
-    results = cursor.fetchall()
-    log.info(f"Found {len(results)} old items in Schedule")
-    
-    query = f"""DELETE FROM SCHEDULE WHERE End < '{current_time}'"""
-    cursor.execute(query)
+    cutoff = datetime.now() - timedelta(hours=3)
+    current_time = cutoff.strftime('%Y-%m-%d %H:%M:%S')
+    cursor.execute("DELETE FROM SCHEDULE WHERE End < ?", (current_time,))
+    results = cursor.rowcount
+    log.info(f"Removed {results} old items from Schedule")
+
+    # The guide reads the day before the cutoff day for showings running past midnight
+    rule_cutoff = (cutoff - timedelta(days=1)).strftime('%Y-%m-%d')
+    cursor.execute("DELETE FROM CHANNEL_RULES WHERE Day < ?", (rule_cutoff,))
+    log.debug(f"Removed {cursor.rowcount} old channel rules")
     conn.commit()
     conn.close()
 
+    # Rebuild only the guide slices that lost items
+    if results:
+        guide.invalidate_guide(cutoff)
+
 def check_schedule_for_rebuild():
     """
-    Checks for items scheduled for today in the Schedule table
+    Checks that every channel has something scheduled right now
 
     Args:
         None
 
     Returns:
-        (bool) - True if there are no future dates in the schedule
+        (bool) - True if any channel has nothing playing now
 
     Raises:
 
@@ -126,25 +166,19 @@ def check_schedule_for_rebuild():
     rebuild_needed = False
 
     # Extract all channel numbers from channels file
-    now = datetime.now().strftime("%Y-%m-%d")
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     with open(channel_file, "r") as channel_file_input:
         channel_data = json.load(channel_file_input)
 
     for channel in channel_data:
         channel_number = channel_data[channel]["channel_number"]
-        log.info(f"Checking for channel {channel_number} for {now}")
-        query = f""" SELECT Showtime, End, Filepath FROM SCHEDULE WHERE Channel = {channel_number} AND DATE(Showtime) = {now} ORDER BY Showtime ASC"""
-        cursor.execute(query)
-        items = [{
-            "showtime": datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S"),
-            "end": datetime.strptime(row[1], "%Y-%m-%d %H:%M:%S"),
-            "filepath": row[2]
-        } for row in cursor.fetchall()]
-
-        log.info(f"Found {len(items)} items in schedule for channel {channel_number}")
+        log.info(f"Checking for channel {channel_number} at {now}")
+        query = "SELECT COUNT(*) FROM SCHEDULE WHERE Channel = ? AND Showtime <= ? AND End > ?"
+        cursor.execute(query, (channel_number, now, now))
+        items, = cursor.fetchone()
 
         if not items:
-            log.warning(f"No items found for channel {channel_number}")
+            log.warning(f"Nothing scheduled now for channel {channel_number}")
             rebuild_needed = True
             break
 
@@ -152,9 +186,30 @@ def check_schedule_for_rebuild():
 
     return rebuild_needed
 
+def needs_extension():
+    """
+    Checks whether any channel's materialized schedule ends within half of the window
+
+    Args:
+        None
+
+    Returns:
+        (bool) - True if extend_schedule() should run
+    """
+
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    cursor = conn.cursor()
+    cursor.execute("SELECT MIN(Last) FROM (SELECT MAX(End) AS Last FROM SCHEDULE GROUP BY Channel)")
+    last_end, = cursor.fetchone()
+    conn.close()
+
+    if last_end is None:
+        return True
+    return datetime.strptime(last_end, "%Y-%m-%d %H:%M:%S") < datetime.now() + schedule_window / 2
+
 def insert_into_schedule(channel_number, showtime, end, filepath, chapter, runtime):
     """
-    Inserts a single media item into the schedule table
+    Queues a single media item for the schedule table, written by flush_schedule()
 
     Args:
         channel_number (integer): Channel number
@@ -173,67 +228,41 @@ def insert_into_schedule(channel_number, showtime, end, filepath, chapter, runti
         insert_into_schedule(2, "05:00:00", "05:01:02", /folder/media.mp4, 2, "02:45:00")
     """
 
-    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO SCHEDULE (Channel, Showtime, End, Filepath, Chapter, Runtime) VALUES (?, ?, ?, ?, ?, ?)",
-        (channel_number, showtime, end, filepath, chapter, runtime),
-    )
-
-    # Commit changes to database
-    conn.commit()
-    conn.close()
+    pending_schedule_rows.append((channel_number, str(showtime), str(end), filepath, chapter, runtime))
 
-def search_database(search_term):
+def flush_schedule():
     """
-    Searches the Solostation Database based on tags
+    Writes all queued schedule items and LastPlayed updates in a single transaction,
+    swapping each file path for its Media ID
 
     Args:
-        search_term (list): List of strings, search keywords/terms
+        None
 
     Returns:
-        results (list): List of dictionaries in tuple format
-
-    Raises:
-    Example:
-        search_database(['action', 'movie'])
+        None
     """
 
     conn = sqlite3.connect(os.getenv("DB_LOCATION"))
     cursor = conn.cursor()
-
-    # log.debug(f"Searching for {search_term}")
-
-    query = f"""
-        SELECT 'TV' AS source_table, json_object('ID', ID, 'Name', Name, 'ShowName', ShowName, 'Season', Season, 'Episode', Episode, 'Overview', Overview, 'Tags', Tags, 'Runtime', Runtime, 'Filepath', Filepath, 'LastPlayed', LastPlayed) AS data
-        FROM TV WHERE Tags LIKE '%{search_term}%' OR ShowName LIKE '%{search_term}%' OR Name LIKE '%{search_term}%'
-
-        UNION ALL
-
-        SELECT 'MOVIE' AS source_table, json_object('ID', ID, 'Name', Name, 'Year', Year, 'Overview', Overview, 'Tags', Tags, 'Runtime', Runtime, 'Filepath', Filepath, 'LastPlayed', LastPlayed) AS data
-        FROM MOVIE WHERE Tags LIKE '%{search_term}%' OR Name LIKE '%{search_term}%' OR Year LIKE '%{search_term}%'
-
-        UNION ALL
-
-        SELECT 'MUSIC' AS source_table, json_object('ID', ID, 'Artist', Artist, 'Title', Title, 'Tags', Tags, 'Runtime', Runtime, 'Filepath', Filepath) AS data
-        FROM MUSIC WHERE Tags LIKE '%{search_term}%'
-
-        UNION ALL
-
-        SELECT 'WEB' AS source_table, json_object('ID', ID,  'Tags', Tags, 'Runtime', Runtime, 'Filepath', Filepath) AS data
-        FROM WEB WHERE Tags LIKE '%{search_term}%'
-
-        UNION ALL
-
-        SELECT 'COMMERCIALS' AS source_table, json_object('ID', ID,  'Tags', Tags, 'Runtime', Runtime, 'Filepath', Filepath, 'LastPlayed', LastPlayed) AS data
-        FROM COMMERCIALS WHERE Tags LIKE '%{search_term}%';
-    """
-
-    cursor.execute(query)
-    results = cursor.fetchall()
+    with metrics.timer("solostation_db_query_seconds", query="flush_schedule"):
+        media.get_media_ids(cursor, {row[3] for row in pending_schedule_rows}, media_ids)
+        cursor.executemany(
+            "INSERT INTO SCHEDULE (Channel, Showtime, End, MediaID, Chapter, Runtime) VALUES (?, ?, ?, ?, ?, ?)",
+            [(channel, showtime, end, media_ids[filepath], chapter, runtime) for channel, showtime, end, filepath, chapter, runtime in pending_schedule_rows],
+        )
+        for table, played in pending_last_played.items():
+            cursor.executemany(
+                f"UPDATE {table} SET LastPlayed = ? WHERE Filepath = ?",
+                [(last_played, filepath) for filepath, last_played in played.items()],
+            )
+
+        # Commit changes to database
+        conn.commit()
     conn.close()
 
-    return results
+    log.debug(f"Wrote {len(pending_schedule_rows)} schedule items")
+    pending_schedule_rows.clear()
+    pending_last_played.clear()
 
 def get_chapters(filepath):
     '''
@@ -274,111 +303,46 @@ def get_chapters(filepath):
     else:
         return None
 
-def get_next_tv_playtime(marker, episode_TD):
+def get_keyframes(filepath):
     """
-    Determine the next available play time and size of episode block
+    Reads the keyframe index of a file
 
     Args:
-        marker (datetime): Current place in the schedule timeline
-        episode_TD (timedelta): Timedelta of episode runtime
+        filepath (string): Video file
 
     Returns:
-        episode_block (timedelta)
-        next_play_time (datetime)
-
-    Raises:
-    Example:
+        times (array): Keyframe times in milliseconds
+        OR
+        None (if the file hasn't been indexed)
     """
 
-    # Find next play time depending on episode runtime
-    if episode_TD < timedelta(minutes=30):
-        episode_block = timedelta(minutes=30)
-        if marker.minute < 30:
-            next_play_time = marker.replace(minute=30, second=0, microsecond=0)
-        else:
-            if marker.hour == 23:
-                next_play_time = marker.replace(day=(marker.day + 1), hour=0, minute=0, second=0, microsecond=0)
-            else:
-                next_play_time = marker.replace(hour=(marker.hour + 1), minute=0, second=0, microsecond=0)
-    else:
-        episode_block = timedelta(hours=1)
-        if marker.minute < 30:
-            if marker.hour == 23:
-                next_play_time = marker.replace(day=(marker.day + 1), hour=0, minute=0, second=0, microsecond=0)
-            else:
-                next_play_time = marker.replace(hour=(marker.hour + 1), minute=0, second=0, microsecond=0)
-            episode_block = timedelta(minutes=30)
-        else:
-            episode_block = timedelta(hours=1)
-            if marker.hour == 23:
-                next_play_time = marker.replace(day=(marker.day + 1), hour=0, minute=30, second=0, microsecond=0)
-            else:
-                next_play_time = marker.replace(hour=(marker.hour + 1), minute=30, second=0, microsecond=0)
-
-    return episode_block, next_play_time
-
-def get_next_movie_playtime_c2(marker):
-    '''
-    Find the next available time to play the next movie, ensuring that the next play time
-    starts on or half the hour.
-
-    Args:
-        marker (datetime): Location of marker
-
-    Returns:
-        next_play_time (datetime): Next available play time for next movie
-
-    Raises:
-    Example:
-    '''
-
-    if marker.minute < 30:
-        next_play_time = marker.replace(minute=30, second=0, microsecond=0)
-    else:
-        if marker.hour == 23:
-            next_play_time = marker.replace(day=(marker.day + 1), hour=0, minute=0, second=0, microsecond=0)
-        else:
-            next_play_time = marker.replace(hour=(marker.hour + 1), minute=0, second=0, microsecond=0)
-
-    return next_play_time
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    cursor = conn.cursor()
+    cursor.execute("SELECT ID FROM MEDIA WHERE Path = ?", (filepath,))
+    result = cursor.fetchone()
+    times = keyframes.load_keyframes(cursor, result[0]) if result else None
+    conn.close()
 
+    return times
 
-def get_next_movie_playtime(marker):
-    '''
-    Find the next available time to play the next movie, giving 15-30 between show times
-    to play web content, movie trailers, etc
+def align_to_slot(marker, slot_TD):
+    """
+    Rounds marker up to the next boundary of the channel's slot grid
 
     Args:
         marker (datetime): Location of marker
+        slot_TD (timedelta): Slot size, i.e. 30 minutes
 
     Returns:
-        next_play_time (datetime): Next available play time for next movie
+        next_play_time (datetime): marker if it is already on the grid
 
-    Raises:
     Example:
-    '''
-
-    marker = marker.replace(second=0, microsecond=0)
-    if marker.minute >= 0 and marker.minute <=15:
-        # log.debug("30")
-        next_play_time = marker.replace(minute=30, second=0)
-    if marker.minute > 15 and marker.minute <=30:
-        # log.debug("45")
-        next_play_time = marker.replace(minute=45, second=0)
-    if marker.minute > 30 and marker.minute <=45:
-        # log.debug("00")
-        if marker.hour == 23:
-            next_play_time = (marker.replace(hour=0, minute=0, second=0)) + timedelta(days=1)
-        else:
-            next_play_time = marker.replace(hour=(marker.hour + 1), minute=0, second=0)
-    if marker.minute > 45 and marker.minute <=59:
-        # log.debug("15")
-        if marker.hour == 23:
-            next_play_time = (marker.replace(hour=0, minute=15, second=0)) + timedelta(days=1)
-        else:
-            next_play_time = marker.replace(hour=(marker.hour + 1), minute=15, second=0)
+        align_to_slot(marker, timedelta(minutes=30))
+    """
 
-    return next_play_time
+    day_start = marker.replace(hour=0, minute=0, second=0, microsecond=0)
+    slots = -(-(marker - day_start) // slot_TD)
+    return day_start + slots * slot_TD
 
 def add_post_movie(channel_number, marker, next_play_time):
     """
@@ -402,10 +366,9 @@ def add_post_movie(channel_number, marker, next_play_time):
     while not filled:
         # Add all trailers if all_trailers is empty
         if len(all_trailers) == 0:    
-            table, data = zip(*search_database("trailers"))
-            data = [json.loads(d) for d in data]
-            for d in data:
-                all_trailers.append(d)
+            all_trailers.extend(select_items("trailers"))
+            if len(all_trailers) == 0:
+                break
         random.shuffle(all_trailers)
         
         for trailer in all_trailers:
@@ -426,286 +389,262 @@ def add_post_movie(channel_number, marker, next_play_time):
         
     return marker
 
-def schedule_loud(channel_number, marker, channel_end_datetime):
-    """ Schedules for the Loud Channel """
+def strategy_block(channel_config):
+    """ Episodic block programming, random picks from a sample of the channel's media """
+
+    channel_media = select_items(channel_config["tags"])
+    random_media_list = []
+    while True:
+        # Sample 75 items from the channel filter, resampling once they have all aired
+        if not random_media_list:
+            random_media_list = random.sample(channel_media, min(75, len(channel_media)))
+            if not random_media_list:
+                return
+        media = random.choice(random_media_list)
+        random_media_list.remove(media)
+        yield media
 
-    # Get total time of channel runtime in seconds for Progress
-    total_seconds = (channel_end_datetime - marker).total_seconds()
-    log.debug(f"{total_seconds=}")   
+def strategy_rotation(channel_config):
+    """ Rotation of movies weighted on LastPlayed """
+
+    while True:
+        selected_movies = select_weighted_movie([channel_config["tags"]])
+        if not selected_movies:
+            return
+        for movie in selected_movies:
+            mark_played(movie["Filepath"], time.time(), "MOVIE")
+            yield movie
+
+def strategy_music(channel_config):
+    """ Shuffled music videos with an ident every few videos """
+
+    ident_every = channel_config.get("ident_every", 2)
     all_music = []
     all_idents = []
+    music_count = 0
+    while True:
+        if not all_music:
+            all_music = [item for item in select_items(channel_config["tags"]) if "music" in item["Filepath"]]
+            random.shuffle(all_music)
+            if not all_music:
+                return
+        yield all_music.pop()
+
+        if ident_every and music_count % ident_every == 0:
+            if not all_idents:
+                all_idents = [item for item in select_items(channel_config.get("idents", "ident")) if "idents" in item["Filepath"]]
+                random.shuffle(all_idents)
+            if all_idents:
+                yield all_idents.pop()
+        music_count += 1
+
+def get_loop_rule(channel_number, channel_config, marker):
+    """
+    Finds, or picks and stores, the title a looping channel plays on marker's day
 
-    # Monitor progress of scheduling for channel
-    with Progress() as progress:
-        task = progress.add_task("[green]Scheduling loud ...", total=total_seconds)
-        completed_time = 0
-
-        while not progress.finished:
-        # while marker < channel_end_datetime:
-            if len(all_music) == 0:
-                # Search database for 'music' tag and create lists from results
-                all_music.extend([json.loads(data) for table, data in search_database("music") if "music" in json.loads(data)["Filepath"]])
-                random.shuffle(all_music)
-    
-            # 2 music videos, 1 ident
-            for music_index, music_video in enumerate(all_music):
-                # Insert video into schedule
-                # log.debug(f"{music_index} - {all_music[music_index]['Filepath']}")
-                hours, minutes, seconds = map(int, music_video["Runtime"].split(":"))
-                mv_runtime_TD = timedelta(hours=hours,minutes=minutes,seconds=seconds)
-                post_marker = marker + mv_runtime_TD
-                insert_into_schedule(channel_number, marker, post_marker, music_video["Filepath"], None, music_video["Runtime"])
-                marker = post_marker
-                all_music.pop(all_music.index(music_video))
-                completed_time += mv_runtime_TD.total_seconds()
-
-                if music_index % 2 == 0:
-                    if len(all_idents) < 2:
-                        # Search database for 'ident' tag and create lists from results
-                        all_idents.extend([json.loads(data) for table, data in search_database("ident") if "idents" in json.loads(data)["Filepath"]])
-                        random.shuffle(all_idents)
+    Args:
+        channel_number (integer): Channel number
+        channel_config (dictionary): Channel definition from the channel file
+        marker (datetime): Where the channel's timeline is
 
-                    # Schedule ident
-                    hours, minutes, seconds = map(int, all_idents[0]["Runtime"].split(":"))
-                    mv_runtime_TD = timedelta(hours=hours,minutes=minutes,seconds=seconds)
-                    post_marker = marker + mv_runtime_TD
-                    insert_into_schedule(channel_number, marker, post_marker, all_idents[0]["Filepath"], None, all_idents[0]["Runtime"])
-                    marker = post_marker
-                    all_idents.pop(all_idents.index(all_idents[0]))
+    Returns:
+        rule (dictionary): 'day', 'filepath', 'runtime' and 'anchor', the first showtime of the title
+        OR
+        None (if nothing matches the channel filter)
+    """
 
-                    # Update Progress
-                    completed_time += mv_runtime_TD.total_seconds()
-                    progress.update(task, completed=completed_time)
+    day = marker.strftime("%Y-%m-%d")
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    cursor = conn.cursor()
+    cursor.execute("SELECT Filepath, Runtime, Anchor FROM CHANNEL_RULES WHERE Channel = ? AND Day = ?", (channel_number, day))
+    result = cursor.fetchone()
+
+    if result is None:
+        selected_movies = select_weighted_movie([channel_config["tags"]])
+        if not selected_movies:
+            conn.close()
+            return None
+        movie = selected_movies[0]
+        mark_played(movie["Filepath"], time.time(), "MOVIE")
+        result = (movie["Filepath"], movie["Runtime"], str(marker))
+        cursor.execute(
+            "INSERT INTO CHANNEL_RULES (Channel, Day, Filepath, Runtime, Anchor) VALUES (?, ?, ?, ?, ?)",
+            (channel_number, day, *result),
+        )
+        conn.commit()
+    conn.close()
 
+    filepath, runtime, anchor = result
+    return {"day": day, "filepath": filepath, "runtime": runtime, "anchor": datetime.strptime(anchor, "%Y-%m-%d %H:%M:%S")}
 
-def schedule_ppv(channel_number, marker, channel_end_datetime):
-    """ Schedules for the PPV Channels """
+def loop_timeline(channel_number, channel_config, marker):
+    """
+    Closed-form timeline for looping channels: showtimes are anchor + n * runtime,
+    so no strategy state is needed to continue the channel. Its rows are still
+    written to SCHEDULE like any other channel.
 
-    # Get total time of channel runtime in seconds for Progress
-    total_seconds = (channel_end_datetime - marker).total_seconds()
+    Args:
+        channel_number (integer): Channel number
+        channel_config (dictionary): Channel definition from the channel file
+        marker (datetime): Where the channel's timeline starts
 
-    with Progress() as progress:
-        task = progress.add_task("[green]Scheduling PPV ...", total=total_seconds)
-        completed_time = 0
+    Returns:
+        Generator of schedule rows
+    """
 
-        while not progress.finished:
-            # Search database for 'movie' tag and create lists from results
-            selected_movies = select_weighted_movie(["movie"])
+    while True:
+        rule = get_loop_rule(channel_number, channel_config, marker)
+        if rule is None:
+            return
+        runtime_TD = runtime_to_timedelta(rule["runtime"])
 
-            # Select random movie
-            ppv_movie = selected_movies[0]
-            ppv_movie_filepath = ppv_movie[0]
-            ppv_movie_runtime = ppv_movie[3]
+        # Start from the showing already running at marker, filler covers any gap before the anchor
+        if marker < rule["anchor"]:
+            showtime = rule["anchor"]
+            yield (channel_number, str(marker), str(showtime), os.getenv("FILLER_VIDEO"), None, seconds_to_hms((showtime - marker).total_seconds()))
+        else:
+            showtime = rule["anchor"] + ((marker - rule["anchor"]) // runtime_TD) * runtime_TD
 
-            # Calculate movie runtime
-            hours, minutes, seconds = map(int, ppv_movie_runtime.split(":"))
-            movie_TD = timedelta(hours=hours,minutes=minutes,seconds=seconds)
+        # The title loops until a showtime falls on the next day
+        while showtime.strftime("%Y-%m-%d") == rule["day"]:
+            yield (channel_number, str(showtime), str(showtime + runtime_TD), rule["filepath"], None, rule["runtime"])
+            showtime += runtime_TD
+        marker = showtime
 
-            # Update Progress
-            completed_time += movie_TD.total_seconds()
-            # log.debug(f"{completed_time=}")
-            progress.update(task, completed=completed_time)
+def channel_timeline(channel_name, channel_config, marker):
+    """
+    Lazily generates a channel's schedule rows from marker on, one program at a time
 
-            # Fill with the movie until the channel end time
-            while marker < channel_end_datetime:
-                post_marker = marker + movie_TD
-                insert_into_schedule(channel_number, marker, post_marker, ppv_movie_filepath, None, ppv_movie_runtime)
-                marker = post_marker #+ timedelta(seconds=1)
+    Args:
+        channel_name (string): Name of the channel in the channel file
+        channel_config (dictionary): Channel definition from the channel file
+        marker (datetime): Where the channel's timeline starts
 
-def schedule_bang(channel_number, marker, channel_end_datetime):
-    """ Schedules for the Bang Channel """
+    Returns:
+        Generator of (Channel, Showtime, End, Filepath, Chapter, Runtime) rows
 
-    # Get total time of channel runtime in seconds for Progress
-    total_seconds = (channel_end_datetime - marker).total_seconds()
+    Example:
+        next(channel_timeline("motion", channel_data["motion"], marker))
+    """
 
-    with Progress() as progress:
-        task = progress.add_task("[green]Scheduling bang! ...", total=total_seconds)
-        completed_time = 0
-
-        while not progress.finished:
-            # Select 20 movies weighted on LastPlayed
-            selected_movies = select_weighted_movie(["action", "movie"])
-            
-            # Insert selected movies into the schedule
-            for movie in selected_movies:
-                movie_filepath = movie[0]
-                movie_runtime = movie[3]
-                movie_h, movie_m, movie_s = map(int, movie_runtime.split(":"))
-                movie_TD = timedelta(hours=movie_h, minutes=movie_m, seconds=movie_s)
-
-                # Update Progress
-                completed_time += movie_TD.total_seconds()
-                # log.debug(f"{completed_time=}")
-                progress.update(task, completed=completed_time)
-
-                post_marker = marker + movie_TD
-                insert_into_schedule(channel_number, marker, post_marker, movie_filepath, None, movie_runtime)
-
-                # Update LastPlayed
-                conn = sqlite3.connect(os.getenv("DB_LOCATION"))
-                cursor = conn.cursor()
-                now_str = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
-                cursor.execute(f'Update MOVIE SET LastPlayed = "{now_str}" WHERE Filepath = "{movie_filepath}"')
-                conn.commit()
-                conn.close()
-                
-                # Update marker
-                marker = post_marker #+ timedelta(seconds=1)
+    channel_number = channel_config["channel_number"]
+    if channel_config.get("strategy") == "loop":
+        yield from loop_timeline(channel_number, channel_config, marker)
+        return
+
+    strategy = channel_strategies[channel_config.get("strategy", "rotation")]
+    for program in strategy(channel_config):
+        # Take the rows place_program queued for this program back out of the write queue
+        first_row = len(pending_schedule_rows)
+        marker = place_program(channel_number, channel_config, program, marker)
+        rows = pending_schedule_rows[first_row:]
+        del pending_schedule_rows[first_row:]
+        yield from rows
+
+channel_strategies = {
+    "block": strategy_block,
+    "rotation": strategy_rotation,
+    "music": strategy_music,
+}
+
+def fill_commercials(marker, next_play_time, channel_number):
+    """ Break policy: commercials, then filler """
+    return post_episode(marker, next_play_time, channel_number)
+
+def fill_web(marker, next_play_time, channel_number):
+    """ Break policy: web content, then filler """
+    return post_movie(marker, next_play_time, channel_number)
+
+def fill_trailers(marker, next_play_time, channel_number):
+    """ Break policy: movie trailers, then filler """
+    marker = add_post_movie(channel_number, marker, next_play_time)
+    return fill_none(marker, next_play_time, channel_number)
+
+def fill_none(marker, next_play_time, channel_number):
+    """ Break policy: filler only """
+    if marker < next_play_time:
+        marker = add_final_filler(marker, next_play_time, next_play_time - marker, channel_number)
+    return marker
 
-                # Stop filling with movies if marker is past the channel end date
-                if marker >= channel_end_datetime:
-                    break
+break_policies = {
+    "commercials": fill_commercials,
+    "web": fill_web,
+    "trailers": fill_trailers,
+    "none": fill_none,
+}
 
-                # Add movie trailers between show times
-                next_showtime = get_next_movie_playtime(marker)
-                marker = add_post_movie(channel_number, marker, next_showtime)
-                marker = next_showtime
+def get_break_policy(channel_config, table):
+    """
+    Looks up the channel's break policy for a media item
 
-def schedule_motion(channel_number, marker, channel_end_datetime):
-    """ Schedules for the Motion Channel """
+    Args:
+        channel_config (dictionary): Channel definition from the channel file
+        table (string): Source table of the media item, i.e. 'TV'
 
-    # Get total time of channel runtime in seconds for Progress
-    total_seconds = (channel_end_datetime - marker).total_seconds()
+    Returns:
+        policy (string): Key of break_policies
+    """
 
-    # Monitor progress of scheduling for channel
-    with Progress() as progress:
-        task = progress.add_task("[green]Scheduling motion ...", total=total_seconds)
-        completed_time = 0
-
-        while not progress.finished:
-            # Select 20 movies weighted on LastPlayed
-            selected_movies = select_weighted_movie(["movie"])
-            
-            # Insert selected movies into the schedule
-            for movie in selected_movies:
-                movie_filepath = movie[0]
-                movie_runtime = movie[3]
-                movie_h, movie_m, movie_s = map(int, movie_runtime.split(":"))
-                movie_TD = timedelta(hours=movie_h, minutes=movie_m, seconds=movie_s)
-
-                # Update Progress
-                completed_time += movie_TD.total_seconds()
-                # log.debug(f"{completed_time=}")
-                progress.update(task, completed=completed_time)
-
-                post_marker = marker + movie_TD
-                insert_into_schedule(channel_number, marker, post_marker, movie_filepath, None, movie_runtime)
-
-                # Update LastPlayed
-                conn = sqlite3.connect(os.getenv("DB_LOCATION"))
-                cursor = conn.cursor()
-                now_str = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
-                cursor.execute(f'Update MOVIE SET LastPlayed = "{now_str}" WHERE Filepath = "{movie_filepath}"')
-                conn.commit()
-                conn.close()
-                
-                # Update marker
-                marker = post_marker #+ timedelta(seconds=1)
+    breaks = channel_config.get("breaks", "none")
+    if isinstance(breaks, dict):
+        return breaks.get(table.lower(), breaks.get("default", "none"))
+    return breaks
 
-                # Stop filling with movies if marker is past the channel end date
-                if marker >= channel_end_datetime:
-                    break
+def place_program(channel_number, channel_config, program, marker):
+    """
+    Places one program on the channel timeline: chapters split by breaks when the
+    channel takes breaks, then the gap up to the next slot filled per break policy
 
-                # Add movie trailers between show times
-                next_showtime = get_next_movie_playtime(marker)
-                # log.debug("Adding post movie")
-                marker = add_post_movie(channel_number, marker, next_showtime)
-                marker = next_showtime
+    Args:
+        channel_number (integer): Channel number
+        channel_config (dictionary): Channel definition from the channel file
+        program (dictionary): Media item from the catalog
+        marker (datetime): Location of marker
 
-def schedule_channel2(channel_number, marker, channel_end_datetime, tags):
-    """ Schedules for the channel2 """
+    Returns:
+        marker (datetime): Location of marker after the program and its breaks
+    """
 
-    # Get total time of channel runtime in seconds for Progress
-    total_seconds = (channel_end_datetime - marker).total_seconds()
+    program_TD = runtime_to_timedelta(program["Runtime"])
+    policy = get_break_policy(channel_config, program["Table"])
+    slot_TD = timedelta(minutes=channel_config.get("slot_minutes", 0))
+    gap_TD = timedelta(minutes=channel_config.get("min_gap_minutes", 0))
 
-    # List creation
-    channel_media = []
+    # Find the next play time on the slot grid
+    next_play_time = None
+    if slot_TD:
+        next_play_time = align_to_slot(marker + program_TD + gap_TD, slot_TD)
 
-    # Gather media by tag
-    for tag in tags:
-        channel_media.extend([json.loads(data) for table, data in search_database(tag)])
+    # Chapters only matter when there is break time to split up
+    chapters = None
+    if program["Table"] == "TV" and policy == "commercials" and next_play_time:
+        chapters = get_chapters(program["Filepath"])
 
-    # Sample 75 items from tag search
-    random_media_list = random.sample(channel_media, min(75, len(channel_media)))
+    if chapters:
+        max_commercial_time = get_max_break_time(program_TD, chapters, next_play_time - marker)
 
-    # Build schedule
-    while marker < channel_end_datetime:
-        # Select random media object
-        media = random.choice(random_media_list)
-        log.debug(f"{media['Filepath']} - {marker.hour:02}:{marker.minute:02}:{marker.second:02}")
-
-        # Process TV episode
-        if "tv" in media["Filepath"]:
-            # Calculate episode timedelta
-            episode_TD = runtime_to_timedelta(media["Runtime"])
-
-            # Get episode block size and next play time
-            episode_block, next_play_time = get_next_tv_playtime(marker, episode_TD)
-
-            # Get chapter metadata
-            chapters = get_chapters(media['Filepath'])
-
-            # If Chapters
-            if chapters:
-                # log.debug(f"Chapters: {len(chapters)}")
-
-                # Calculate max commercial time
-                max_commercial_time = get_max_break_time(episode_TD, chapters, episode_block)
-
-                for chapter in chapters:
-                    # Get chapter duration
-                    chapter_number, chapter_start, chapter_end = chapter
-                    chapter_start_TD  = runtime_to_timedelta(chapter_start)
-                    chapter_end_TD  = runtime_to_timedelta(chapter_end)
-                    chapter_duration = chapter_end_TD - chapter_start_TD
-
-                    # Insert into schedule
-                    log.debug(f"Inserting {media['Filepath']} - Chapter {chapter_number}")
-                    post_marker = marker + chapter_duration
-                    insert_into_schedule(channel_number, marker, post_marker, media["Filepath"], chapter_number, seconds_to_hms(chapter_duration.total_seconds()))
-                    marker = post_marker #+ timedelta(seconds=1)
-
-                    # Commercials between chapters
-                    if int(chapter_number) < len(chapters):
-                        marker = standard_commercial_break(marker, max_commercial_time, channel_number)
-                    else:
-                        # Commercials post episode
-                        log.debug("Final chapter has been played")
-
-                        log.debug(f"Filling commercials from {marker} to {next_play_time}")
-                        marker = post_episode(marker, next_play_time, channel_number)
-            else:
-                # If no chapters are in episode, add episode and fill the rest of the block with commercials
-                post_marker = marker + episode_TD
-                insert_into_schedule(channel_number, marker, post_marker, media["Filepath"], None, media["Runtime"])
-                marker = post_marker #+ timedelta(seconds=1)
-
-                # Pop 'media' from the list
-                media_index = random_media_list.index(media)
-                random_media_list.pop(media_index)
-
-                # Commercials post episode
-                log.debug(f"Filling commercials from {marker} to {next_play_time}")
-                marker = post_episode(marker, next_play_time, channel_number)
-        else:
-            # Process Movie
-            movie_TD = runtime_to_timedelta(media["Runtime"])
+        # Breaks cut on keyframes, so the player starts each chapter without decoding up to it
+        for chapter in keyframes.align_chapters(chapters, get_keyframes(program["Filepath"])):
+            chapter_number, chapter_start, chapter_end = chapter
+            chapter_duration = timedelta(seconds=round(chapter_end - chapter_start))
 
-            # Insert into schedule
-            post_marker = marker + movie_TD
-            insert_into_schedule(channel_number, marker, post_marker, media["Filepath"], None, media["Runtime"])
-            marker = post_marker #+ timedelta(seconds=1)
+            post_marker = marker + chapter_duration
+            insert_into_schedule(channel_number, marker, post_marker, program["Filepath"], chapter_number, seconds_to_hms(chapter_duration.total_seconds()))
+            marker = post_marker
 
-            # Pop 'media' from the list
-            movie_index = random_media_list.index(media)
-            random_media_list.pop(movie_index)
+            # Commercials between chapters
+            if int(chapter_number) < len(chapters):
+                marker = standard_commercial_break(marker, max_commercial_time, channel_number)
+    else:
+        post_marker = marker + program_TD
+        insert_into_schedule(channel_number, marker, post_marker, program["Filepath"], None, program["Runtime"])
+        marker = post_marker
 
-            # Get next movie playtime
-            next_play_time = get_next_movie_playtime_c2(marker)
+    if next_play_time:
+        log.debug(f"Filling {policy} from {marker} to {next_play_time}")
+        marker = break_policies[policy](marker, next_play_time, channel_number)
 
-            # Fill time with commercials
-            log.debug(f"Filling commercials from {marker} to {next_play_time}")
-            marker = post_movie(marker, next_play_time, channel_number)
+    return marker
 
 def time_str_to_seconds(time_str):
     """ Converts time formatted string to number of seconds  """
@@ -781,6 +720,8 @@ def standard_commercial_break(marker, max_break_time, channel_number):
     while max_break_time > timedelta(seconds=14):
         # Select fitted, random commercial
         commercial = select_commercial(max_break_time)
+        if commercial is None:
+            break
 
         # Parse commercial runtime
         comm_h, comm_m, comm_s = map(int, commercial["Runtime"].split(":"))
@@ -821,6 +762,8 @@ def post_episode(marker, next_play_time, channel_number):
         while time_remaining > timedelta(minutes=1):
             # Select fitted, random commercial
             commercial = select_commercial(time_remaining)
+            if commercial is None:
+                break
             # log.debug(f"{time_remaining=} - {commercial['Runtime']}")
 
             # Parse commercial runtime
@@ -865,7 +808,7 @@ def post_movie(marker, next_play_time, channel_number):
     log.debug(type(time_remaining_hms))
 
     # Get all web content
-    all_web_media = [json.loads(data) for table, data in search_database("web")]
+    all_web_media = select_items("web")
     random.shuffle(all_web_media)
 
     for web_media in all_web_media:
@@ -881,15 +824,137 @@ def post_movie(marker, next_play_time, channel_number):
     marker = add_final_filler(marker, next_play_time, time_remaining, channel_number)
     return marker
 
+def get_catalog():
+    """ Tag-indexed catalog of all media, loaded once per build """
+    global catalog, catalog_version
+    if catalog is None:
+        catalog_version = read_catalog_version()
+        catalog = tagindex.load_catalog()
+    return catalog
+
+def read_catalog_version():
+    """ Catalog version the media manager last set, see media.mark_catalog_changed() """
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    version = media.get_catalog_version(conn.cursor())
+    conn.close()
+    return version
+
+def reload_if_catalog_changed():
+    """
+    Drops the loaded catalog, and the channel timelines drawing from it, when the
+    media manager has changed the library since it was loaded. The schedule
+    already built stays; the next extension continues from the new catalog.
+
+    Args:
+        None
+
+    Returns:
+        (bool) - True if the catalog was dropped
+    """
+
+    global catalog
+
+    if catalog is None or read_catalog_version() == catalog_version:
+        return False
+
+    log.info("Media catalog changed, reloading it for the next extension")
+    catalog = None
+    media_pools.clear()
+    media_ids.clear()
+    channel_timelines.clear()
+    return True
+
+def select_items(expression):
+    """
+    Selects every media item matching a channel filter
+
+    Args:
+        expression (string): Channel filter, i.e. 'tv, movie' or 'action+movie' (see tagindex.parse_filter)
+
+    Returns:
+        items (list): List of dictionaries, no duplicates
+
+    Example:
+        select_items("action+movie")
+    """
+
+    current_catalog = get_catalog()
+    return [current_catalog["items"][i] for i in load_media_pool(expression)]
+
+def load_media_pool(expression):
+    """
+    Catalog positions matching a channel filter, evaluated once per build. Selection
+    works on the catalog's duration and last played arrays at these positions.
+
+    Args:
+        expression (string): Channel filter
+
+    Returns:
+        positions (ndarray): Positions into the catalog
+
+    Example:
+        load_media_pool("commercial+!filler")
+    """
+
+    if expression not in media_pools:
+        media_pools[expression] = tagindex.select_positions(get_catalog(), expression)
+    return media_pools[expression]
+
+def mark_played(filepath, played_at, table=None):
+    """
+    Updates LastPlayed for filepath in the loaded catalog, and queues the database
+    update for flush_schedule() when table is given
+    """
+    i = get_catalog()["index"].get(filepath)
+    if i is not None:
+        catalog["last_played"][i] = played_at
+    if table:
+        pending_last_played.setdefault(table, {})[filepath] = datetime.fromtimestamp(played_at).strftime("%Y-%m-%d %H:%M:%S")
+
+def get_recency_weights(last_played):
+    """
+    Weighs items by seconds since they were last played, never played items get 10000
+
+    Args:
+        last_played (ndarray): Epoch of last play, NaN if never played
+
+    Returns:
+        weights (ndarray)
+    """
+
+    weights = np.maximum(time.time() - last_played, 1)
+    weights[np.isnan(last_played)] = 10000
+    return weights
+
+def weighted_sample(weights, k):
+    """
+    Samples k positions without replacement, weighted, in one vectorized pass
+    (Efraimidis-Spirakis keys: largest log(u) / weight wins)
+
+    Args:
+        weights (ndarray): Weight per candidate
+        k (integer): Sample size, capped at the number of candidates
+
+    Returns:
+        positions (ndarray): Positions of the selected candidates, in sampled order
+    """
+
+    k = min(k, len(weights))
+    if k == 0:
+        return np.array([], dtype=np.int64)
+    keys = np.log(rng.random(len(weights))) / weights
+    top = np.argpartition(-keys, k - 1)[:k]
+    return top[np.argsort(-keys[top])]
+
 def select_weighted_movie(tags):
     """
     Selects a movie, filtered by tags, based on the LastPlayed datetime
 
     Args:
-        tags (list):  Strings of tags in which to search the movie database for
+        tags (list):  Strings of tags, movies must carry all of them
 
     Returns:
-        selected_movies (list): Sample of 20 movies
+        selected_movies (list): Sample of 20 movies, most likely first
 
     Raises:
         None
@@ -898,31 +963,15 @@ def select_weighted_movie(tags):
         select_weighted_movie(["movie", "action"])
     """
 
-    # Search database for tags
-    all_movies = []
-    for tag in tags:
-        table, data = zip(*search_database(tag))
-        data = [json.loads(d) for d in data]
-        for item in data:
-            all_movies.append(item)
-
-    # Created weighted list based on LastPlayed datetime
-    weighted_list = []
-    for movie in all_movies:
-        if movie["LastPlayed"]:
-            last_played = datetime.strptime(movie["LastPlayed"], "%Y-%m-%d %H:%M:%S")
-            time_difference = (datetime.now() - last_played).total_seconds()
-            weight = max(time_difference, 1)
-        else:
-            weight = 10000
-        weighted_list.append((movie["Filepath"], weight, movie["LastPlayed"], movie["Runtime"]))
+    # Movies carrying every tag
+    positions = load_media_pool("+".join(tags))
+    items = get_catalog()["items"]
 
-    sorted_list = sorted(weighted_list, key=lambda tup: tup[1], reverse=True)
+    # Create weighted sample of 20 movies based on LastPlayed datetime
+    weights = get_recency_weights(catalog["last_played"][positions])
+    selected = weighted_sample(weights, 20)
 
-    # Create sample of 20 movies
-    selected_movies = random.sample(sorted_list, 20)
-
-    return selected_movies
+    return [items[positions[k]] for k in selected]
 
 def select_commercial(max_break):
     """
@@ -932,7 +981,9 @@ def select_commercial(max_break):
         max_break (timedelta):  Max time for commercial break
 
     Returns:
-        selected_commercial (list): A single commercial's metadata from the database
+        selected_commercial (dictionary): A single commercial's metadata from the database
+        OR
+        None (if no commercial fits max_break)
 
     Raises:
         None
@@ -940,53 +991,30 @@ def select_commercial(max_break):
     Example:
         select_commercial(max_break)
     """
-    # Open the database
-    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
-    cursor = conn.cursor()
 
     # Get all commercials
-    all_comms = [json.loads(data) for table, data in search_database("commercial") if "filler" not in json.loads(data)["Tags"]]
-    # all_comms = []
-    # for r in search_database("commercial"):
-    #     all_comms
-    #     table, data = r
-    #     all_comms.append(json.loads(data))
-
-    # Try and find commercials that match max_break
-    # log.debug(f"Looking for commercials that match {seconds_to_hms(max_break.total_seconds())}")
-    all_comms_fit = [c for c in all_comms if c["Runtime"] == seconds_to_hms(max_break.total_seconds())]
-    # log.debug(f"All Comms Fit: {len(all_comms_fit)}")
-
-    # If no exact matches, get all commercials that are less than max_break
-    if len(all_comms_fit) == 0:
-        # log.debug(f"Could not find a commercial for {seconds_to_hms(max_break.total_seconds())}")
-        all_comms = [c for c in all_comms if c["Runtime"] < seconds_to_hms(max_break.total_seconds())]
-    # log.debug(f"All Comms: {len(all_comms)}")
+    positions = load_media_pool("commercial+!filler")
+    durations = get_catalog()["duration"][positions]
+    max_break_seconds = int(max_break.total_seconds())
+
+    # Try and find commercials that match max_break, otherwise all commercials that are less than max_break
+    fit = durations == max_break_seconds
+    if not fit.any():
+        fit = durations < max_break_seconds
+    candidates = positions[fit]
+    if len(candidates) == 0:
+        log.debug(f"No commercial fits {seconds_to_hms(max_break_seconds)}")
+        return None
 
     # Weigh all commercials based on LastPlayed
-    weighted_list = []
-    # {'ID': 1, 'Tags': 'commercial,games', 'Runtime': '00:00:29', 'Filepath': '/media/ascott/USB/bumpers/Games/Gaming-19.mp4', 'LastPlayed': '2025-02-06 15:18:11'}
-    for comm in all_comms:
-        if comm["LastPlayed"]:
-            last_played = datetime.strptime(comm["LastPlayed"], "%Y-%m-%d %H:%M:%S")
-            time_difference = (datetime.now() - last_played).total_seconds()
-            weight = max(time_difference, 1)
-        else:
-            weight = 10000
-
-        weighted_list.append((comm["Filepath"], weight, comm["Runtime"]))
-
-    filepaths, weights, runtimes = zip(*weighted_list)
-    selected = random.choices(filepaths, weights=weights, k=1)[0]
+    weights = get_recency_weights(catalog["last_played"][candidates])
+    selected = candidates[rng.choice(len(candidates), p=weights / weights.sum())]
+    selected_commercial = catalog["items"][selected]
 
     # Update LastPlayed with Datetime.Now timestamp
-    now_str = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
-    cursor.execute(f"Update COMMERCIALS SET LastPlayed = '{now_str}' WHERE Filepath = '{selected}'")
-    conn.commit()
-    conn.close()
+    mark_played(selected_commercial["Filepath"], time.time(), "COMMERCIALS")
 
     # Return the selected commercial
-    selected_commercial = [c for c in all_comms if c["Filepath"] == selected][0]
     return selected_commercial
 
 def add_final_filler(marker, next_play_time, time_remaining, channel_number):
@@ -1014,9 +1042,106 @@ def add_final_filler(marker, next_play_time, time_remaining, channel_number):
     return next_play_time
                 
 
+def run_channel(channel_name, channel_config, marker, channel_end_datetime):
+    """
+    Materializes a channel's timeline from marker until channel_end_datetime. The
+    timeline is kept so the next extension continues where this one stopped.
+
+    Args:
+        channel_name (string): Name of the channel in the channel file
+        channel_config (dictionary): Channel definition from the channel file
+        marker (datetime): Where to start, the end of the channel's last scheduled item
+        channel_end_datetime (datetime): Materialize up to here
+
+    Returns:
+        marker (datetime): Where the channel's materialized timeline ends
+
+    Example:
+        run_channel("motion", channel_data["motion"], marker, channel_end_datetime)
+    """
+
+    channel_number = channel_config["channel_number"]
+    start_marker = marker
+    total_seconds = (channel_end_datetime - marker).total_seconds()
+
+    # Continue the running timeline if it ends where the schedule does
+    timeline, timeline_end = channel_timelines.get(channel_number, (None, None))
+    if timeline is None or timeline_end != marker:
+        timeline = channel_timeline(channel_name, channel_config, marker)
+
+    rows = []
+    with Progress() as progress:
+        task = progress.add_task(f"[green]Scheduling {channel_name} ...", total=total_seconds)
+
+        for row in timeline:
+            rows.append(row)
+            if heartbeat_name:
+                heartbeat.beat(heartbeat_name, status=f"building {channel_name}")
+            marker = datetime.strptime(row[2], "%Y-%m-%d %H:%M:%S")
+            progress.update(task, completed=min(total_seconds, (marker - start_marker).total_seconds()))
+            if marker >= channel_end_datetime:
+                break
+
+    channel_timelines[channel_number] = (timeline, marker)
+    pending_schedule_rows.extend(rows)
+    flush_schedule()
+    return marker
+
+def extend_schedule():
+    """
+    Tops every channel up to SCHEDULE_WINDOW_HOURS ahead of now, continuing each
+    channel from its last scheduled item, and refreshes the affected guide slices
+
+    Args:
+        None
+
+    Returns:
+        None
+
+    Example:
+        extend_schedule()
+    """
+
+    now = datetime.now()
+    horizon = now + schedule_window
+
+    with open(channel_file, "r") as channel_file_input:
+        channel_data = json.load(channel_file_input)
+
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    cursor = conn.cursor()
+    cursor.execute("SELECT Channel, MAX(End) FROM SCHEDULE GROUP BY Channel")
+    last_ends = {channel: datetime.strptime(end, "%Y-%m-%d %H:%M:%S") for channel, end in cursor.fetchall()}
+    conn.close()
+
+    extended_days = set()
+    for channel_name, channel_config in channel_data.items():
+        channel_number = channel_config["channel_number"]
+        # Channels that ran dry start over from the top of the hour
+        marker = max(last_ends.get(channel_number, datetime.min), now.replace(minute=0, second=0, microsecond=0))
+        if marker >= horizon:
+            continue
+
+        log.info(f"Extending schedule for {channel_name} - {channel_number} from {marker}")
+        profiling.set_channel(channel_name)
+        with metrics.timer("solostation_schedule_build_seconds", channel=channel_number):
+            end = run_channel(channel_name, channel_config, marker, horizon)
+
+        day = marker.replace(hour=0, minute=0, second=0)
+        while day <= end:
+            extended_days.add(day.strftime("%Y-%m-%d"))
+            day += timedelta(days=1)
+
+    # Pre-render the guide for the days that were just extended
+    if extended_days:
+        profiling.set_channel("guide")
+        with profiling.phase("materialize_guide"):
+            guide.materialize_guide(days=sorted(extended_days))
+
 def create_schedule():
     """
-    Creates a schedule for all channels
+    Rebuilds the schedule for all channels when any channel has nothing playing,
+    materializing SCHEDULE_WINDOW_HOURS from the top of the current hour
 
     Args:
 
@@ -1029,50 +1154,147 @@ def create_schedule():
     Example:
         create_schedule()
     """
-    global marker
+    global catalog
 
     # Clear old items in the schedule
     if check_schedule_for_rebuild():
-        # Read in channel json file
-        # log.debug("Opening the channel file")
-        with open(channel_file, "r") as channel_file_input:
-            channel_data = json.load(channel_file_input)
-
-        # Parse channel information
-        for channel_metadata in channel_data:
-            channel_name = channel_metadata
-            channel_number = channel_data[channel_name]["channel_number"]
-            channel_commercials = channel_data[channel_name]["commercials"]
-            channel_tags = map(str, channel_data[channel_name]["tags"].split(", "))
-
-            log.info(f"Building schedule for {channel_name} - {channel_number}")
-
-            # Set marker and channel end datetime
-            marker = datetime.now().replace(hour = 0, minute = 0, second = 0, microsecond = 0)
-            channel_end_datetime = marker + timedelta(days = 1, seconds=1)
-
-            match channel_number:
-                case 2:
-                    schedule_channel2(channel_number, marker, channel_end_datetime, channel_tags)
-                    continue
-                case 3:
-                    schedule_loud(channel_number, marker, channel_end_datetime)
-                    continue
-                case 4:
-                    schedule_motion(channel_number, marker, channel_end_datetime)
-                    continue
-                case 5:
-                    schedule_bang(channel_number, marker, channel_end_datetime)
-                    continue
-                case 6:
-                    schedule_ppv(channel_number, marker, channel_end_datetime)
-                    continue
-                case 7:
-                    schedule_ppv(channel_number, marker, channel_end_datetime)
-                    continue
-                case 8:
-                    schedule_ppv(channel_number, marker, channel_end_datetime)
-                    continue
+        profiling.start()
+
+        # Reload the catalog so newly ingested media is picked up
+        catalog = None
+        media_pools.clear()
+        media_ids.clear()
+
+        # Start every timeline over from the top of the hour
+        channel_timelines.clear()
+        clear_schedule_table()
+        extend_schedule()
+
+        profiling.stop()
+
+def update_schedule():
+    """
+    One check of the schedule worker: rebuilds the schedule if any channel has
+    nothing playing, extends it when it runs short, and then trims what has
+    already aired, so only a short window stays in SCHEDULE
+
+    Args:
+        None
+
+    Returns:
+        (bool) - True if the schedule table changed
+
+    Example:
+        update_schedule()
+    """
+
+    reload_if_catalog_changed()
+    if check_schedule_for_rebuild():
+        create_schedule()
+    elif needs_extension():
+        extend_schedule()
+    else:
+        return False
+
+    clear_old_schedule_items()
+    return True
+
+def run_worker(check_interval, on_update=None, wake=None, name=None):
+    """
+    Keeps the schedule built and extended forever: checks every check_interval
+    seconds, or as soon as wake is set, and reloads the catalog when the media
+    manager changed the library
+
+    Args:
+        check_interval (float): Seconds between checks
+        on_update (function): Called after the schedule table changed
+        wake (threading.Event): Optional event that triggers an early check
+        name (string): Heartbeat name to report progress under, i.e. 'scheduler'
+
+    Returns:
+        None
+
+    Example:
+        run_worker(60, name="scheduler")
+    """
+
+    global heartbeat_name
+
+    heartbeat_name = name
+    initialize_schedule_db()
+    while True:
+        if name:
+            heartbeat.beat(name, status="checking", force=True)
+        try:
+            if update_schedule() and on_update:
+                on_update()
+        except Exception as e:
+            log.error(f"Schedule worker error: {e}")
+
+        # Sleep until the next check, still beating while idle
+        deadline = time.monotonic() + check_interval
+        while time.monotonic() < deadline:
+            if name:
+                heartbeat.beat(name, status="idle")
+            wait = min(deadline - time.monotonic(), heartbeat.heartbeat_interval)
+            if wake is not None:
+                if wake.wait(max(0, wait)):
+                    wake.clear()
+                    break
+            else:
+                time.sleep(max(0, wait))
+
+def instrument_schedule():
+    """
+    Wraps each scheduling phase and database call with profiling timers.
+    Called on import when SCHEDULE_PROFILE is set, or by --profile.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    global get_chapters, get_keyframes, insert_into_schedule, flush_schedule, select_commercial, select_weighted_movie
+    global standard_commercial_break, post_episode, post_movie, add_post_movie, Progress
+
+    get_chapters = profiling.wrap(get_chapters)
+    get_keyframes = profiling.wrap(get_keyframes)
+    insert_into_schedule = profiling.wrap(insert_into_schedule)
+    flush_schedule = profiling.wrap(flush_schedule)
+    select_commercial = profiling.wrap(select_commercial)
+    select_weighted_movie = profiling.wrap(select_weighted_movie)
+    standard_commercial_break = profiling.wrap(standard_commercial_break)
+    post_episode = profiling.wrap(post_episode)
+    post_movie = profiling.wrap(post_movie)
+    add_post_movie = profiling.wrap(add_post_movie)
+    Progress = profiling.wrap_class(Progress, "rich_progress", ["__enter__", "__exit__", "add_task", "update"])
+
+if profiling.profile_enabled:
+    instrument_schedule()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the SoloStation schedule")
+    parser.add_argument("--rebuild", action="store_true", help="Clear the schedule table before building")
+    parser.add_argument("--profile", action="store_true", help="Print and save a per-channel timing report")
+    parser.add_argument("--pstats", help="Also dump cProfile stats to this file")
+    parser.add_argument("--worker", action="store_true", help="Keep running, rebuilding and extending the schedule as needed")
+    args = parser.parse_args()
+
+    if (args.profile or args.pstats) and not profiling.profile_enabled:
+        profiling.enable(args.pstats)
+        instrument_schedule()
+    elif args.pstats:
+        profiling.enable(args.pstats)
+
+    initialize_schedule_db()
+    if args.rebuild:
+        clear_schedule_table()
+    if args.worker:
+        run_worker(float(os.getenv("SCHEDULE_CHECK_INTERVAL", 60)), name="scheduler")
+    else:
+        create_schedule()
 
 
 
@@ -0,0 +1,322 @@
+# Schedule Store
+import argparse
+import sqlite3
+import os
+import sys
+import tracemalloc
+import logging
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+log = logging.getLogger("rich")
+
+# Variables
+# Schedule times are naive local times, kept as whole seconds since this base
+# so no timezone conversion happens on the way in or out
+time_base = datetime(1970, 1, 1)
+
+# Functions
+def to_seconds(when):
+    """ Converts a naive datetime to schedule seconds """
+    return int((when - time_base).total_seconds())
+
+def from_seconds(seconds):
+    """ Converts schedule seconds back to a naive datetime """
+    return time_base + timedelta(seconds=seconds)
+
+class ScheduleItem:
+    """
+    One scheduled item, built on demand from the store. Supports item["key"]
+    access so it can stand in for the old schedule dictionaries.
+    """
+
+    __slots__ = ("index", "row_id", "channel", "showtime", "end", "media_id", "filepath", "chapter", "runtime")
+
+    def __init__(self, index, row_id, channel, showtime, end, media_id, filepath, chapter, runtime):
+        self.index = index
+        self.row_id = row_id
+        self.channel = channel
+        self.showtime = showtime
+        self.end = end
+        self.media_id = media_id
+        self.filepath = filepath
+        self.chapter = chapter
+        self.runtime = runtime
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        return isinstance(other, ScheduleItem) and self.row_id == other.row_id
+
+    def __repr__(self):
+        return f"ScheduleItem(channel={self.channel}, showtime={self.showtime}, end={self.end}, filepath={self.filepath!r}, chapter={self.chapter})"
+
+class ScheduleStore:
+    """
+    Compact, read-only copy of the SCHEDULE table. Rows are kept sorted by channel
+    then showtime in parallel arrays of integers; each file path is held once per
+    Media ID and runtimes are interned once and referenced by ID.
+    """
+
+    def __init__(self, rows=()):
+        """
+        Args:
+            rows (iterable): (ID, Channel, Showtime, End, MediaID, Filepath, Chapter, Runtime) tuples,
+            Showtime and End in schedule seconds, sorted by Channel then Showtime
+        """
+
+        self.row_ids = array("q")
+        self.channels = array("h")
+        self.showtimes = array("q")
+        self.ends = array("q")
+        self.media_ids = array("l")
+        self.chapters = array("h")
+        self.runtime_ids = array("l")
+        self.paths = {}
+        self.strings = []
+        self.string_ids = {}
+        self.channel_ranges = {}
+
+        for row in rows:
+            self.append(*row)
+
+    def intern(self, value):
+        """ ID of value in the shared string table """
+        string_id = self.string_ids.get(value)
+        if string_id is None:
+            string_id = self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return string_id
+
+    def append(self, row_id, channel, showtime, end, media_id, filepath, chapter, runtime):
+        """ Adds a row after the last one, rows must arrive sorted by channel then showtime """
+        index = len(self.channels)
+        lo, hi = self.channel_ranges.get(channel, (index, index))
+        self.channel_ranges[channel] = (lo, index + 1)
+
+        self.row_ids.append(row_id)
+        self.channels.append(channel)
+        self.showtimes.append(showtime)
+        self.ends.append(end)
+        self.media_ids.append(media_id)
+        self.paths.setdefault(media_id, filepath)
+        self.chapters.append(-1 if chapter is None else chapter)
+        self.runtime_ids.append(self.intern(runtime))
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __iter__(self):
+        for index in range(len(self.channels)):
+            yield self.item(index)
+
+    def item(self, index):
+        """ Builds the ScheduleItem at index """
+        chapter = self.chapters[index]
+        return ScheduleItem(
+            index,
+            self.row_ids[index],
+            self.channels[index],
+            from_seconds(self.showtimes[index]),
+            from_seconds(self.ends[index]),
+            self.media_ids[index],
+            self.paths[self.media_ids[index]],
+            None if chapter == -1 else chapter,
+            self.strings[self.runtime_ids[index]],
+        )
+
+    def channel_count(self, channel):
+        """ Number of items scheduled on channel """
+        lo, hi = self.channel_ranges.get(channel, (0, 0))
+        return hi - lo
+
+    def find(self, channel, when):
+        """
+        Finds the item airing on channel at when
+
+        Args:
+            channel (integer): Channel number
+            when (datetime): Time to look up
+
+        Returns:
+            index (integer): Position of the item in the store
+            OR
+            None (if nothing is scheduled on the channel at when)
+        """
+
+        lo, hi = self.channel_ranges.get(channel, (0, 0))
+        seconds = to_seconds(when)
+        index = bisect_right(self.showtimes, seconds, lo, hi) - 1
+        if index >= lo and seconds < self.ends[index]:
+            return index
+        return None
+
+    def playing_now(self, channel, when):
+        """ ScheduleItem airing on channel at when, or None """
+        index = self.find(channel, when)
+        return None if index is None else self.item(index)
+
+    def playing_next(self, item):
+        """ ScheduleItem following item on the same channel, or None """
+        lo, hi = self.channel_ranges[item.channel]
+        if item.index + 1 >= hi:
+            return None
+        return self.item(item.index + 1)
+
+    def playing_at(self, when):
+        """ ScheduleItem airing at when on every channel, sorted by channel """
+        items = [self.playing_now(channel, when) for channel in sorted(self.channel_ranges)]
+        return [item for item in items if item is not None]
+
+    def rows(self, channel, start, end):
+        """
+        Raw rows airing on channel between start and end, in the format the
+        store is built from, i.e. to cache part of the schedule elsewhere
+
+        Args:
+            channel (integer): Channel number
+            start (datetime): Start of the window
+            end (datetime): End of the window
+
+        Returns:
+            rows (list): (ID, Channel, Showtime, End, MediaID, Filepath, Chapter, Runtime) tuples
+        """
+
+        lo, hi = self.channel_ranges.get(channel, (0, 0))
+        first = max(lo, bisect_right(self.showtimes, to_seconds(start), lo, hi) - 1)
+        last = bisect_right(self.showtimes, to_seconds(end), lo, hi)
+        return [
+            (
+                self.row_ids[index],
+                channel,
+                self.showtimes[index],
+                self.ends[index],
+                self.media_ids[index],
+                self.paths[self.media_ids[index]],
+                None if self.chapters[index] == -1 else self.chapters[index],
+                self.strings[self.runtime_ids[index]],
+            )
+            for index in range(first, last)
+            if self.ends[index] > to_seconds(start)
+        ]
+
+    def version(self):
+        """ Highest SCHEDULE ID loaded, new rows always get a higher one """
+        return max(self.row_ids, default=0)
+
+    def nbytes(self):
+        """ Approximate memory held by the arrays and the string table """
+        arrays = [self.row_ids, self.channels, self.showtimes, self.ends, self.media_ids, self.chapters, self.runtime_ids]
+        return (
+            sum(a.itemsize * len(a) for a in arrays)
+            + sum(sys.getsizeof(s) for s in self.strings)
+            + sum(sys.getsizeof(s) for s in self.paths.values())
+            + sys.getsizeof(self.paths)
+            + sys.getsizeof(self.strings)
+            + sys.getsizeof(self.string_ids)
+        )
+
+def load_schedule(db_location=None):
+    """
+    Loads the whole SCHEDULE table into a ScheduleStore
+
+    Args:
+        db_location (string): Database path, defaults to DB_LOCATION
+
+    Returns:
+        store (ScheduleStore): Every scheduled item
+
+    Example:
+        live_schedule = load_schedule()
+        playing_now = live_schedule.playing_now(2, datetime.now())
+    """
+
+    conn = sqlite3.connect(db_location or os.getenv("DB_LOCATION"))
+    cursor = conn.cursor()
+
+    # SQLite reads the naive times as UTC, which is exactly schedule seconds
+    cursor.execute("""
+        SELECT s.ID, s.Channel, CAST(strftime('%s', s.Showtime) AS INTEGER), CAST(strftime('%s', s.End) AS INTEGER), s.MediaID, m.Path, s.Chapter, s.Runtime
+        FROM SCHEDULE s
+        JOIN MEDIA m ON m.ID = s.MediaID
+        ORDER BY s.Channel ASC, s.Showtime ASC
+    """)
+    store = ScheduleStore(cursor)
+    conn.close()
+
+    return store
+
+def get_schedule_version(db_location=None):
+    """ Highest ID in the SCHEDULE table, compare with ScheduleStore.version() """
+    conn = sqlite3.connect(db_location or os.getenv("DB_LOCATION"))
+    version, = conn.execute("SELECT MAX(ID) FROM SCHEDULE").fetchone()
+    conn.close()
+    return version or 0
+
+def load_schedule_dicts(db_location=None):
+    """ The previous representation, one dictionary per row, kept for the benchmark """
+    conn = sqlite3.connect(db_location or os.getenv("DB_LOCATION"))
+    cursor = conn.cursor()
+    cursor.execute("SELECT s.ID, s.Channel, s.Showtime, s.End, m.Path, s.Chapter, s.Runtime FROM SCHEDULE s JOIN MEDIA m ON m.ID = s.MediaID ORDER BY s.Showtime ASC")
+    all_scheduled_items = [{
+            "channel": row[1],
+            "showtime": datetime.strptime(str(row[2]), "%Y-%m-%d %H:%M:%S"),
+            "end": datetime.strptime(str(row[3]), "%Y-%m-%d %H:%M:%S"),
+            "filepath": row[4],
+            "chapter": row[5],
+            "runtime": row[6]
+    } for row in cursor.fetchall()]
+    conn.close()
+
+    return all_scheduled_items
+
+def measure(loader, *args):
+    """ Peak and retained traced memory, in bytes, of whatever loader returns """
+    tracemalloc.start()
+    result = loader(*args)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, retained, peak
+
+def benchmark(db_location=None):
+    """
+    Compares the memory held by the dictionary schedule and the ScheduleStore
+    for the schedule in db_location
+
+    Args:
+        db_location (string): Database path, defaults to DB_LOCATION
+
+    Returns:
+        results (dictionary): Rows, plus retained and peak bytes for each representation
+    """
+
+    dicts, dict_retained, dict_peak = measure(load_schedule_dicts, db_location)
+    store, store_retained, store_peak = measure(load_schedule, db_location)
+
+    results = {
+        "rows": len(store),
+        "filepaths": len(store.paths),
+        "dict_retained": dict_retained,
+        "dict_peak": dict_peak,
+        "store_retained": store_retained,
+        "store_peak": store_peak,
+    }
+
+    print(f"{results['rows']} rows, {results['filepaths']} distinct files")
+    print(f"dicts: {dict_retained / 1024:10.1f} KiB retained {dict_peak / 1024:10.1f} KiB peak {dict_retained / max(1, len(dicts)):7.1f} B/row")
+    print(f"store: {store_retained / 1024:10.1f} KiB retained {store_peak / 1024:10.1f} KiB peak {store_retained / max(1, len(store)):7.1f} B/row")
+    print(f"store uses {store_retained / max(1, dict_retained):.1%} of the dictionary memory")
+
+    return results
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Measure schedule memory use, dictionaries against the ScheduleStore")
+    parser.add_argument("--db", help="Database to read the schedule from, defaults to DB_LOCATION")
+    args = parser.parse_args()
+
+    benchmark(args.db)
@@ -0,0 +1,196 @@
+# Supervisor
+import argparse
+import subprocess
+import signal
+import sys
+import os
+import time
+import logging
+import heartbeat
+from dotenv import load_dotenv
+from rich.logging import RichHandler
+
+# Load env file
+load_dotenv()
+
+# Rich log
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+log_level = getattr(logging, log_level_str, logging.INFO)
+FORMAT = "%(message)s"
+logging.basicConfig(
+    level=log_level_str,
+    format=FORMAT,
+    datefmt="[%X]",
+    handlers=[RichHandler()]
+)
+log = logging.getLogger("rich")
+
+# Variables
+v2_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(v2_dir)
+check_interval = float(os.getenv("SUPERVISOR_INTERVAL", 1))
+stop_grace = float(os.getenv("SUPERVISOR_STOP_GRACE", 5))
+max_backoff = float(os.getenv("SUPERVISOR_MAX_BACKOFF", 30))
+stable_after = 60
+
+# Started in this order, the player doesn't wait on the scheduler
+processes = {
+    "scheduler": {
+        "command": [sys.executable, os.path.join(v2_dir, "schedule.py"), "--worker"],
+        "cwd": v2_dir,
+        "timeout": float(os.getenv("SCHEDULER_TIMEOUT", 300)),
+        "env": {},
+    },
+    "player": {
+        "command": [sys.executable, os.path.join(v2_dir, "play.py")],
+        "cwd": v2_dir,
+        "timeout": float(os.getenv("PLAYER_TIMEOUT", 20)),
+        "env": {"SCHEDULE_WORKER": "external"},
+    },
+    "dashboard": {
+        "command": [sys.executable, os.path.join(repo_dir, "APITest2.py")],
+        "cwd": repo_dir,
+        "timeout": float(os.getenv("DASHBOARD_TIMEOUT", 60)),
+        "env": {},
+    },
+}
+running = {}
+
+# Functions
+def start_process(name):
+    """
+    Starts one supervised process
+
+    Args:
+        name (string): Key in processes
+
+    Returns:
+        None
+    """
+
+    config = processes[name]
+    proc = subprocess.Popen(config["command"], cwd=config["cwd"], env={**os.environ, **config["env"]})
+    state = running.setdefault(name, {"failures": 0, "restart_at": 0})
+    state["proc"] = proc
+    state["started"] = time.time()
+    log.info(f"Started {name} (pid {proc.pid})")
+
+def stop_process(name):
+    """
+    Stops one supervised process, killing it if it doesn't exit within SUPERVISOR_STOP_GRACE seconds
+
+    Args:
+        name (string): Key in processes
+
+    Returns:
+        None
+    """
+
+    proc = running.get(name, {}).get("proc")
+    if proc is None or proc.poll() is not None:
+        return
+
+    proc.terminate()
+    try:
+        proc.wait(stop_grace)
+    except subprocess.TimeoutExpired:
+        log.warning(f"{name} ignored SIGTERM, killing it")
+        proc.kill()
+        proc.wait()
+
+def check_process(name, heartbeats):
+    """
+    Checks that a process is still running and still beating
+
+    Args:
+        name (string): Key in processes
+        heartbeats (dictionary): From heartbeat.get_heartbeats()
+
+    Returns:
+        reason (string): Why the process needs restarting
+        OR
+        None (if it is healthy)
+    """
+
+    state = running[name]
+    proc = state["proc"]
+    if proc.poll() is not None:
+        return f"exited with code {proc.returncode}"
+
+    # A beat from an earlier instance doesn't count, new instances get the whole timeout to start
+    pid, last_beat, status = heartbeats.get(name, (None, 0, None))
+    if pid != proc.pid:
+        last_beat = 0
+    silence = time.time() - max(last_beat, state["started"])
+    if silence > processes[name]["timeout"]:
+        return f"no heartbeat for {silence:.0f}s (last status: {status})"
+
+    return None
+
+def schedule_restart(name, reason):
+    """ Stops a failed process and picks when to start it again, backing off if it keeps failing """
+    state = running[name]
+    log.error(f"Restarting {name}: {reason}")
+    stop_process(name)
+
+    if time.time() - state["started"] < stable_after:
+        state["failures"] += 1
+    else:
+        state["failures"] = 1
+
+    # The first restart is immediate, repeated failures back off up to SUPERVISOR_MAX_BACKOFF
+    delay = 0 if state["failures"] <= 1 else min(max_backoff, 2 ** (state["failures"] - 2))
+    state["restart_at"] = time.time() + delay
+    state["proc"] = None
+
+def shutdown(signum, frame):
+    """ Stops every process and exits """
+    log.info("Stopping all processes")
+    for name in reversed(list(running)):
+        stop_process(name)
+    sys.exit(0)
+
+def supervise(names):
+    """
+    Runs the given processes and restarts any that exit or stop beating
+
+    Args:
+        names (list): Keys in processes to run
+
+    Returns:
+        None
+
+    Example:
+        supervise(["scheduler", "player", "dashboard"])
+    """
+
+    heartbeat.initialize_heartbeat_db()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for name in names:
+        start_process(name)
+
+    while True:
+        time.sleep(check_interval)
+        heartbeats = heartbeat.get_heartbeats()
+
+        for name in names:
+            state = running[name]
+            if state["proc"] is None:
+                if time.time() >= state["restart_at"]:
+                    start_process(name)
+                continue
+
+            reason = check_process(name, heartbeats)
+            if reason:
+                schedule_restart(name, reason)
+                if state["restart_at"] <= time.time():
+                    start_process(name)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the SoloStation player, scheduler and dashboard with watchdogs")
+    parser.add_argument("--skip", nargs="*", default=[], choices=list(processes), help="Processes not to run")
+    args = parser.parse_args()
+
+    supervise([name for name in processes if name not in args.skip])
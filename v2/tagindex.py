@@ -0,0 +1,156 @@
+# Tag Index
+import json
+import sqlite3
+import os
+import logging
+from datetime import datetime
+import numpy as np
+import media
+
+log = logging.getLogger("rich")
+
+# Functions
+def load_catalog():
+    """
+    Loads every media item once and indexes its tags as a bitmask, one bit per tag
+
+    Args:
+        None
+
+    Returns:
+        catalog (dictionary):
+            'items' (list of dictionaries): Media metadata, 'Table' being the source table
+            'tags' (dictionary): Tag to bit number
+            'masks' (ndarray): uint64 words of tag bits, one row per item
+            'duration' (ndarray): Runtime in seconds
+            'last_played' (ndarray): Epoch of last play, NaN if never played
+            'index' (dictionary): Filepath to position
+
+    Example:
+        catalog = load_catalog()
+    """
+
+    conn = sqlite3.connect(os.getenv("DB_LOCATION"))
+    cursor = conn.cursor()
+
+    items = []
+    for table, data in media.select_library(cursor):
+        item = json.loads(data)
+        item["Table"] = table
+        items.append(item)
+    conn.close()
+
+    # Assign each tag a bit
+    item_tags = [[t.strip().lower() for t in (item["Tags"] or "").split(",") if t.strip()] for item in items]
+    tags = {}
+    for item_tag_list in item_tags:
+        for tag in item_tag_list:
+            if tag not in tags:
+                tags[tag] = len(tags)
+
+    words = max(1, (len(tags) + 63) // 64)
+    masks = np.zeros((len(items), words), dtype=np.uint64)
+    for i, item_tag_list in enumerate(item_tags):
+        for tag in item_tag_list:
+            bit = tags[tag]
+            masks[i, bit // 64] |= np.uint64(1) << np.uint64(bit % 64)
+
+    catalog = {
+        "items": items,
+        "tags": tags,
+        "masks": masks,
+        "duration": np.array([time_str_to_seconds(item["Runtime"]) for item in items], dtype=np.int64),
+        "last_played": np.array([
+            datetime.strptime(item["LastPlayed"], "%Y-%m-%d %H:%M:%S").timestamp() if item.get("LastPlayed") else np.nan
+            for item in items
+        ], dtype=np.float64),
+        "index": {item["Filepath"]: i for i, item in enumerate(items)},
+    }
+
+    log.info(f"Indexed {len(items)} media items with {len(tags)} tags")
+    return catalog
+
+def time_str_to_seconds(time_str):
+    """ Converts time formatted string to number of seconds  """
+    if not time_str:
+        return 0
+    h, m, s = map(int, time_str.split(":"))
+    return h * 3600 + m * 60 + s
+
+def parse_filter(expression):
+    """
+    Parses a channel filter into OR groups of AND terms
+
+    ',' separates alternatives, '+' requires every tag, '!' excludes a tag.
+    i.e. 'tv, movie' is tv OR movie, 'action+movie' is action AND movie,
+    'commercial+!filler' is commercial AND NOT filler
+
+    Args:
+        expression (string): Channel filter
+
+    Returns:
+        groups (list): Lists of (negated, tag) tuples
+
+    Example:
+        parse_filter("action+movie, tv+!kids")
+    """
+
+    groups = []
+    for group in expression.split(","):
+        terms = []
+        for term in group.split("+"):
+            term = term.strip().lower()
+            if not term:
+                continue
+            if term.startswith("!"):
+                terms.append((True, term[1:].strip()))
+            else:
+                terms.append((False, term))
+        if terms:
+            groups.append(terms)
+    return groups
+
+def evaluate_filter(catalog, expression):
+    """
+    Evaluates a channel filter over the whole catalog with bitwise operations
+
+    Args:
+        catalog (dictionary): Catalog from load_catalog()
+        expression (string): Channel filter, see parse_filter()
+
+    Returns:
+        matches (ndarray): Boolean mask, one entry per catalog item
+
+    Example:
+        evaluate_filter(catalog, "action+movie")
+    """
+
+    masks = catalog["masks"]
+    matches = np.zeros(len(masks), dtype=bool)
+
+    for group in parse_filter(expression):
+        required = np.zeros(masks.shape[1], dtype=np.uint64)
+        excluded = np.zeros(masks.shape[1], dtype=np.uint64)
+        unknown_required = False
+
+        for negated, tag in group:
+            bit = catalog["tags"].get(tag)
+            if bit is None:
+                # Nothing carries an unknown tag
+                unknown_required = unknown_required or not negated
+                continue
+            word_mask = np.uint64(1) << np.uint64(bit % 64)
+            if negated:
+                excluded[bit // 64] |= word_mask
+            else:
+                required[bit // 64] |= word_mask
+
+        if unknown_required:
+            continue
+        matches |= np.all((masks & required) == required, axis=1) & np.all((masks & excluded) == 0, axis=1)
+
+    return matches
+
+def select_positions(catalog, expression):
+    """ Catalog positions of every item matching the channel filter """
+    return np.flatnonzero(evaluate_filter(catalog, expression))
@@ -0,0 +1,84 @@
+# Guide Tests
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+import guide
+import schedule
+from test_schedule import Clock, create_library
+
+class GuideTest(unittest.TestCase):
+    channels = {"ppv": {"channel_number": 6, "commercials": "false", "tags": "movie", "strategy": "loop", "breaks": "none"}}
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.db_location = os.path.join(self.temp.name, "solo.db")
+        channel_file = os.path.join(self.temp.name, "channels.json")
+        with open(channel_file, "w") as file:
+            json.dump(self.channels, file)
+        create_library(self.db_location)
+
+        Clock.current = datetime(2025, 4, 9, 0, 30)
+        patches = [
+            mock.patch.dict(os.environ, {"DB_LOCATION": self.db_location, "FILLER_VIDEO": "/media/filler.mp4"}),
+            mock.patch.object(schedule, "channel_file", channel_file),
+            mock.patch.object(schedule, "datetime", Clock),
+            mock.patch.object(guide, "datetime", Clock),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        schedule.catalog = None
+        schedule.media_pools.clear()
+        schedule.media_ids.clear()
+        schedule.channel_timelines.clear()
+        schedule.initialize_schedule_db()
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def test_loop_channel_matches_schedule(self):
+        # Yesterday's title runs until 01:00, today's is anchored there, and the
+        # schedule is rebuilt from midnight, so filler airs until the anchor
+        conn = sqlite3.connect(self.db_location)
+        conn.executemany("INSERT INTO CHANNEL_RULES (Channel, Day, Filepath, Runtime, Anchor) VALUES (6, ?, ?, '01:30:00', ?)", [
+            ("2025-04-08", "/media/movies/Movie0 (1990)/Movie0.mp4", "2025-04-08 22:00:00"),
+            ("2025-04-09", "/media/movies/Movie1 (1990)/Movie1.mp4", "2025-04-09 01:00:00"),
+        ])
+        conn.commit()
+        conn.close()
+
+        schedule.update_schedule()
+
+        conn = sqlite3.connect(self.db_location)
+        grid, = conn.execute("SELECT Grid FROM GUIDE WHERE Channel = 6 AND Day = '2025-04-09'").fetchone()
+        grid = json.loads(grid)
+        rows = conn.execute("""
+            SELECT s.Showtime, s.End, m.Name FROM SCHEDULE s
+            JOIN MEDIA md ON md.ID = s.MediaID
+            LEFT JOIN MOVIE m ON md.Kind = 'MOVIE' AND m.ID = md.ItemID
+            WHERE s.Channel = 6 ORDER BY s.Showtime ASC
+        """).fetchall()
+        conn.close()
+
+        day_start = datetime(2025, 4, 9)
+        seconds = lambda text: int((datetime.strptime(text, "%Y-%m-%d %H:%M:%S") - day_start).total_seconds())
+        self.assertEqual((rows[0][0], rows[0][2]), ("2025-04-09 00:00:00", None))
+
+        # Where the schedule is materialized the guide shows exactly what airs
+        scheduled = [[seconds(showtime), seconds(end), name, "MOVIE"] for showtime, end, name in rows if name is not None]
+        materialized_end = seconds(rows[-1][1])
+        self.assertEqual([item for item in grid["items"] if item[0] < materialized_end], scheduled)
+        self.assertEqual(grid["cells"][:2], [-1, -1])
+
+        # The rules carry the rest of the day
+        self.assertGreater(len(grid["items"]), len(scheduled))
+        self.assertGreaterEqual(grid["items"][-1][1], 24 * 3600)
+        self.assertTrue(all(item[2] == "Movie1" for item in grid["items"]))
+
+if __name__ == "__main__":
+    unittest.main()
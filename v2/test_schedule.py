@@ -0,0 +1,95 @@
+# Schedule Tests
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+import guide
+import schedule
+
+class Clock(datetime):
+    """ datetime whose now() is set by the test """
+    current = datetime(2025, 4, 9, 0, 30)
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+def create_library(db_location, movies=10):
+    """ Empty library tables, the way the media manager creates them, with a few 90 minute movies """
+    conn = sqlite3.connect(db_location)
+    conn.executescript("""
+        CREATE TABLE COMMERCIALS(ID INTEGER PRIMARY KEY AUTOINCREMENT, Tags TEXT, Runtime TEXT, Filepath TEXT, LastPlayed TEXT);
+        CREATE TABLE MUSIC(ID INTEGER PRIMARY KEY AUTOINCREMENT, Tags TEXT, Artist TEXT, Title TEXT, Runtime TEXT, Filepath TEXT);
+        CREATE TABLE WEB(ID INTEGER PRIMARY KEY AUTOINCREMENT, Tags TEXT, Runtime TEXT, Filepath TEXT, LastPlayed TEXT);
+        CREATE TABLE TV(ID INTEGER PRIMARY KEY AUTOINCREMENT, Name TEXT, ShowName TEXT, Season INTEGER, Episode INTEGER, Overview TEXT, Tags TEXT, Runtime TEXT, Filepath TEXT, LastPlayed TEXT);
+        CREATE TABLE CHAPTERS(ID INTEGER PRIMARY KEY AUTOINCREMENT, EpisodeID INTEGER, Title TEXT, Start TEXT, End INT);
+        CREATE TABLE MOVIE(ID INTEGER PRIMARY KEY AUTOINCREMENT, Name TEXT, Year TEXT, Overview TEXT, Tags TEXT, Runtime TEXT, Filepath TEXT, LastPlayed TEXT);
+    """)
+    conn.executemany(
+        "INSERT INTO MOVIE (Name, Year, Overview, Tags, Runtime, Filepath) VALUES (?, '1990', '', 'movie', ?, ?)",
+        [(f"Movie{i}", "01:30:00", f"/media/movies/Movie{i} (1990)/Movie{i}.mp4") for i in range(movies)],
+    )
+    conn.commit()
+    conn.close()
+
+class ScheduleTest(unittest.TestCase):
+    channels = {"ppv": {"channel_number": 6, "commercials": "false", "tags": "movie", "strategy": "loop", "breaks": "none"}}
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.db_location = os.path.join(self.temp.name, "solo.db")
+        channel_file = os.path.join(self.temp.name, "channels.json")
+        with open(channel_file, "w") as file:
+            json.dump(self.channels, file)
+        create_library(self.db_location)
+
+        Clock.current = datetime(2025, 4, 9, 0, 30)
+        patches = [
+            mock.patch.dict(os.environ, {"DB_LOCATION": self.db_location, "FILLER_VIDEO": "/media/filler.mp4"}),
+            mock.patch.object(schedule, "channel_file", channel_file),
+            mock.patch.object(schedule, "datetime", Clock),
+            mock.patch.object(guide, "datetime", Clock),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        schedule.catalog = None
+        schedule.media_pools.clear()
+        schedule.media_ids.clear()
+        schedule.channel_timelines.clear()
+        schedule.initialize_schedule_db()
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def count(self, table):
+        conn = sqlite3.connect(self.db_location)
+        rows, = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+        conn.close()
+        return rows
+
+    def test_window_stays_bounded(self):
+        counts = []
+        # Three days of checks, three hours apart
+        for check in range(24):
+            schedule.update_schedule()
+            counts.append((self.count("SCHEDULE"), self.count("CHANNEL_RULES"), self.count("GUIDE")))
+
+            conn = sqlite3.connect(self.db_location)
+            oldest, = conn.execute("SELECT MIN(End) FROM SCHEDULE").fetchone()
+            conn.close()
+            self.assertGreaterEqual(datetime.strptime(oldest, "%Y-%m-%d %H:%M:%S"), Clock.current - timedelta(hours=6))
+            Clock.current += timedelta(hours=3)
+
+        # Up to 6 hours aired, before the next trim, and 9 ahead, in 90 minute showings
+        self.assertLessEqual(max(rows for rows, rules, days in counts), 11)
+        # The day before the cutoff, the cutoff day and the day ahead
+        self.assertLessEqual(max(rules for rows, rules, days in counts), 3)
+        self.assertLessEqual(max(days for rows, rules, days in counts), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+# TVDB Fetch Tests
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import tvdbfetch
+
+# Fake TVDB
+class FakeTVDBHandler(BaseHTTPRequestHandler):
+    """ Answers the few TVDB v4 endpoints tvdbfetch uses """
+
+    def send_json(self, code, data):
+        body = json.dumps({"status": "success" if code == 200 else "failure", "data": data}).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def record(self):
+        """ Logs the request and returns the error code to fail it with, if any """
+        server = self.server
+        with server.lock:
+            server.requests.append((time.monotonic(), self.command, self.path))
+            failures = server.failures.get(urlparse(self.path).path, 0)
+            if failures:
+                server.failures[urlparse(self.path).path] = failures - 1
+                return server.failure_code
+        return None
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        code = self.record()
+        if code:
+            return self.send_json(code, None)
+        self.send_json(200, {"token": "fake-token"})
+
+    def do_GET(self):
+        code = self.record()
+        if code:
+            return self.send_json(code, None)
+
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")[1:]
+        if parts[0] == "art":
+            body = f"art {parts[1]}".encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.headers.get("Authorization") != "Bearer fake-token":
+            return self.send_json(401, None)
+
+        if parts[0] == "search":
+            query = parse_qs(url.query)["query"][0]
+            self.send_json(200, [{"type": "series", "year": "1994", "tvdb_id": "79168", "name": query}])
+        elif parts[0] == "series" and parts[2] == "episodes":
+            episodes = [{"seasonNumber": 1, "number": n, "name": f"Episode {n}"} for n in range(1, 4)]
+            self.send_json(200, {"series": {"id": parts[1]}, "episodes": episodes})
+        elif parts[0] == "series" and parts[2] == "extended":
+            self.send_json(200, {"id": parts[1], "genres": [{"name": "Comedy"}]})
+        else:
+            self.send_json(404, None)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeTVDB:
+    """
+    Local TVDB v4 server on a free port
+
+    Example:
+        with FakeTVDB() as server:
+            tvdbfetch.api_url = server.url
+    """
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeTVDBHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.failures = {}
+        self.server.failure_code = 503
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v4"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail(self, path, times, code=503):
+        """ Answers the next requests to path with code """
+        with self.server.lock:
+            self.server.failures[urlparse(f"{self.url}/{path}").path] = times
+            self.server.failure_code = code
+
+    def requests(self, command=None):
+        """ (time, command, path) of every request so far """
+        with self.server.lock:
+            return [r for r in self.server.requests if command is None or r[1] == command]
+
+# Tests
+class TVDBFetchTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = {name: getattr(tvdbfetch, name) for name in ("api_url", "cache_dir", "rate", "burst", "concurrency", "token")}
+        self.temp = tempfile.TemporaryDirectory()
+        self.fake = FakeTVDB().__enter__()
+
+        tvdbfetch.api_url = self.fake.url
+        tvdbfetch.cache_dir = os.path.join(self.temp.name, "cache")
+        tvdbfetch.token = None
+
+    def tearDown(self):
+        self.fake.__exit__(None, None, None)
+        self.temp.cleanup()
+        for name, value in self.settings.items():
+            setattr(tvdbfetch, name, value)
+
+    def show_args(self, name):
+        return (name, "1994", os.path.join(self.temp.name, f"{name}.json"), os.path.join(self.temp.name, f"{name}-extended.json"))
+
+    def test_rate_limit(self):
+        tvdbfetch.rate = 10
+        tvdbfetch.burst = 2
+        tvdbfetch.concurrency = 8
+        art = [(f"{self.fake.url}/art/{n}.jpg", os.path.join(self.temp.name, f"{n}.jpg")) for n in range(8)]
+
+        self.assertEqual(tvdbfetch.prefetch(art=art), 0)
+
+        times = [t for t, command, path in self.fake.requests()]
+        self.assertEqual(len(times), 8)
+        # The burst goes straight out, the other six wait for a token each
+        self.assertGreaterEqual(times[-1] - times[0], (8 - 2) / 10 * 0.9)
+        for n in range(8):
+            with open(os.path.join(self.temp.name, f"{n}.jpg"), "rb") as file:
+                self.assertEqual(file.read(), f"art {n}.jpg".encode())
+
+    def test_cache_hit(self):
+        args = self.show_args("Friends")
+        self.assertEqual(tvdbfetch.prefetch(shows=[args]), 0)
+        with open(args[2]) as file:
+            episodes = json.load(file)
+        fetched = len(self.fake.requests("GET"))
+        self.assertEqual(fetched, 3)
+
+        os.remove(args[2])
+        tvdbfetch.token = None
+        self.assertEqual(tvdbfetch.prefetch(shows=[args]), 0)
+
+        # Answered from the cache, not even a login
+        self.assertEqual(len(self.fake.requests("GET")), fetched)
+        self.assertEqual(len(self.fake.requests("POST")), 1)
+        with open(args[2]) as file:
+            self.assertEqual(json.load(file), episodes)
+
+    def test_error_retry(self):
+        self.fake.fail("search", 1)
+        args = self.show_args("Friends")
+
+        self.assertEqual(tvdbfetch.prefetch(shows=[args]), 0)
+
+        searches = [path for t, command, path in self.fake.requests("GET") if path.startswith("/v4/search")]
+        self.assertEqual(len(searches), 2)
+        self.assertTrue(os.path.exists(args[3]))
+
+    def test_client_error_not_retried(self):
+        self.fake.fail("search", 1, code=404)
+        args = self.show_args("Friends")
+
+        self.assertEqual(tvdbfetch.prefetch(shows=[args]), 1)
+
+        searches = [path for t, command, path in self.fake.requests("GET") if path.startswith("/v4/search")]
+        self.assertEqual(len(searches), 1)
+        self.assertFalse(os.path.exists(args[2]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,332 @@
+# TVDB Fetch
+import asyncio
+import hashlib
+import json
+import os
+import time
+import logging
+import urllib.error
+import urllib.parse
+import urllib.request
+import metrics
+
+log = logging.getLogger("rich")
+
+# Variables
+api_url = os.getenv("TVDB_API_URL", "https://api4.thetvdb.com/v4").rstrip("/")
+cache_dir = os.path.expanduser(os.getenv("TVDB_CACHE_DIR", "~/.cache/solostation/tvdb"))
+concurrency = int(os.getenv("TVDB_CONCURRENCY", 4))
+rate = float(os.getenv("TVDB_RATE", 5))
+burst = int(os.getenv("TVDB_BURST", 5))
+request_timeout = float(os.getenv("TVDB_TIMEOUT", 30))
+retries = 3
+
+# Seconds each kind of response stays fresh in the cache
+cache_ttls = {
+    "search": 7 * 86400,
+    "episodes": 7 * 86400,
+    "extended": 30 * 86400,
+}
+
+token = None
+login_lock = None
+semaphore = None
+bucket = None
+
+# Functions
+class TokenBucket:
+    """ Allows rate requests per second on average, with bursts of up to capacity """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def take(self):
+        """ Waits until a token is available and takes it """
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def cache_key(url):
+    """ Cache reference for a request """
+    return hashlib.sha256(url.encode()).hexdigest()
+
+def read_cache(url, ttl):
+    """
+    Looks up a cached response. References live under refs/, named by the hash of
+    the request, and point at response bodies under objects/, named by the hash of
+    their content, so identical responses are only stored once.
+
+    Args:
+        url (string): Request URL
+        ttl (float): Seconds the response stays fresh, None never expires
+
+    Returns:
+        data: Cached response
+        OR
+        None (if not cached or expired)
+    """
+
+    ref_file = os.path.join(cache_dir, "refs", cache_key(url))
+    try:
+        with open(ref_file, "r") as file:
+            ref = json.load(file)
+        if ttl is not None and time.time() - ref["fetched"] > ttl:
+            return None
+        with open(os.path.join(cache_dir, "objects", ref["object"]), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError, KeyError):
+        return None
+
+def write_cache(url, data):
+    """ Stores a response body by content hash and points the request's reference at it """
+    body = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    object_hash = hashlib.sha256(body.encode()).hexdigest()
+
+    for folder in ("refs", "objects"):
+        os.makedirs(os.path.join(cache_dir, folder), exist_ok=True)
+
+    object_file = os.path.join(cache_dir, "objects", object_hash)
+    if not os.path.exists(object_file):
+        write_atomic(object_file, body)
+    write_atomic(os.path.join(cache_dir, "refs", cache_key(url)), json.dumps({"url": url, "object": object_hash, "fetched": time.time()}))
+
+def write_atomic(path, text):
+    """ Writes text to path through a temporary file, readers never see half a file """
+    temp_file = f"{path}.{os.getpid()}.tmp"
+    with open(temp_file, "w") as file:
+        file.write(text)
+    os.replace(temp_file, path)
+
+def http_request(url, body=None, headers=None):
+    """ Blocking HTTP request, run in a worker thread. Returns the raw response body. """
+    request = urllib.request.Request(url, data=body, headers=headers or {})
+    with urllib.request.urlopen(request, timeout=request_timeout) as response:
+        return response.read()
+
+async def request(url, body=None, headers=None):
+    """
+    Makes one rate limited request, retrying rate limit and server errors with backoff
+
+    Args:
+        url (string): Full URL
+        body (bytes): POST body, GET if None
+        headers (dictionary): Extra request headers
+
+    Returns:
+        content (bytes): Response body
+    """
+
+    for attempt in range(retries + 1):
+        async with semaphore:
+            await bucket.take()
+            try:
+                with metrics.timer("solostation_tvdb_request_seconds"):
+                    return await asyncio.to_thread(http_request, url, body, headers)
+            except urllib.error.HTTPError as e:
+                if e.code != 429 and e.code < 500 or attempt == retries:
+                    raise
+                log.debug(f"TVDB returned {e.code}, retrying {url}")
+            except urllib.error.URLError:
+                if attempt == retries:
+                    raise
+        await asyncio.sleep(2 ** attempt)
+
+async def login():
+    """ Gets a bearer token with TVDB_API_KEY, once per run """
+    global token
+
+    async with login_lock:
+        if token is None:
+            body = json.dumps({"apikey": os.getenv("TVDB_API_KEY", "")}).encode()
+            content = await request(f"{api_url}/login", body, {"Content-Type": "application/json"})
+            token = json.loads(content)["data"]["token"]
+    return token
+
+async def get(path, kind, **params):
+    """
+    Fetches a TVDB endpoint, answering from the cache while it is fresh
+
+    Args:
+        path (string): Endpoint path, i.e. 'series/121361/extended'
+        kind (string): Key in cache_ttls
+        params: Query string parameters
+
+    Returns:
+        data: The response's 'data' field
+
+    Example:
+        await get("search", "search", query="Friends")
+    """
+
+    url = f"{api_url}/{path}"
+    if params:
+        url = f"{url}?{urllib.parse.urlencode(params)}"
+
+    data = read_cache(url, cache_ttls[kind])
+    if data is not None:
+        metrics.inc("solostation_tvdb_cache_total", result="hit")
+        return data
+    metrics.inc("solostation_tvdb_cache_total", result="miss")
+
+    headers = {"Authorization": f"Bearer {await login()}", "Accept": "application/json"}
+    data = json.loads(await request(url, headers=headers))["data"]
+    write_cache(url, data)
+    return data
+
+async def search(query):
+    """ Searches TVDB for series and movies by name """
+    return await get("search", "search", query=query)
+
+async def get_series_episodes(tvdb_id):
+    """ Series record and every episode of a series, following pagination """
+    data = await get(f"series/{tvdb_id}/episodes/default", "episodes", page=0)
+    episodes = list(data.get("episodes") or [])
+
+    page = 1
+    while len(data.get("episodes") or []) >= 500:
+        data = await get(f"series/{tvdb_id}/episodes/default", "episodes", page=page)
+        episodes += data.get("episodes") or []
+        page += 1
+
+    return {**data, "episodes": episodes}
+
+async def get_series_extended(tvdb_id):
+    """ Extended series record, genres and artwork included """
+    return await get(f"series/{tvdb_id}/extended", "extended")
+
+async def get_movie_extended(tvdb_id):
+    """ Extended movie record, genres and artwork included """
+    return await get(f"movies/{tvdb_id}/extended", "extended")
+
+async def download_file(url, path):
+    """ Downloads url to path, skipped if path already exists """
+    if os.path.exists(path):
+        return
+    content = await request(url)
+    await asyncio.to_thread(write_bytes, path, content)
+
+def write_bytes(path, content):
+    """ Writes content to path through a temporary file """
+    temp_file = f"{path}.{os.getpid()}.tmp"
+    with open(temp_file, "wb") as file:
+        file.write(content)
+    os.replace(temp_file, path)
+
+async def fetch_show(show_name, show_year, episode_json, extended_json):
+    """
+    Downloads the episode and series extended metadata for a show to separate JSON files
+
+    Args:
+        show_name (string): Name of the show
+        show_year (string): Year of the show
+        episode_json (string): Location of the episode JSON file
+        extended_json (string): Location of the series extended JSON file
+
+    Returns:
+        None
+    """
+
+    results = await search(show_name)
+    series = [s for s in results if s.get("type") == "series" and s.get("year") == show_year][0]
+    episode_data, extended_data = await asyncio.gather(
+        get_series_episodes(series["tvdb_id"]),
+        get_series_extended(series["tvdb_id"]),
+    )
+
+    await asyncio.to_thread(write_atomic, episode_json, json.dumps(episode_data, indent=4))
+    await asyncio.to_thread(write_atomic, extended_json, json.dumps(extended_data, indent=4))
+
+async def fetch_movie(movie_name, movie_year, movie_json, movie_extended_json, movie_art=None):
+    """
+    Downloads a movie's metadata, extended metadata and, optionally, its art
+
+    Args:
+        movie_name (string): Name of the movie
+        movie_year (string): Year of the movie
+        movie_json (string): Location of the movie JSON file
+        movie_extended_json (string): Location of the movie extended JSON file
+        movie_art (string): Location of the art file, skipped if None
+
+    Returns:
+        None
+    """
+
+    results = await search(movie_name)
+    movie = [m for m in results if m.get("type") == "movie" and m.get("year") == movie_year][0]
+    extended_data = await get_movie_extended(movie["tvdb_id"])
+
+    await asyncio.to_thread(write_atomic, movie_json, json.dumps(movie, indent=4))
+    await asyncio.to_thread(write_atomic, movie_extended_json, json.dumps(extended_data, indent=4))
+
+    if movie_art:
+        art_urls = [a["image"] for a in extended_data.get("artworks") or [] if a.get("width") == 680]
+        if art_urls:
+            await download_file(art_urls[0], movie_art)
+
+async def tracked(job, args, on_done):
+    """ Awaits one fetch, then tells on_done its arguments whether it worked or not """
+    try:
+        return await job
+    finally:
+        if on_done:
+            on_done(args)
+
+async def fetch_all(shows=(), movies=(), art=(), on_done=None):
+    """
+    Runs every fetch concurrently, bounded by TVDB_CONCURRENCY and TVDB_RATE
+
+    Args:
+        shows (list): fetch_show() argument tuples
+        movies (list): fetch_movie() argument tuples
+        art (list): (url, path) tuples
+        on_done (function): Called with a fetch's argument tuple as soon as that fetch finishes
+
+    Returns:
+        failures (int): Fetches that failed, each one is logged
+    """
+
+    global login_lock, semaphore, bucket
+
+    login_lock = asyncio.Lock()
+    semaphore = asyncio.Semaphore(concurrency)
+    bucket = TokenBucket(rate, burst)
+
+    jobs = [(f"show {args[0]}", tracked(fetch_show(*args), args, on_done)) for args in shows]
+    jobs += [(f"movie {args[0]}", tracked(fetch_movie(*args), args, on_done)) for args in movies]
+    jobs += [(f"art {args[1]}", tracked(download_file(*args), args, on_done)) for args in art]
+
+    results = await asyncio.gather(*(job for name, job in jobs), return_exceptions=True)
+    failures = 0
+    for (name, job), result in zip(jobs, results):
+        if isinstance(result, Exception):
+            failures += 1
+            log.debug(f"Could not fetch TVDB metadata for {name}: {result!r}")
+
+    log.info(f"Fetched TVDB metadata for {len(jobs) - failures} of {len(jobs)} items")
+    return failures
+
+def prefetch(shows=(), movies=(), art=(), on_done=None):
+    """
+    Fetches metadata for many shows and movies at once from synchronous code.
+    Only one prefetch should run at a time, they share the rate limit.
+
+    Example:
+        prefetch(shows=[("Friends", "1994", episode_json, series_extended_json)])
+    """
+
+    if not shows and not movies and not art:
+        return 0
+    return asyncio.run(fetch_all(shows, movies, art, on_done))
+
+metrics.describe("solostation_tvdb_request_seconds", "histogram", "TVDB API request latency")
+metrics.describe("solostation_tvdb_cache_total", "counter", "TVDB responses answered from the cache or fetched")
@@ -0,0 +1,224 @@
+# Watcher
+import os
+import queue
+import threading
+import time
+import logging
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+log = logging.getLogger("rich")
+
+# Variables
+# A path is handed on once it has had no events for this long, so copies in progress are left alone
+debounce_seconds = float(os.getenv("WATCH_DEBOUNCE_SECONDS", 10))
+poll_interval = float(os.getenv("WATCH_POLL_INTERVAL", 60))
+watch_backend = os.getenv("WATCH_BACKEND", "auto").lower()
+media_extensions = (".mp4", ".mkv")
+
+# Put on the event queue when events were lost and every root needs a rescan
+rescan = object()
+
+# Functions
+def is_media(path):
+    """ True for the video files the media manager ingests """
+    return path.lower().endswith(media_extensions) and not os.path.basename(path).startswith(".")
+
+def walk_files(root):
+    """
+    Every media file under root with its size and modification time
+
+    Args:
+        root (string): Folder to walk
+
+    Returns:
+        files (dictionary): Path to (size, mtime)
+    """
+
+    files = {}
+    for folder, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(folder, name)
+            if not is_media(path):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files[path] = (stat.st_size, stat.st_mtime)
+    return files
+
+def watch_inotify(roots, events, stop, ready):
+    """
+    Puts the path of every media file written, or moved, under roots on events.
+    inotify isn't recursive, so every folder gets a watch, including new ones.
+
+    Args:
+        roots (list): Folders to watch
+        events (queue.Queue): Receives paths, or rescan if the kernel queue overflowed
+        stop (threading.Event): Ends the watch when set
+        ready (threading.Event): Set once every folder is watched
+
+    Returns:
+        None
+    """
+
+    inotify = INotify()
+    folder_mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+    folders = {}
+
+    def add_folder(folder, report=False):
+        for current, _, names in os.walk(folder):
+            try:
+                folders[inotify.add_watch(current, folder_mask)] = current
+            except OSError as e:
+                log.warning(f"Could not watch {current}: {e}")
+                continue
+            # Files can land in a new folder before its watch is in place
+            if report:
+                for name in names:
+                    if is_media(name):
+                        events.put(os.path.join(current, name))
+
+    for root in roots:
+        add_folder(root)
+    log.info(f"Watching {len(folders)} folders with inotify")
+    ready.set()
+
+    while not stop.is_set():
+        for event in inotify.read(timeout=1000):
+            if event.mask & flags.Q_OVERFLOW:
+                log.warning("inotify queue overflowed, rescanning")
+                events.put(rescan)
+                continue
+            if event.mask & flags.IGNORED:
+                folders.pop(event.wd, None)
+                continue
+
+            folder = folders.get(event.wd)
+            if folder is None:
+                continue
+            path = os.path.join(folder, event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    add_folder(path, report=True)
+            elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO) and is_media(path):
+                events.put(path)
+
+    inotify.close()
+
+def watch_polling(roots, events, stop, ready):
+    """
+    Puts the path of every media file that appeared or changed under roots on
+    events, found by comparing sizes and mtimes every WATCH_POLL_INTERVAL seconds.
+    A path is only put on events once it is unchanged across two polls, so a
+    copy still in progress isn't ingested truncated. Used where inotify isn't
+    available, i.e. network shares.
+
+    Args:
+        roots (list): Folders to watch
+        events (queue.Queue): Receives paths
+        stop (threading.Event): Ends the watch when set
+        ready (threading.Event): Set once the first listing is taken
+
+    Returns:
+        None
+    """
+
+    known = {}
+    for root in roots:
+        known.update(walk_files(root))
+    log.info(f"Polling {len(known)} files every {poll_interval:g} seconds")
+    ready.set()
+
+    changing = set()
+    while not stop.wait(poll_interval):
+        current = {}
+        for root in roots:
+            current.update(walk_files(root))
+        for path, stat in current.items():
+            if known.get(path) != stat:
+                changing.add(path)
+            elif path in changing:
+                changing.discard(path)
+                events.put(path)
+        changing &= current.keys()
+        known = current
+
+def watch(roots, on_change, on_start=None, stop=None):
+    """
+    Watches folders for new and changed media files and calls on_change with each
+    settled batch. Uses inotify when inotify_simple is installed (WATCH_BACKEND
+    'auto' or 'inotify'), and polling otherwise (or with WATCH_BACKEND 'poll').
+    Blocks until stop is set; on_change and on_start run in the calling thread.
+
+    Args:
+        roots (list): Folders to watch, missing ones are skipped
+        on_change (function): Called with a set of paths, or None when every root needs a rescan
+        on_start (function): Optional, called once the watch is in place, i.e. a full
+            scan, so files that land while it runs aren't missed
+        stop (threading.Event): Optional event that ends the watch
+
+    Returns:
+        None
+
+    Example:
+        watch([tv_root, movie_root], ingest_paths)
+    """
+
+    stop = stop or threading.Event()
+    roots = [root for root in roots if root and os.path.isdir(root)]
+    events = queue.Queue()
+    ready = threading.Event()
+
+    backend = watch_polling
+    if watch_backend != "poll":
+        if INotify is not None:
+            backend = watch_inotify
+        else:
+            log.warning("inotify_simple is not installed, polling for changes instead")
+
+    thread = threading.Thread(target=backend, args=(roots, events, stop, ready), name="watcher", daemon=True)
+    thread.start()
+    while not ready.wait(1):
+        if not thread.is_alive():
+            log.error("Watcher thread stopped before the watch was in place")
+            return
+    if on_start:
+        on_start()
+
+    pending = {}
+    rescan_at = None
+    while not stop.is_set():
+        waits = list(pending.values()) + ([rescan_at] if rescan_at is not None else [])
+        timeout = max(0.1, min(waits) + debounce_seconds - time.monotonic()) if waits else 1
+        try:
+            path = events.get(timeout=timeout)
+            if path is rescan:
+                rescan_at = time.monotonic()
+            else:
+                pending[path] = time.monotonic()
+        except queue.Empty:
+            if not thread.is_alive():
+                log.error("Watcher thread stopped, ending the watch")
+                break
+
+        # Hand on the paths that have been quiet for the debounce time, even while
+        # events keep arriving for others
+        now = time.monotonic()
+        settled = {path for path, last in pending.items() if now - last >= debounce_seconds}
+        if rescan_at is not None and len(settled) == len(pending) and now - rescan_at >= debounce_seconds:
+            pending.clear()
+            rescan_at = None
+            on_change(None)
+        elif settled:
+            for path in settled:
+                del pending[path]
+            settled = {path for path in settled if os.path.isfile(path)}
+            if settled:
+                on_change(settled)
+
+    stop.set()